@@ -1,12 +1,23 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import re
+import binascii
 from contextlib import contextmanager
 import errno
+import fcntl
 import itertools
 import os
 import stat
+import struct
+import subprocess
 import sys
 import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue
 
 from curtin import util
 from curtin.block import lvm
@@ -18,6 +29,16 @@ from curtin import storage_config
 
 SECTOR_SIZE_BYTES = 512
 
+# block device ioctls taking a uint64_t[2] {start, length} byte range
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
+# generators of RandomStream, fastest first
+RANDOM_GENERATORS = ('aes-ctr', 'urandom')
+# errnos of range ioctls that the device or driver does not support
+BLK_IOCTL_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                         errno.ENOTSUP)
+
 
 def get_dev_name_entry(devname):
     """
@@ -319,6 +340,56 @@ def get_partition_sfdisk_info(devpath, sfdisk_info=None):
     return entry.pop()
 
 
+class PartitionTableCache(object):
+    """
+    Cache of the sfdisk_info of disks, keyed by disk, so that looking up
+    many partitions of a disk runs sfdisk once.
+
+    The cached table of a disk must be invalidated whenever the partition
+    table of that disk is written.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, disk):
+        disk = os.path.realpath(disk)
+        with self._lock:
+            table = self._tables.get(disk)
+        if table is None:
+            info = sfdisk_info(disk)
+            table = (info, dict((os.path.realpath(part['node']), part)
+                                for part in info.get('partitions', [])))
+            # failures to read the table are not cached
+            if info:
+                with self._lock:
+                    self._tables[disk] = table
+        return table
+
+    def sfdisk_info(self, disk):
+        """return the sfdisk_info of disk"""
+        return self._lookup(disk)[0]
+
+    def partition_info(self, disk, devpath):
+        """return the sfdisk_info entry of partition devpath on disk"""
+        (info, partitions) = self._lookup(disk)
+        entry = partitions.get(os.path.realpath(devpath))
+        if entry is None:
+            raise RuntimeError('Device %s not present in sfdisk dump:\n%s' %
+                               (devpath, util.json_dumps(info)))
+        return entry
+
+    def invalidate(self, disk):
+        """forget the partition table of disk"""
+        with self._lock:
+            self._tables.pop(os.path.realpath(disk), None)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+
 def dmsetup_info(devname):
     ''' returns dict of info about device mapper dev.
 
@@ -566,6 +637,35 @@ def blkid(devs=None, cache=True):
     return data
 
 
+def blkid_export(devs):
+    """
+    get blkid tags of each of devs from a single blkid call
+
+    :param devs: list of device paths to probe
+    :returns: dict mapping each DEVNAME reported by blkid to a dict of its
+              tags (TYPE, UUID, PTUUID, PARTUUID, LABEL, ...)
+    """
+    if not devs:
+        return {}
+    # blkid exits 2 if none of devs has any tags
+    out, _err = util.subp(['blkid', '-o', 'export'] + list(devs),
+                          capture=True, rcs=[0, 2], retries=[1, 1, 1])
+    # blkid -o export output is a block of KEY=value lines per device,
+    # starting with DEVNAME and separated by empty lines
+    data = {}
+    for record in out.split('\n\n'):
+        tags = {}
+        for line in record.splitlines():
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            # values are shell escaped
+            tags[key] = ''.join(util.shlex_split(value))
+        if tags.get('DEVNAME'):
+            data[tags['DEVNAME']] = tags
+    return data
+
+
 def _legacy_detect_multipath(target_mountpoint=None):
     """
     Detect if the operating system has been installed to a multipath device.
@@ -946,8 +1046,12 @@ def lookup_disk(serial):
         path = os.path.join('/dev/mapper', info['DM_NAME'])
     # /dev/sdX
     elif multipath.is_mpath_member(path):
-        mp_name = multipath.find_mpath_id_by_path(path)
-        path = os.path.join('/dev/mapper', mp_name)
+        # refreshes the topology if path is not in it yet
+        mp_name = multipath.get_mpath_id_from_device(path)
+        if mp_name:
+            path = os.path.join('/dev/mapper', mp_name)
+        else:
+            LOG.debug('lookup_disk: no multipath map holds %s', path)
 
     if not os.path.exists(path):
         raise ValueError("path '%s' to block device for disk with serial '%s' \
@@ -1174,6 +1278,101 @@ def exclusive_open(path, exclusive=True):
         raise
 
 
+class RandomStream(object):
+    """
+    A reader of random data for wiping volumes, much faster than reading
+    /dev/urandom.
+
+    The 'aes-ctr' generator encrypts zeros with AES-256 in counter mode
+    (openssl enc) using a key and iv derived from a passphrase read once
+    from the kernel CSPRNG, the 'urandom' generator reads /dev/urandom.
+    The passphrase is passed on stdin, never on the command line where
+    other users could read it.  A producer thread keeps up to
+    'depth' buffers of 'buflen' bytes ready, so that the data is generated
+    while the previous buffers are being written.
+    """
+
+    def __init__(self, generator=None, buflen=4 * 1024 * 1024, depth=4):
+        if generator is None:
+            generator = 'aes-ctr' if util.which('openssl') else 'urandom'
+        if generator not in RANDOM_GENERATORS:
+            raise ValueError('Unknown random generator: %s' % generator)
+        self.generator = generator
+        self.buflen = buflen
+        self._proc = None
+        if generator == 'aes-ctr':
+            passphrase = binascii.hexlify(os.urandom(32))
+            with open(os.devnull, 'wb') as devnull:
+                self._proc = subprocess.Popen(
+                    ['openssl', 'enc', '-aes-256-ctr', '-nosalt',
+                     '-pass', 'stdin', '-in', '/dev/zero'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull)
+            self._proc.stdin.write(passphrase + b'\n')
+            self._proc.stdin.close()
+            self._source = self._proc.stdout
+        else:
+            self._source = open('/dev/urandom', 'rb')
+        self._pending = b''
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._producer = threading.Thread(target=self._produce)
+        self._producer.daemon = True
+        self._producer.start()
+
+    def _produce(self):
+        try:
+            while not self._closed.is_set():
+                data = self._source.read(self.buflen)
+                if len(data) != self.buflen:
+                    raise IOError('short read from %s random generator' %
+                                  self.generator)
+                self._put(data)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size):
+        """return size bytes of random data"""
+        chunks = [self._pending]
+        available = len(self._pending)
+        while available < size:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            chunks.append(item)
+            available += len(item)
+        if available == size and len(chunks) == 2 and not chunks[0]:
+            # the common case of reading whole buffers needs no copy
+            self._pending = b''
+            return chunks[1]
+        data = b''.join(chunks)
+        self._pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._closed.set()
+        if self._proc:
+            self._proc.kill()
+        self._producer.join()
+        if self._proc:
+            self._proc.wait()
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
     """
     wipe the existing file at path.
@@ -1209,41 +1408,121 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
                 fp.write(pbuf)
 
 
+def blkdev_range_ioctl(path, request, exclusive=True):
+    """
+    issue a range ioctl (BLKZEROOUT, BLKDISCARD, BLKSECDISCARD) covering the
+    whole block device at path, letting the kernel and the device wipe it
+    without any data being copied from userspace.
+    returns True on success and False if the device does not support it.
+    """
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        try:
+            fcntl.ioctl(fp.fileno(), request, struct.pack('=QQ', 0, size))
+        except (IOError, OSError) as e:
+            if e.errno not in BLK_IOCTL_UNSUPPORTED:
+                raise
+            LOG.debug('%s: ioctl 0x%x not supported: %s', path, request, e)
+            return False
+    LOG.debug('%s: wiped %s bytes with ioctl 0x%x', path, size, request)
+    return True
+
+
+def zero_volume(path, exclusive=True):
+    """
+    write zeros to the entire volume, offloading the writes to the kernel
+    with BLKZEROOUT where possible (which uses the device's write zeroes
+    command if it has one) and falling back to writing zero buffers.
+    """
+    if (is_block_device(path) and
+            blkdev_range_ioctl(path, BLKZEROOUT, exclusive=exclusive)):
+        return
+    wipe_file(path, exclusive=exclusive)
+
+
+def discard_volume(path, exclusive=True):
+    """
+    discard the entire volume, using a secure discard where the device
+    supports one.  devices which support neither are zeroed instead.
+    """
+    if is_block_device(path):
+        for request in (BLKSECDISCARD, BLKDISCARD):
+            if blkdev_range_ioctl(path, request, exclusive=exclusive):
+                return
+    LOG.debug('%s does not support discard, writing zeros instead', path)
+    zero_volume(path, exclusive=exclusive)
+
+
 def quick_zero(path, partitions=True, exclusive=True):
     """
     zero 1M at front, 1M at end, and 1M at front
     if this is a block device and partitions is true, then
     zero 1M at front and end of each partition.
+
+    all of the ranges, including those of the partitions, are zeroed through
+    a single open of path.
     """
-    buflen = 1024
-    count = 1024
-    zero_size = buflen * count
-    offsets = [0, -zero_size]
+    zero_size = 1024 * 1024
     is_block = is_block_device(path)
     if not (is_block or os.path.isfile(path)):
         raise ValueError("%s: not an existing file or block device", path)
 
-    pt_names = []
+    ranges = []
     if partitions and is_block:
-        ptdata = sysfs_partition_data(path)
-        for kname, ptnum, start, size in ptdata:
-            pt_names.append((dev_path(kname), kname, ptnum))
-        pt_names.reverse()
+        for (kname, start, size) in sysfs_partition_extents(path):
+            LOG.debug('Wiping partition %s of %s at offset %s',
+                      kname, path, start)
+            ranges.append((start, min(zero_size, size)))
+            if size > zero_size:
+                ranges.append((start + size - zero_size, zero_size))
+
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        LOG.debug("wiping 1M on %s at offsets %s", path, [0, -zero_size])
+        ranges.append((0, min(zero_size, size)))
+        if size > zero_size:
+            ranges.append((size - zero_size, zero_size))
+        _zero_ranges(fp, ranges)
+
 
-    for (pt, kname, ptnum) in pt_names:
-        LOG.debug('Wiping path: dev:%s kname:%s partnum:%s',
-                  pt, kname, ptnum)
-        quick_zero(pt, partitions=False)
+def sysfs_partition_extents(device):
+    """
+    return a list of (kname, start, size) of the partitions on device, with
+    start and size in bytes.
+    """
+    # sysfs reports partition start and size in 512 byte sectors, whatever
+    # the logical block size of the disk is
+    extents = []
+    for part_sysfs in get_sysfs_partitions(device):
+        extents.append(
+            (path_to_kname(part_sysfs),
+             int(util.load_file(os.path.join(part_sysfs, 'start'))) *
+             SECTOR_SIZE_BYTES,
+             int(util.load_file(os.path.join(part_sysfs, 'size'))) *
+             SECTOR_SIZE_BYTES))
+    return extents
 
-    LOG.debug("wiping 1M on %s at offsets %s", path, offsets)
-    return zero_file_at_offsets(path, offsets, buflen=buflen, count=count,
-                                exclusive=exclusive)
+
+def _zero_ranges(fp, ranges):
+    """
+    write zeros to the (offset, length) ranges of the open file fp, in
+    offset order with one write per range, and flush them to the device
+    """
+    buf = memoryview(b'\0' * max([length for (_, length) in ranges] + [0]))
+    for (offset, length) in sorted(ranges):
+        fp.seek(offset)
+        fp.write(buf[0:length])
+    fp.flush()
+    os.fsync(fp.fileno())
 
 
 def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
                          exclusive=True):
     """
-    write zeros to file at specified offsets
+    write buflen * count zeros to file at specified offsets, negative offsets
+    are relative to the end of the file
     """
     bmsg = "{path} (size={size}): "
     m_short = bmsg + "{tot} bytes from {offset} > size."
@@ -1252,7 +1531,6 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
         m_short += " Shortened to {wsize} bytes."
         m_badoff += " Skipping."
 
-    buf = b'\0' * buflen
     tot = buflen * count
     msg_vals = {'path': path, 'tot': buflen * count}
 
@@ -1263,6 +1541,7 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
         size = fp.tell()
         msg_vals['size'] = size
 
+        ranges = []
         for offset in offsets:
             if offset < 0:
                 pos = size + offset
@@ -1283,13 +1562,9 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
                     raise ValueError(m_short.format(**msg_vals))
                 else:
                     LOG.debug(m_short.format(**msg_vals))
-            fp.seek(pos)
-            for i in range(count):
-                pos = fp.tell()
-                if pos + buflen > size:
-                    fp.write(buf[0:size-pos])
-                else:
-                    fp.write(buf)
+            ranges.append((pos, min(tot, size - pos)))
+
+        _zero_ranges(fp, ranges)
 
 
 def wipe_volume(path, mode="superblock", exclusive=True):
@@ -1299,7 +1574,9 @@ def wipe_volume(path, mode="superblock", exclusive=True):
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
        zero: write zeros to the entire volume
-       random: write random data (/dev/urandom) to the entire volume
+       discard: discard (securely, if supported) the entire volume, or write
+                zeros if the volume does not support discard
+       random: write random data (see RandomStream) to the entire volume
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
                     volume and beginning and end of any partitions that are
@@ -1317,9 +1594,11 @@ def wipe_volume(path, mode="superblock", exclusive=True):
                   rcs=[0, 5], capture=True)
         lvm.lvm_scan()
     elif mode == "zero":
-        wipe_file(path, exclusive=exclusive)
+        zero_volume(path, exclusive=exclusive)
+    elif mode == "discard":
+        discard_volume(path, exclusive=exclusive)
     elif mode == "random":
-        with open("/dev/urandom", "rb") as reader:
+        with RandomStream() as reader:
             wipe_file(path, reader=reader.read, exclusive=exclusive)
     elif mode == "superblock":
         quick_zero(path, partitions=False, exclusive=exclusive)
@@ -6,12 +6,17 @@ import time
 
 from curtin import util
 from curtin.log import LOG
-from curtin.udev import udevadm_settle
+from curtin.udev import UEVENT_POLL_INTERVAL, wait_for_paths
 from . import dev_path, sys_block_path
 
 # Wait up to 20 minutes (150 + 300 + 750 = 1200 seconds)
 BCACHE_RETRIES = [sleep for nap in [1, 2, 5] for sleep in [nap] * 150]
-BCACHE_REGISTRATION_RETRY = [0.2] * 60
+# Seconds to wait for new bcache devices to register.  The bcache-tools udev
+# rules usually register them, curtin only writes to /sys/fs/bcache/register
+# for devices still missing after BCACHE_UDEV_REGISTRATION_TIMEOUT seconds and
+# again every BCACHE_UDEV_REGISTRATION_TIMEOUT seconds after that.
+BCACHE_REGISTRATION_TIMEOUT = 12
+BCACHE_UDEV_REGISTRATION_TIMEOUT = 1
 
 
 def superblock_asdict(device=None, data=None):
@@ -379,62 +384,82 @@ def validate_bcache_ready(bcache_device, bcache_sys_path):
         return ValueError(msg)
 
 
-def ensure_bcache_is_registered(bcache_device, expected, retry=None):
-    """ Test that bcache_device is found at an expected path and
-        re-register the device if it's not ready.
+def ensure_bcaches_registered(devices, timeout=None):
+    """ Wait until each bcache device is registered at its expected sysfs
+        path, registering the devices which udev did not register.
+
+    Registration is waited for on kernel uevents rather than with sleeps,
+    so this returns as soon as the last device is ready.
 
-        Retry the validation and registration as needed.
+    :param devices: dict mapping each bcache device path to the sysfs path
+                    expected once it is registered, /sys/fs/bcache/<cset>
+                    for cache devices and /sys/class/block/<dev>/bcache for
+                    backing devices.
+    :param timeout: seconds to wait, BCACHE_REGISTRATION_TIMEOUT by default
+    :raises: RuntimeError if any device is not ready within timeout
     """
-    if not retry:
-        retry = BCACHE_REGISTRATION_RETRY
-
-    for attempt, wait in enumerate(retry):
-        # find the actual bcache device name via sysfs using the
-        # backing device's holders directory.
-        LOG.debug('check just created bcache %s if it is registered,'
-                  ' try=%s', bcache_device, attempt + 1)
-        try:
-            udevadm_settle()
-            if os.path.exists(expected):
-                LOG.debug('Found bcache dev %s at expected path %s',
-                          bcache_device, expected)
-                validate_bcache_ready(bcache_device, expected)
-            else:
-                msg = 'bcache device path not found: %s' % expected
-                LOG.debug(msg)
-                raise ValueError(msg)
-
-            # if bcache path exists and holders are > 0 we can return
-            LOG.debug('bcache dev %s at path %s successfully registered'
-                      ' on attempt %s/%s',  bcache_device, expected,
-                      attempt + 1, len(retry))
-            return
-
-        except (OSError, IndexError, ValueError):
-            # Some versions of bcache-tools will register the bcache device
-            # as soon as we run make-bcache using udev rules, so wait for
-            # udev to settle, then try to locate the dev, on older versions
-            # we need to register it manually though
-            LOG.debug('bcache device was not registered, registering %s '
-                      'at /sys/fs/bcache/register', bcache_device)
+    if timeout is None:
+        timeout = BCACHE_REGISTRATION_TIMEOUT
+    deadline = time.time() + timeout
+    pending = dict(devices)
+    registered = {}
+
+    # give the bcache-tools udev rules the first chance to register
+    wait_for_paths(list(pending.values()),
+                   timeout=min(timeout, BCACHE_UDEV_REGISTRATION_TIMEOUT))
+    while True:
+        for bcache_device, expected in sorted(pending.items()):
+            if not os.path.exists(expected):
+                last = registered.get(bcache_device)
+                if last and time.time() - last < (
+                        BCACHE_UDEV_REGISTRATION_TIMEOUT):
+                    continue
+                LOG.debug('bcache device was not registered, registering %s '
+                          'at /sys/fs/bcache/register', bcache_device)
+                try:
+                    register_bcache(bcache_device)
+                except IOError:
+                    # device creation is notoriously racy and this can
+                    # trigger "Invalid argument" IOErrors if it got created
+                    # in "the meantime", the path is checked again below
+                    pass
+                registered[bcache_device] = time.time()
+                continue
             try:
-                register_bcache(bcache_device)
-            except IOError:
-                # device creation is notoriously racy and this can trigger
-                # "Invalid argument" IOErrors if it got created in "the
-                # meantime" - just restart the function a few times to
-                # check it all again
-                pass
+                validate_bcache_ready(bcache_device, expected)
+            except (OSError, IndexError, ValueError) as e:
+                LOG.debug('bcache dev %s not ready: %s', bcache_device, e)
+                continue
+            LOG.debug('bcache dev %s at path %s successfully registered',
+                      bcache_device, expected)
+            del pending[bcache_device]
+
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            break
+        missing = [path for path in pending.values()
+                   if not os.path.exists(path)]
+        if missing:
+            wait_for_paths(missing, timeout=min(
+                remaining, BCACHE_UDEV_REGISTRATION_TIMEOUT))
+        else:
+            # registered but sysfs links not yet complete
+            time.sleep(min(remaining, UEVENT_POLL_INTERVAL))
+
+    if pending:
+        LOG.warning('Repetitive error registering the bcache devs %s',
+                    sorted(pending))
+        raise RuntimeError("bcache devices %s can't be registered" %
+                           sorted(pending))
+
 
-        LOG.debug("bcache dev %s not ready, waiting %ss",
-                  bcache_device, wait)
-        time.sleep(wait)
+def ensure_bcache_is_registered(bcache_device, expected, timeout=None):
+    """ Test that bcache_device is found at an expected path and
+        re-register the device if it's not ready.
 
-    # we've exhausted our retries
-    LOG.warning('Repetitive error registering the bcache dev %s',
-                bcache_device)
-    raise RuntimeError("bcache device %s can't be registered" %
-                       bcache_device)
+        See ensure_bcaches_registered.
+    """
+    ensure_bcaches_registered({bcache_device: expected}, timeout=timeout)
 
 
 def create_cache_device(cache_device):
@@ -464,44 +489,66 @@ def create_cache_device(cache_device):
     return cset_uuid
 
 
-def create_backing_device(backing_device, cache_device, cache_mode, cset_uuid):
-    backing_device_sysfs = sys_block_path(backing_device)
-    target_sysfs_path = os.path.join(backing_device_sysfs, "bcache")
+def create_backing_devices(backing_devices, cache_device, cset_uuid):
+    """ Create bcache devices on each of backing_devices, all attached to
+        the cache set cset_uuid of cache_device.
 
-    # there should not be any pre-existing bcache device
-    bdir = os.path.join(backing_device_sysfs, "bcache")
-    if os.path.exists(bdir):
-        raise RuntimeError(
-            'Unexpected old bcache device: %s', backing_device)
+    The backing devices are formatted with a single make-bcache call and
+    their registration is waited for together.
 
-    LOG.debug('Creating a backing device on %s', backing_device)
-    util.subp(["make-bcache", "-B", backing_device])
-    ensure_bcache_is_registered(backing_device, target_sysfs_path)
+    :param backing_devices: list of (backing device, cache mode) tuples,
+                            cache mode may be None to keep the default.
+    :returns: list of the created bcache device paths in the same order
+    """
+    for backing_device, _ in backing_devices:
+        # there should not be any pre-existing bcache device
+        bdir = os.path.join(sys_block_path(backing_device), "bcache")
+        if os.path.exists(bdir):
+            raise RuntimeError(
+                'Unexpected old bcache device: %s' % backing_device)
+
+    if cache_device and not cset_uuid:
+        msg = "Invalid cset_uuid: {}".format(cset_uuid)
+        LOG.error(msg)
+        raise ValueError(msg)
+
+    devices = [backing_device for backing_device, _ in backing_devices]
+    LOG.debug('Creating backing devices on %s', devices)
+    util.subp(["make-bcache", "-B"] + devices)
+    ensure_bcaches_registered(dict(
+        (backing_device, os.path.join(sys_block_path(backing_device),
+                                      "bcache"))
+        for backing_device in devices))
 
     # via the holders we can identify which bcache device we just created
     # for a given backing device
     from .clear_holders import get_holders
-    holders = get_holders(backing_device)
-    if len(holders) != 1:
-        err = ('Invalid number {} of holding devices:'
-               ' "{}"'.format(len(holders), holders))
-        LOG.error(err)
-        raise ValueError(err)
-    [bcache_dev] = holders
-    LOG.debug('The just created bcache device is {}'.format(holders))
-
-    if cache_device:
-        # if we specify both then we need to attach backing to cache
-        if cset_uuid:
-            attach_backing_to_cacheset(backing_device, cache_device, cset_uuid)
-        else:
-            msg = "Invalid cset_uuid: {}".format(cset_uuid)
-            LOG.error(msg)
-            raise ValueError(msg)
+    bcache_devs = []
+    for backing_device, cache_mode in backing_devices:
+        holders = get_holders(backing_device)
+        if len(holders) != 1:
+            err = ('Invalid number {} of holding devices:'
+                   ' "{}"'.format(len(holders), holders))
+            LOG.error(err)
+            raise ValueError(err)
+        [bcache_dev] = holders
+        LOG.debug('The just created bcache device is {}'.format(holders))
+
+        if cache_device:
+            # if we specify both then we need to attach backing to cache
+            attach_backing_to_cacheset(backing_device, cache_device,
+                                       cset_uuid)
+        if cache_mode:
+            set_cache_mode(bcache_dev, cache_mode)
+        bcache_devs.append(dev_path(bcache_dev))
+
+    return bcache_devs
 
-    if cache_mode:
-        set_cache_mode(bcache_dev, cache_mode)
-    return dev_path(bcache_dev)
+
+def create_backing_device(backing_device, cache_device, cache_mode, cset_uuid):
+    [bcache_dev] = create_backing_devices([(backing_device, cache_mode)],
+                                          cache_device, cset_uuid)
+    return bcache_dev
 
 
 # vi: ts=4 expandtab syntax=python
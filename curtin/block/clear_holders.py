@@ -9,6 +9,7 @@ having to reboot the system
 import glob
 import os
 import time
+from collections import OrderedDict
 
 from curtin import (block, udev, util)
 from curtin.swap import is_swap_device
@@ -42,6 +43,11 @@ def get_dmsetup_uuid(device):
     """
     get the dm uuid for a specified dmsetup device
     """
+    # the kernel exports the uuid of dm devices in sysfs, reading it from
+    # there saves a dmsetup call for every dm device in the holders tree
+    uuid_path = os.path.join(device, 'dm', 'uuid')
+    if os.path.exists(uuid_path):
+        return util.load_file(uuid_path).strip()
     blockdev = block.sysfs_to_devpath(device)
     (out, _) = util.subp(['dmsetup', 'info', blockdev, '-C', '-o', 'uuid',
                           '--noheadings'], capture=True)
@@ -136,11 +142,13 @@ def shutdown_lvm(device):
     # remove the logical volume
     LOG.debug('using "lvremove" on %s', vg_lv_name)
     util.subp(['lvremove', '--force', '--force', vg_lv_name])
+    lvm.invalidate()
 
     # if that was the last lvol in the volgroup, get rid of volgroup
     if len(lvm.get_lvols_in_volgroup(vg_name)) == 0:
         pvols = lvm.get_pvols_in_volgroup(vg_name)
         util.subp(['vgremove', '--force', '--force', vg_name], rcs=[0, 5])
+        lvm.invalidate()
 
         # wipe the underlying physical volumes
         for pv in pvols:
@@ -377,8 +385,10 @@ def identify_mdadm(device):
     """
     # RAID0 and 1 devices can be partitioned and the partitions are *not*
     # raid devices with a sysfs 'md' subdirectory
-    partition = identify_partition(device)
-    return block.path_to_kname(device).startswith('md') and not partition
+    # checking the kname first avoids probing for a partition (which may
+    # need udev data) on every device that is not a md device
+    return (block.path_to_kname(device).startswith('md') and
+            not identify_partition(device))
 
 
 def identify_bcache(device):
@@ -387,8 +397,8 @@ def identify_bcache(device):
     """
     # bcache devices can be partitioned and the partitions are *not*
     # bcache devices with a sysfs 'slaves' subdirectory
-    partition = identify_partition(device)
-    return block.path_to_kname(device).startswith('bcache') and not partition
+    return (block.path_to_kname(device).startswith('bcache') and
+            not identify_partition(device))
 
 
 def identify_partition(device):
@@ -431,11 +441,20 @@ def get_holders(device):
     return holders
 
 
-def gen_holders_tree(device):
+def gen_holders_tree(device, cache=None):
     """
     generate a tree representing the current storage hirearchy above 'device'
+
+    'cache' is an optional dict of the trees already generated, keyed by sysfs
+    path. sharing one cache between calls identifies each device only once,
+    and a device reached from several places in the hierarchy (such as a
+    raid array on multiple partitions) shares a single subtree
     """
+    if cache is None:
+        cache = {}
     device = block.sys_block_path(device)
+    if device in cache:
+        return cache[device]
     dev_name = block.path_to_kname(device)
     # the holders for a device should consist of the devices in the holders/
     # dir in sysfs and any partitions on the device. this ensures that a
@@ -456,10 +475,20 @@ def gen_holders_tree(device):
     # there is a default value defined
     dev_type = next((k for k, v in DEV_TYPES.items() if v['ident'](device)),
                     DEFAULT_DEV_TYPE)
-    return {
+    cache[device] = {
         'device': device, 'dev_type': dev_type, 'name': dev_name,
-        'holders': [gen_holders_tree(h) for h in holder_paths],
+        'holders': [gen_holders_tree(h, cache=cache) for h in holder_paths],
     }
+    return cache[device]
+
+
+def gen_holders_trees(devices):
+    """
+    generate the holders trees for a list of devices from a single scan of
+    the storage hirearchy
+    """
+    cache = {}
+    return [gen_holders_tree(device, cache=cache) for device in devices]
 
 
 def plan_shutdown_holder_trees(holders_trees):
@@ -485,10 +514,17 @@ def plan_shutdown_holder_trees(holders_trees):
     # sort the trees to ensure we generate a consistent plan
     holders_trees = sorted(holders_trees, key=lambda x: x['device'])
 
+    # subtree sizes, keyed by the id of the tree node. trees may share the
+    # subtree of a device with many holders, so each node is measured once
+    htree_levels = {}
+
     def htree_level(tree):
-        if len(tree['holders']) == 0:
-            return 0
-        return 1 + sum(htree_level(holder) for holder in tree['holders'])
+        key = id(tree)
+        if key not in htree_levels:
+            htree_levels[key] = (
+                1 + sum(htree_level(holder) for holder in tree['holders'])
+                if tree['holders'] else 0)
+        return htree_levels[key]
 
     def flatten_holders_tree(tree, level=0):
         """
@@ -549,6 +585,50 @@ def plan_shutdown_holder_trees(holders_trees):
                                            devtype_order(reg[x]['dev_type'])))]
 
 
+def get_shutdown_graph(holders_trees, ordered_devs):
+    """
+    map each device in the shutdown plan 'ordered_devs' to the devices which
+    must be shut down before it
+
+    devices connected to each other through holders form a stack. within a
+    stack every device waits for the device planned before it, so the planned
+    order is kept, while devices in unrelated stacks do not depend on each
+    other and may be shut down concurrently
+
+    returns an OrderedDict in shutdown plan order
+    """
+    if not isinstance(holders_trees, (list, tuple)):
+        holders_trees = [holders_trees]
+
+    # union-find over the device sysfs paths, joining devices to holders
+    stacks = {}
+
+    def find_stack(device):
+        stacks.setdefault(device, device)
+        while stacks[device] != device:
+            stacks[device] = stacks[stacks[device]]
+            device = stacks[device]
+        return device
+
+    def join_holders(tree):
+        for holder in tree['holders']:
+            stacks[find_stack(holder['device'])] = find_stack(tree['device'])
+            join_holders(holder)
+
+    for holders_tree in holders_trees:
+        find_stack(holders_tree['device'])
+        join_holders(holders_tree)
+
+    graph = OrderedDict()
+    previous = {}
+    for dev_info in ordered_devs:
+        device = dev_info['device']
+        stack = find_stack(device)
+        graph[device] = {previous[stack]} if stack in previous else set()
+        previous[stack] = device
+    return graph
+
+
 def format_holders_tree(holders_tree):
     """
     draw a nice dirgram of the holders tree
@@ -592,19 +672,21 @@ def assert_clear(base_paths):
         base_paths = [base_paths]
     base_paths = [block.sys_block_path(path, strict=False)
                   for path in base_paths]
-    for holders_tree in [gen_holders_tree(p)
-                         for p in base_paths if os.path.exists(p)]:
+    for holders_tree in gen_holders_trees(
+            [p for p in base_paths if os.path.exists(p)]):
         if any(holder_type not in valid and path not in base_paths
                for (holder_type, path) in get_holder_types(holders_tree)):
             raise OSError('Storage not clear, remaining:\n{}'
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def clear_holders(base_paths, try_preserve=False, workers=1):
     """
     Clear all storage layers depending on the devices specified in 'base_paths'
     A single device or list of devices can be specified.
     Device paths can be specified either as paths in /dev or /sys/block
+    Up to 'workers' unrelated storage stacks are shut down concurrently,
+    devices within a stack are always shut down in the planned order.
     Will throw OSError if any holders could not be shut down
     """
     # handle single path
@@ -613,34 +695,185 @@ def clear_holders(base_paths, try_preserve=False):
     LOG.info('Generating device storage trees for path(s): %s', base_paths)
 
     # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
+    holder_trees = gen_holders_trees(base_paths)
     LOG.info('Current device storage tree:\n%s',
              '\n'.join(format_holders_tree(tree) for tree in holder_trees))
     ordered_devs = plan_shutdown_holder_trees(holder_trees)
     LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
-    # run shutdown functions
-    for dev_info in ordered_devs:
+    devs_info = {dev_info['device']: dev_info for dev_info in ordered_devs}
+
+    def shutdown_device(device):
+        dev_info = devs_info[device]
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
         if not shutdown_function:
-            continue
+            return
 
         if try_preserve and shutdown_function in DATA_DESTROYING_HANDLERS:
             LOG.info('shutdown function for holder type: %s is destructive. '
                      'attempting to preserve data, so skipping' %
                      dev_info['dev_type'])
-            continue
+            return
 
         if os.path.exists(dev_info['device']):
             LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
                      dev_info['dev_type'], dev_info['device'])
             shutdown_function(dev_info['device'])
 
+    def shutdown_lock(device):
+        return SHUTDOWN_LOCK_GROUPS.get(devs_info[device]['dev_type'])
+
+    # run shutdown functions
+    util.run_dependency_graph(get_shutdown_graph(holder_trees, ordered_devs),
+                              shutdown_device, workers=workers,
+                              lock_key=shutdown_lock)
+
+
+def _read_at(fp, offset, length):
+    fp.seek(offset)
+    return fp.read(length)
+
+
+def _has_mdadm_signature(fp, size):
+    # version 1.1 and 1.2 superblocks are at 0 and 4K from the start, 1.0 is
+    # 8K to 12K from the end (4K aligned) and 0.90 is in the last 64K aligned
+    # 64K block.  0.90 superblocks are in host byte order.
+    offsets = [0, 4096]
+    if size >= 128 * 1024:
+        offsets.append((((size >> 9) - 16) & ~7) << 9)
+        offsets.append((size & ~0xffff) - 0x10000)
+    return any(_read_at(fp, offset, 4) in MDADM_MAGICS
+               for offset in offsets if offset >= 0)
+
+
+def _has_lvm_signature(fp, size):
+    # the lvm2 label may be in any of the first four sectors
+    for sector in range(4):
+        label = _read_at(fp, sector * 512, 32)
+        if label[0:8] == LVM_LABEL_ID and label[24:32] == LVM_LABEL_TYPE:
+            return True
+    return False
+
+
+def _has_bcache_signature(fp, size):
+    # the bcache superblock is at 4K, its magic follows the csum, offset and
+    # version fields
+    return _read_at(fp, 4096 + 24, 16) == BCACHE_MAGIC
+
+
+def _has_crypt_signature(fp, size):
+    return _read_at(fp, 0, 6) == LUKS_MAGIC
+
+
+def _has_zfs_signature(fp, size):
+    # zfs keeps two 256K labels at each end of the device (256K aligned),
+    # each with an array of uberblocks of at least 1K in its second half.
+    # look for an uberblock in the first and the last label
+    end = size & ~(ZFS_LABEL_SIZE - 1)
+    for label in sorted({0, end - ZFS_LABEL_SIZE}):
+        if label < 0:
+            continue
+        uberblocks = _read_at(fp, label + ZFS_LABEL_SIZE // 2,
+                              ZFS_LABEL_SIZE // 2)
+        for offset in range(0, len(uberblocks), 1024):
+            if uberblocks[offset:offset + 8] in ZFS_UBERBLOCK_MAGICS:
+                return True
+    return False
 
-def start_clear_holders_deps():
+
+def scan_storage_signatures(devices):
+    """
+    look for the on-disk metadata of the storage layers which have to be
+    started before clear_holders can see them
+
+    the devices and their partitions are read directly, a few reads each.
+    returns a set of the dev types ('raid', 'lvm', 'bcache', 'crypt') and
+    'zfs' with metadata present. raid and bcache devices may hold further
+    layers which can only be seen once they are started, so if either of
+    them is found all layers are returned. all layers are also returned if
+    a device could not be read
+    """
+    if not isinstance(devices, (list, tuple)):
+        devices = [devices]
+
+    paths = []
+    for device in devices:
+        if not os.path.exists(device):
+            continue
+        paths.append(device)
+        if block.is_block_device(device):
+            paths.extend(block.dev_path(block.path_to_kname(part))
+                         for part in block.get_sysfs_partitions(device))
+
+    found = set()
+    for path in paths:
+        try:
+            with open(path, 'rb') as fp:
+                fp.seek(0, os.SEEK_END)
+                size = fp.tell()
+                for (layer, has_signature) in SIGNATURE_CHECKS:
+                    if layer not in found and has_signature(fp, size):
+                        LOG.debug('found %s metadata on %s', layer, path)
+                        found.add(layer)
+        except (IOError, OSError) as e:
+            LOG.debug('could not scan %s for storage metadata: %s', path, e)
+            return set(layer for (layer, _) in SIGNATURE_CHECKS)
+
+    if found & {'raid', 'bcache'}:
+        return set(layer for (layer, _) in SIGNATURE_CHECKS)
+    return found
+
+
+def start_clear_holders_deps(devices=None):
     """
     prepare system for clear holders to be able to scan old devices
+
+    if 'devices' is given, only the storage layers with metadata present on
+    those devices are started
+    """
+    layers = set(layer for (layer, _) in SIGNATURE_CHECKS)
+    if devices is not None:
+        layers = scan_storage_signatures(devices)
+        LOG.info('Storage metadata found on %s: %s', devices,
+                 sorted(layers) or 'none')
+    if 'raid' in layers:
+        _start_mdadm()
+
+    mp_support = multipath.multipath_supported()
+    if mp_support:
+        LOG.debug('Detected multipath support, reload maps')
+        multipath.reload()
+        multipath.force_devmapper_symlinks()
+
+    if 'lvm' in layers:
+        # scan and activate for logical volumes
+        lvm.lvm_scan(multipath=mp_support)
+        try:
+            lvm.activate_volgroups(multipath=mp_support)
+        except util.ProcessExecutionError:
+            # partial vg may not come up due to missing members, that's OK
+            pass
+
+    if layers & {'raid', 'lvm'} or mp_support:
+        udev.udevadm_settle()
+
+    if 'bcache' in layers:
+        # the bcache module needs to be present to properly detect bcache
+        # devs on some systems (precise without hwe kernel) it may not be
+        # possible to lad the bcache module bcause it is not present in the
+        # kernel. if this happens then there is no need to halt installation,
+        # as the bcache devices will never appear and will never prevent the
+        # disk from being reformatted
+        util.load_kernel_module('bcache')
+
+    if 'zfs' in layers and not zfs.zfs_supported():
+        LOG.warning('zfs filesystem is not supported in this environment')
+
+
+def _start_mdadm():
+    """
+    assemble and start any mdadm arrays present on the system
     """
     # a mdadm scan has to be started in case there is a md device that needs to
     # be detected. if the scan fails, it is either because there are no mdadm
@@ -685,31 +918,6 @@ def start_clear_holders_deps():
         except util.ProcessExecutionError:
             LOG.debug('Non-fatal error when querying mdadm detail on %s', md)
 
-    mp_support = multipath.multipath_supported()
-    if mp_support:
-        LOG.debug('Detected multipath support, reload maps')
-        multipath.reload()
-        multipath.force_devmapper_symlinks()
-
-    # scan and activate for logical volumes
-    lvm.lvm_scan(multipath=mp_support)
-    try:
-        lvm.activate_volgroups(multipath=mp_support)
-    except util.ProcessExecutionError:
-        # partial vg may not come up due to missing members, that's OK
-        pass
-    udev.udevadm_settle()
-
-    # the bcache module needs to be present to properly detect bcache devs
-    # on some systems (precise without hwe kernel) it may not be possible to
-    # lad the bcache module bcause it is not present in the kernel. if this
-    # happens then there is no need to halt installation, as the bcache devices
-    # will never appear and will never prevent the disk from being reformatted
-    util.load_kernel_module('bcache')
-
-    if not zfs.zfs_supported():
-        LOG.warning('zfs filesystem is not supported in this environment')
-
 
 # anything that is not identified can assumed to be a 'disk' or similar
 DEFAULT_DEV_TYPE = 'disk'
@@ -718,5 +926,26 @@ DATA_DESTROYING_HANDLERS = [wipe_superblock]
 # types of devices that could be encountered by clear holders and functions to
 # identify them and shut them down
 DEV_TYPES = _define_handlers_registry()
+# on-disk signatures of the storage layers started by start_clear_holders_deps
+MDADM_MAGICS = (b'\xfc\x4e\x2b\xa9', b'\xa9\x2b\x4e\xfc')
+LVM_LABEL_ID = b'LABELONE'
+LVM_LABEL_TYPE = b'LVM2 001'
+BCACHE_MAGIC = (b'\xc6\x85\x73\xf6\x4e\x1a\x45\xca'
+                b'\x82\x65\xf5\x7f\x48\xba\x6d\x81')
+LUKS_MAGIC = b'LUKS\xba\xbe'
+ZFS_LABEL_SIZE = 256 * 1024
+ZFS_UBERBLOCK_MAGICS = (b'\x0c\xb1\xba\x00\x00\x00\x00\x00',
+                        b'\x00\x00\x00\x00\x00\xba\xb1\x0c')
+SIGNATURE_CHECKS = (
+    ('raid', _has_mdadm_signature),
+    ('lvm', _has_lvm_signature),
+    ('bcache', _has_bcache_signature),
+    ('crypt', _has_crypt_signature),
+    ('zfs', _has_zfs_signature),
+)
+# device types whose shutdown functions change state shared between stacks
+# (lvm removes volume groups and rescans every device), devices of a type in
+# the same group are never shut down concurrently
+SHUTDOWN_LOCK_GROUPS = {'lvm': 'lvm'}
 
 # vi: ts=4 expandtab syntax=python
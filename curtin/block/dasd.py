@@ -3,6 +3,7 @@
 import glob
 import os
 import re
+import subprocess
 import tempfile
 from curtin import util
 from curtin.log import LOG, logged_time
@@ -210,6 +211,53 @@ def _dasd_format(dasdview_output):
         return mapping.get(diskfmt.lower())
 
 
+DASDFMT_PROGRESS = re.compile(
+    r"^\s*cyl\s+(?P<cylinder>\d+)\s+of\s+(?P<cylinders>\d+)\s*"
+    r"\|\s*(?P<percent>\d+)%")
+
+
+def parse_dasdfmt_progress(line):
+    """ Parse a line of 'dasdfmt --percentage' output.
+
+    % dasdfmt -y -P --blocksize=4096 --mode=full /dev/dasdc
+    cyl       1 of   10017 |  0%
+    cyl     100 of   10017 |  1%
+
+    :returns: tuple of integers (cylinder, cylinders, percent), or None if
+        line does not report progress.
+    """
+    match = DASDFMT_PROGRESS.match(line)
+    if match is None:
+        return None
+    return (int(match.group('cylinder')), int(match.group('cylinders')),
+            int(match.group('percent')))
+
+
+def _dasdfmt_with_progress(cmd, progress):
+    """ Run dasdfmt cmd, calling progress for each progress line it prints.
+
+    :returns: string: output of cmd which did not report progress.
+    :raises: ProcessExecutionError if cmd exits non-zero.
+    """
+    output = []
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace')
+        parsed = parse_dasdfmt_progress(line)
+        if parsed:
+            progress(*parsed)
+        else:
+            output.append(line)
+    proc.stdout.close()
+    exit_code = proc.wait()
+    out = ''.join(output)
+    if exit_code != 0:
+        raise util.ProcessExecutionError(stdout=out, stderr='',
+                                         exit_code=exit_code, cmd=cmd)
+    return out
+
+
 def _valid_device_id(device_id):
     """ validate device_id string.
 
@@ -336,31 +384,47 @@ class DasdDevice(CcwDevice):
         :param volser: expected label, if None, label is ignored.
         :returns: boolean, True if formatting is needed, else False.
         """
+        return self.format_mode(blksize, layout, volser) is not None
+
+    def format_mode(self, blksize, layout, volser):
+        """ Determine the dasdfmt mode needed to match the required parameters.
+
+        A quick format rewrites the label and the first tracks only, it is
+        enough when only the disk layout or the label (VOLSER) differ.  An
+        unformatted device or a different block size needs every track
+        formatted.
+
+        :param blksize: expected blocksize of the device.
+        :param layout: expected disk layout.
+        :param volser: expected label, if None, label is ignored.
+        :returns: string: 'full' or 'quick', None if no formatting is needed.
+        """
         LOG.debug('Checking if dasd %s needs formatting', self.device_id)
         if self.is_not_formatted():
             LOG.debug('dasd %s is not formatted', self.device_id)
-            return True
+            return 'full'
 
         if int(blksize) != int(self.blocksize()):
             LOG.debug('dasd %s block size (%s) does not match (%s)',
                       self.device_id, self.blocksize(), blksize)
-            return True
+            return 'full'
 
         if layout != self.disk_layout():
             LOG.debug('dasd %s disk layout (%s) does not match %s',
                       self.device_id, self.disk_layout(), layout)
-            return True
+            return 'quick'
 
         if volser and volser != self.label():
             LOG.debug('dasd %s volser (%s) does not match %s',
                       self.device_id, self.label(), volser)
-            return True
+            return 'quick'
 
-        return False
+        return None
 
     @logged_time("DASD.FORMAT")
     def format(self, blksize=4096, layout='cdl', force=False, set_label=None,
-               keep_label=False, no_label=False, mode='quick'):
+               keep_label=False, no_label=False, mode='quick',
+               progress=None):
         """ Format DasdDevice with supplied parameters.
 
         :param blksize: integer value to configure disk block size in bytes.
@@ -383,6 +447,8 @@ class DasdDevice(CcwDevice):
             'full'   (Format the full disk),
             'quick'  (Format the first two tracks, default),
             'expand' (Format unformatted tracks at device end).
+        :param progress: callable invoked with the integers (cylinder,
+            cylinders, percent) as dasdfmt reports its progress.
         :param strict: boolean which enforces that dasd device exists before
             issuing format command, defaults to True.
 
@@ -435,11 +501,16 @@ class DasdDevice(CcwDevice):
             opts += ['--no_label']
         if force:
             opts += ['--force']
+        if progress:
+            opts += ['--percentage']
 
         cmd = ['dasdfmt'] + opts + [self.devname]
         LOG.debug('Formatting %s with %s', self.devname, cmd)
         try:
-            out, _err = util.subp(cmd, capture=True)
+            if progress:
+                _dasdfmt_with_progress(cmd, progress)
+            else:
+                out, _err = util.subp(cmd, capture=True)
         except util.ProcessExecutionError as e:
             LOG.error("Formatting failed: %s", e)
             raise
@@ -5,6 +5,7 @@
 # the 'iscsiadm' command in a subprocess.  The remaining functions handle
 # manipulation of the iscsiadm output.
 
+from collections import OrderedDict
 import os
 import re
 import shutil
@@ -16,6 +17,8 @@ from curtin.block import (get_device_slave_knames,
 from curtin.log import LOG
 
 _ISCSI_DISKS = {}
+# default number of iSCSI targets logged in to concurrently
+ISCSI_CONNECT_WORKERS = 8
 RFC4173_AUTH_REGEX = re.compile(r'''^
     (?P<user>[^:]*?):(?P<password>[^:]*?)
         (?::(?P<initiatoruser>[^:]*?):(?P<initiatorpassword>[^:]*?))?
@@ -225,6 +228,75 @@ def ensure_disk_connected(rfc4173, write_config=True):
     return iscsi_disk
 
 
+def connect_disks(rfc4173s, write_config=True,
+                  workers=ISCSI_CONNECT_WORKERS):
+    """Connect all iSCSI disks of rfc4173s at once.
+
+    The disks are grouped by portal and discovery runs once per portal.
+    Every target not in an active session is logged in to, with up to
+    workers logins in flight at a time, and then the device links of all
+    disks are waited for together.  Connected disks are remembered so that
+    ensure_disk_connected() returns them without connecting again.
+
+    :returns: list of the IscsiDisk objects, in the order of rfc4173s.
+    :raises: ProcessExecutionError if discovery or a login fails.
+    """
+    disks = OrderedDict()
+    for rfc4173 in rfc4173s:
+        if rfc4173 not in disks:
+            disks[rfc4173] = _ISCSI_DISKS.get(rfc4173) or IscsiDisk(rfc4173)
+    pending = [disk for (rfc4173, disk) in disks.items()
+               if rfc4173 not in _ISCSI_DISKS]
+    if not pending:
+        return list(disks.values())
+
+    sessions = iscsiadm_sessions()
+    # disks sharing a target need one login, and every target one
+    # discovery of its portal
+    targets = OrderedDict()
+    for disk in pending:
+        targets.setdefault((disk.target, disk.portal), disk)
+    logins = OrderedDict((key, disk) for (key, disk) in targets.items()
+                         if disk.target not in sessions)
+    portals = OrderedDict((disk.portal, []) for disk in logins.values())
+    LOG.debug('Connecting %d iSCSI disk(s): %d login(s) to %d portal(s)',
+              len(pending), len(logins), len(portals))
+
+    def connect_target(key):
+        disk = targets[key]
+        if key in logins:
+            iscsiadm_authenticate(disk.target, disk.portal, disk.user,
+                                  disk.password, disk.iuser, disk.ipassword)
+            iscsiadm_login(disk.target, disk.portal)
+        # always set automatic mode
+        iscsiadm_set_automatic(disk.target, disk.portal)
+
+    try:
+        util.run_dependency_graph(portals, iscsiadm_discovery,
+                                  workers=min(workers, len(portals)))
+        util.run_dependency_graph(
+            OrderedDict((key, []) for key in targets), connect_target,
+            workers=min(workers, len(targets)))
+    except util.ProcessExecutionError:
+        LOG.error('Unable to connect to iSCSI disks (%s)',
+                  ', '.join(str(disk) for disk in pending))
+        raise
+
+    if logins:
+        udev.udevadm_settle()
+    for disk in pending:
+        udev.udevadm_settle(exists=disk.devdisk_path)
+        if not os.path.exists(disk.devdisk_path):
+            LOG.warn('Unable to find iSCSI disk for target (%s) by path (%s)',
+                     disk.target, disk.devdisk_path)
+        if write_config:
+            save_iscsi_config(disk)
+    for (rfc4173, disk) in disks.items():
+        _ISCSI_DISKS.setdefault(rfc4173, disk)
+
+    return list(disks.values())
+
+
 def connected_disks():
     global _ISCSI_DISKS
     return _ISCSI_DISKS
@@ -7,24 +7,104 @@ This module provides some helper functions for manipulating lvm devices
 from curtin import distro
 from curtin import util
 from curtin.log import LOG
+import json
 import os
+import threading
 
 # separator to use for lvm/dm tools
 _SEP = '='
 
+# fields of each report section that LvmState records; a fullreport groups
+# sections by volume group, so every row also carries its vg_name.
+_REPORT_FIELDS = {
+    'pv': ['pv_name', 'vg_name', 'pv_size'],
+    'vg': ['vg_name', 'vg_size', 'vg_free'],
+    'lv': ['lv_name', 'vg_name', 'lv_size', 'lv_path'],
+}
 
-def _filter_lvm_info(lvtool, match_field, query_field, match_key, args=None):
+# map the lvm display/report tools onto the report section they show
+_TOOL_SECTIONS = {
+    'pvdisplay': 'pv', 'pvs': 'pv',
+    'vgdisplay': 'vg', 'vgs': 'vg',
+    'lvdisplay': 'lv', 'lvs': 'lv',
+}
+
+
+class LvmState(object):
     """
-    filter output of pv/vg/lvdisplay tools
+    Snapshot of lvm physical volumes, volume groups and logical volumes.
+
+    The snapshot is read with a single 'lvm fullreport' the first time it
+    is queried and is kept until invalidate() is called, which must happen
+    after any command which changes lvm metadata (lvcreate, vgcreate,
+    lvremove, ...) or rescans devices.
     """
-    if args is None:
-        args = []
-    (out, _) = util.subp([lvtool, '-C', '--separator', _SEP, '--noheadings',
-                          '-o', ','.join([match_field, query_field])] + args,
-                         capture=True)
-    return [qf for (mf, qf) in
-            [line.strip().split(_SEP) for line in out.strip().splitlines()]
-            if mf == match_key]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._report = None
+
+    def invalidate(self):
+        with self._lock:
+            self._report = None
+
+    def report(self):
+        """Return a dict mapping 'pv', 'vg' and 'lv' to lists of rows."""
+        with self._lock:
+            if self._report is None:
+                self._report = self._load()
+            return self._report
+
+    def rows(self, section):
+        return self.report()[section]
+
+    def _load(self):
+        try:
+            return self._load_fullreport()
+        except util.ProcessExecutionError as e:
+            # 'lvm fullreport' and json output need lvm2 >= 2.02.158
+            LOG.debug('lvm fullreport failed, using pvs/vgs/lvs: %s', e)
+            return self._load_reports()
+
+    def _load_fullreport(self):
+        cmd = ['lvm', 'fullreport', '--reportformat', 'json', '--units', 'B']
+        for section in ('pv', 'vg', 'lv'):
+            cmd.extend(['--configreport', section, '-o',
+                        ','.join(_REPORT_FIELDS[section])])
+        (out, _) = util.subp(cmd, capture=True)
+        report = dict((section, []) for section in _REPORT_FIELDS)
+        for group in json.loads(out).get('report', []):
+            for section in _REPORT_FIELDS:
+                report[section].extend(group.get(section, []))
+        return report
+
+    def _load_reports(self):
+        report = {}
+        for section, fields in _REPORT_FIELDS.items():
+            (out, _) = util.subp(
+                [section + 's', '--noheadings', '--separator', _SEP,
+                 '--units', 'B', '-o', ','.join(fields)], capture=True)
+            report[section] = [
+                dict(zip(fields, line.strip().split(_SEP)))
+                for line in out.strip().splitlines() if line.strip()]
+        return report
+
+
+LVM_STATE = LvmState()
+
+
+def invalidate():
+    """Discard the lvm state snapshot after lvm metadata has changed."""
+    LVM_STATE.invalidate()
+
+
+def _filter_lvm_info(lvtool, match_field, query_field, match_key):
+    """
+    filter pv/vg/lv information as shown by the lvm tool lvtool
+    """
+    section = _TOOL_SECTIONS[lvtool]
+    return [row[query_field] for row in LVM_STATE.rows(section)
+            if row.get(match_field) == match_key]
 
 
 def get_pvols_in_volgroup(vg_name):
@@ -43,10 +123,38 @@ def get_lvols_in_volgroup(vg_name):
 
 def get_lv_size_bytes(lv_name):
     """ get the size in bytes of a logical volume specified by lv_name."""
-    result = _filter_lvm_info('lvdisplay', 'lv_name', 'lv_size', lv_name,
-                              args=['--units=B'])
+    result = _filter_lvm_info('lvdisplay', 'lv_name', 'lv_size', lv_name)
     if result:
-        return util.human2bytes(result[0])
+        return util.human2bytes(str(result[0]))
+
+
+def lvm_shell(commands):
+    """
+    Run lvm commands (lists of arguments, each starting with the lvm tool
+    name) through a single 'lvm' shell process.
+
+    Each tool run on its own scans and locks every device before doing
+    any work; one shell session pays that startup cost once.  The shell
+    carries on past failed commands and does not report their status, so
+    callers must check the resulting lvm state and rerun whatever is
+    missing to get a proper error.  A failure of the shell itself is
+    logged as a warning and left to that check as well.
+    """
+    lines = []
+    for cmd in commands:
+        if any(not arg or arg.split() != [arg] for arg in cmd):
+            raise ValueError('lvm shell arguments must not be empty or '
+                             'contain whitespace: %s' % cmd)
+        lines.append(' '.join(cmd))
+    LOG.debug('running %d commands in one lvm shell', len(lines))
+    try:
+        (out, err) = util.subp(['lvm'], data='\n'.join(lines) + '\n',
+                               capture=True)
+        LOG.debug('lvm shell output:\n%s\n%s', out, err)
+    except util.ProcessExecutionError as e:
+        LOG.warning('lvm shell failed, rerunning missing commands: %s', e)
+    finally:
+        invalidate()
 
 
 def split_lvm_name(full):
@@ -88,6 +196,7 @@ def activate_volgroups(multipath=False):
     # vgchange handles syncing with udev by default
     # see man 8 vgchange and flag --noudevsync
     out, _ = util.subp(cmd, capture=True)
+    invalidate()
     if out:
         LOG.info(out)
 
@@ -138,5 +247,6 @@ def lvm_scan(activate=True, multipath=False):
         if multipath:
             cmd.extend(['--config', mponly])
         util.subp(cmd, capture=True)
+    invalidate()
 
 # vi: ts=4 expandtab syntax=python
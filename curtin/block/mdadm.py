@@ -5,8 +5,10 @@
 # the 'mdadm' command in a subprocess.  The remaining functions handle
 # manipulation of the mdadm output.
 
+import json
 import os
 import re
+import select
 import shlex
 import time
 
@@ -106,6 +108,22 @@ VALID_RAID_ARRAY_STATES = (
 '''
 MDADM_USE_EXPORT = lsb_release()['codename'] not in ['precise', 'trusty']
 
+# How the initial resync of a newly created array is handled during install.
+#   resync: the kernel resyncs the array in the background at full speed
+#   assume-clean: skip the resync where that is safe (see
+#                 md_assume_clean_safe), throttle it otherwise
+#   throttle: cap sync_speed_max until the install finishes
+#   wait: block until the resync completes, reporting progress
+RESYNC_POLICIES = ['resync', 'assume-clean', 'throttle', 'wait']
+
+# sync_speed_max (KiB/s) used to throttle resync during install; this is the
+# kernel default of sync_speed_min, below which md never throttles resync.
+DEFAULT_SYNC_SPEED_MAX = 1000
+
+# Arrays throttled during install record their previous sync_speed_max in
+# this file in the install state directory, see md_restore_sync_speed.
+SYNC_SPEED_STATE_FILE = 'md_sync_speed.json'
+
 #
 # mdadm executors
 #
@@ -147,10 +165,11 @@ def mdadm_assemble(md_devname=None, devices=[], spares=[], scan=False,
 
 
 def mdadm_create(md_devname, raidlevel, devices, spares=None, container=None,
-                 md_name="", metadata=None):
+                 md_name="", metadata=None, assume_clean=False):
     LOG.debug('mdadm_create: ' +
               'md_name=%s raidlevel=%s ' % (md_devname, raidlevel) +
-              ' devices=%s spares=%s name=%s' % (devices, spares, md_name))
+              ' devices=%s spares=%s name=%s' % (devices, spares, md_name) +
+              ' assume_clean=%s' % assume_clean)
 
     assert_valid_devpath(md_devname)
     if not metadata:
@@ -186,6 +205,9 @@ def mdadm_create(md_devname, raidlevel, devices, spares=None, container=None,
     if md_name:
         cmd.append("--name=%s" % md_name)
 
+    if assume_clean:
+        cmd.append("--assume-clean")
+
     if container:
         cmd.append(container)
 
@@ -720,7 +742,33 @@ def md_check_raidlevel(md_devname, detail, raidlevel):
                 md_devname, raidlevel, actual_level))
 
 
-def md_block_until_in_sync(md_devname):
+def md_sync_completed(md_devname):
+    """Return (completed, total) sectors of the array's current sync action.
+
+    Returns None when no sync action is running (or the array has no
+    redundancy to sync).  A sync which is queued behind another array
+    sharing the same disks reports as (0, 0).
+    """
+    value = md_sysfs_attr(md_devname, 'sync_completed', None)
+    return _parse_sync_completed(value)
+
+
+def _parse_sync_completed(value):
+    if value is None:
+        return None
+    value = value.strip()
+    if value in ('', 'none'):
+        return None
+    try:
+        completed, total = [int(v) for v in value.split('/')]
+    except ValueError:
+        # 'delayed' or a format we don't know, but some action is pending
+        return (0, 0)
+    return (completed, total)
+
+
+def md_block_until_in_sync(md_devname, timeout=None, progress=None,
+                           interval=5):
     '''
     sync_completed
     This shows the number of sectors that have been completed of
@@ -731,9 +779,120 @@ def md_block_until_in_sync(md_devname):
     A 'select' on this attribute will return when resync completes,
     when it reaches the current sync_max (below) and possibly at
     other times.
+
+    Block until the current sync action of md_devname completes, waking
+    on sysfs notifications of sync_completed and at least every
+    `interval` seconds.  `progress`, if given, is called with
+    (completed, total) sectors each time the array is checked.  Raises
+    RuntimeError if `timeout` seconds pass before the sync completes.
     '''
-    # FIXME: use selectors to block on: /sys/class/block/mdX/md/sync_completed
-    pass
+    assert_valid_devpath(md_devname)
+    attr_path = md_sysfs_attr_path(md_devname, 'sync_completed')
+    if not os.path.exists(attr_path):
+        LOG.debug('%s has no sync_completed attribute, nothing to wait for',
+                  md_devname)
+        return
+
+    deadline = None if timeout is None else time.time() + timeout
+    poller = select.poll()
+    with open(attr_path, 'r') as fp:
+        poller.register(fp.fileno(), select.POLLPRI | select.POLLERR)
+        while True:
+            # sysfs notifications are only delivered after a read from
+            # the start of the attribute.
+            fp.seek(0)
+            state = _parse_sync_completed(fp.read())
+            if state is None:
+                # a newly created array reports no progress until its
+                # sync thread starts, but sync_action shows it is due.
+                action = md_sysfs_attr(md_devname, 'sync_action', None)
+                if action in (None, 'idle', 'frozen'):
+                    LOG.debug('%s is in sync', md_devname)
+                    return
+                state = (0, 0)
+            if progress:
+                progress(*state)
+            wait = interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise RuntimeError(
+                        'Timed out after %ss waiting for %s to sync' %
+                        (timeout, md_devname))
+            poller.poll(wait * 1000)
+
+
+def md_set_sync_speed_max(md_devname, speed):
+    """Set the maximum resync speed (KiB/s) of md_devname.
+
+    speed may be 'system' to return to the system wide default
+    (/proc/sys/dev/raid/speed_limit_max).  Returns the previous setting in
+    a form that can be passed back to restore it, or None if the array
+    has no sync_speed_max attribute.
+    """
+    attr_path = md_sysfs_attr_path(md_devname, 'sync_speed_max')
+    if not os.path.exists(attr_path):
+        return None
+    # reads as '<speed> (system)' or '<speed> (local)'
+    current = md_sysfs_attr(md_devname, 'sync_speed_max')
+    previous = 'system'
+    if current.endswith('(local)'):
+        previous = current.split()[0]
+    LOG.debug('mdadm: setting %s sync_speed_max=%s (was %s)',
+              md_devname, speed, current)
+    util.write_file(attr_path, content=str(speed))
+    return previous
+
+
+def md_record_sync_speed(state_file, md_devname, previous):
+    """Record the sync_speed_max of md_devname to restore after install."""
+    saved = {}
+    if os.path.exists(state_file):
+        saved = json.loads(util.load_file(state_file))
+    # keep the oldest value if an array is throttled more than once
+    saved.setdefault(md_devname, previous)
+    util.write_file(state_file, json.dumps(saved))
+
+
+def md_restore_sync_speed(state_file):
+    """Restore sync_speed_max of each array recorded in state_file.
+
+    Arrays which no longer exist are skipped; the state file is removed.
+    """
+    if not os.path.exists(state_file):
+        return
+    saved = json.loads(util.load_file(state_file))
+    for md_devname, previous in sorted(saved.items()):
+        if not os.path.exists(md_sysfs_attr_path(md_devname,
+                                                 'sync_speed_max')):
+            LOG.debug('mdadm: %s is gone, not restoring sync_speed_max',
+                      md_devname)
+            continue
+        LOG.info('mdadm: restoring %s sync_speed_max=%s', md_devname,
+                 previous)
+        try:
+            md_set_sync_speed_max(md_devname, previous)
+        except (IOError, OSError) as e:
+            LOG.warning('mdadm: failed to restore sync_speed_max of %s: %s',
+                        md_devname, e)
+    util.del_file(state_file)
+
+
+def md_assume_clean_safe(raidlevel, zeroed=False):
+    """Return True if a new array may be created without initial resync.
+
+    The members of a mirror may differ only in blocks which were never
+    written, every block written through the array is written to all of
+    them.  Parity is only consistent without a resync if all members are
+    known to be zeroed (the parity of zeros is zero).  Arrays without
+    redundancy never resync, so there is nothing to skip.
+    """
+    level = str(raidlevel).replace('raid', '')
+    if level in ('1', 'mirror', '10'):
+        return True
+    if level in ('4', '5', '6'):
+        return zeroed
+    return False
 
 
 def md_check_array_state(md_devname):
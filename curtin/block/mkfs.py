@@ -6,6 +6,7 @@
 from curtin import block
 from curtin import distro
 from curtin import util
+from curtin.log import LOG
 
 import string
 import os
@@ -97,6 +98,21 @@ release_flag_mapping_overrides = {
 }
 
 
+# mke2fs uses 4KiB blocks for filesystems of 512MiB and more ("small" and
+# "floppy" types in mke2fs.conf use 1KiB blocks); stride is in blocks so only
+# tune filesystems which get 4KiB blocks.
+EXT_TUNE_BLOCK_SIZE = 4096
+EXT_TUNE_MIN_SIZE = 512 * 1024 * 1024
+
+# extended options mke2fs -E takes which belong together, an explicit value
+# for any of them in extra_options replaces all tuned values of the group.
+EXT_TUNE_OPTION_GROUPS = [
+    ('stride', 'stripe_width', 'stripe-width'),
+    ('discard', 'nodiscard'),
+]
+XFS_TUNE_DATA_OPTIONS = ('su', 'sw', 'sunit', 'swidth')
+
+
 def valid_fstypes():
     return list(mkfs_commands.keys())
 
@@ -223,15 +239,173 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
     return uuid
 
 
-def mkfs_from_config(path, info, strict=False):
+def _read_sysfs_int(path, default=0):
+    try:
+        return int(util.load_file(path).strip())
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def _md_data_disks(md_sysfs):
+    """Return the number of data disks a stripe of an md array spans."""
+    level = util.load_file(os.path.join(md_sysfs, 'level')).strip()
+    disks = _read_sysfs_int(os.path.join(md_sysfs, 'raid_disks'))
+    if level == 'raid0':
+        return disks
+    if level in ('raid4', 'raid5'):
+        return disks - 1
+    if level == 'raid6':
+        return disks - 2
+    if level == 'raid10':
+        # near and far copies are encoded in the low two bytes of layout
+        layout = _read_sysfs_int(os.path.join(md_sysfs, 'layout'))
+        copies = (layout & 0xff) * ((layout >> 8) & 0xff)
+        if copies and disks % copies == 0:
+            return disks // copies
+    return 0
+
+
+def _device_stripe(devpath):
+    """Return (stripe unit bytes, data disks) of devpath or (0, 0)."""
+    sysfs = block.sys_block_path(devpath)
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        # partitions share the queue (and md directory) of their disk
+        sysfs = os.path.dirname(os.path.realpath(sysfs))
+    md_sysfs = os.path.join(sysfs, 'md')
+    if os.path.exists(os.path.join(md_sysfs, 'chunk_size')):
+        chunk = _read_sysfs_int(os.path.join(md_sysfs, 'chunk_size'))
+        data_disks = _md_data_disks(md_sysfs)
+        if chunk and data_disks > 1:
+            return (chunk, data_disks)
+        return (0, 0)
+    io_min = _read_sysfs_int(os.path.join(sysfs, 'queue/minimum_io_size'))
+    io_opt = _read_sysfs_int(os.path.join(sysfs, 'queue/optimal_io_size'))
+    if (io_min >= EXT_TUNE_BLOCK_SIZE and io_opt > io_min and
+            io_opt % io_min == 0):
+        return (io_min, io_opt // io_min)
+    return (0, 0)
+
+
+def get_topology(path, stack=None):
+    """Return the io topology of the device at path to tune mkfs for.
+
+    stack is an optional list of the devices path is built on, top down.
+    The first of path and stack with a striped layout (md chunk size and
+    data disks, or minimum/optimal io size) provides the stripe, as some
+    stacked devices (bcache) do not pass the io hints of their backing
+    device on.  Returns a dict with keys stripe_unit (bytes, 0 if not
+    striped), stripe_width (data disks), rotational, discard and size.
+    """
+    sysfs = block.sys_block_path(path)
+    queue = os.path.join(sysfs, 'queue')
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        queue = os.path.join(os.path.dirname(os.path.realpath(sysfs)),
+                             'queue')
+    topology = {
+        'stripe_unit': 0,
+        'stripe_width': 0,
+        'rotational': bool(_read_sysfs_int(os.path.join(queue,
+                                                        'rotational'))),
+        'discard': _read_sysfs_int(os.path.join(queue,
+                                                'discard_max_bytes')) > 0,
+        'size': _read_sysfs_int(os.path.join(sysfs, 'size')) * 512,
+    }
+    for devpath in [path] + list(stack or []):
+        (unit, width) = _device_stripe(devpath)
+        if unit:
+            topology.update({'stripe_unit': unit, 'stripe_width': width})
+            break
+    LOG.debug('mkfs topology of %s: %s', path, topology)
+    return topology
+
+
+def _split_ext_extended_options(extra_options):
+    """Split extra_options into (other options, mke2fs -E option list)."""
+    others = []
+    extended = []
+    options = iter(extra_options)
+    for option in options:
+        if option == '-E':
+            extended.extend(next(options, '').split(','))
+        elif option.startswith('-E'):
+            extended.extend(option[2:].split(','))
+        else:
+            others.append(option)
+    return others, [opt for opt in extended if opt]
+
+
+def tune_extra_options(fstype, topology, extra_options=None):
+    """Return extra_options with mkfs options tuned to topology added.
+
+    ext filesystems get stride and stripe_width for striped devices and
+    nodiscard on rotational devices which advertise discard (thin
+    provisioned LUNs, where discarding the whole device is slow); xfs gets
+    su/sw and -K likewise.
+    Options given in extra_options always win over tuned ones.
+    """
+    extra_options = list(extra_options or [])
+    fs_family = specific_to_family.get(fstype, fstype)
+    slow_discard = topology['rotational'] and topology['discard']
+    unit = topology['stripe_unit']
+    width = topology['stripe_width']
+
+    if fs_family == 'ext':
+        tuned = []
+        if unit and topology['size'] >= EXT_TUNE_MIN_SIZE:
+            stride = unit // EXT_TUNE_BLOCK_SIZE
+            if stride:
+                tuned.extend(['stride=%d' % stride,
+                              'stripe_width=%d' % (stride * width)])
+        if slow_discard:
+            tuned.append('nodiscard')
+        others, explicit = _split_ext_extended_options(extra_options)
+        explicit_keys = set(opt.split('=')[0] for opt in explicit)
+        for group in EXT_TUNE_OPTION_GROUPS:
+            if explicit_keys.intersection(group):
+                tuned = [opt for opt in tuned
+                         if opt.split('=')[0] not in group]
+        # mke2fs only honours the last -E, so merge into a single one
+        if tuned or explicit:
+            return others + ['-E', ','.join(tuned + explicit)]
+        return others
+
+    if fs_family == 'xfs':
+        tuned = []
+        data_options = []
+        for (idx, option) in enumerate(extra_options[:-1]):
+            if option == '-d':
+                data_options.extend(extra_options[idx + 1].split(','))
+        data_keys = set(opt.split('=')[0] for opt in data_options)
+        if unit and not data_keys.intersection(XFS_TUNE_DATA_OPTIONS):
+            tuned.extend(['-d', 'su=%d,sw=%d' % (unit, width)])
+        if slow_discard and '-K' not in extra_options:
+            tuned.append('-K')
+        return tuned + extra_options
+
+    return extra_options
+
+
+def mkfs_from_config(path, info, strict=False, stack=None, tune=False):
     """Make filesystem on block device with given path according to storage
-       config given"""
+       config given.
+
+       If tune is True mkfs options are tuned to the io topology of path
+       (and the devices in stack it is built on), see tune_extra_options."""
     fstype = info.get('fstype')
     if fstype is None:
         raise ValueError("fstype must be specified")
+    extra_options = info.get('extra_options')
+    if tune:
+        try:
+            topology = get_topology(path, stack=stack)
+        except (IOError, OSError) as e:
+            LOG.debug('not tuning mkfs of %s, no topology: %s', path, e)
+        else:
+            extra_options = tune_extra_options(fstype, topology,
+                                               extra_options)
     # NOTE: Since old metadata on partitions that have not been wiped can cause
     #       some mkfs commands to refuse to work, it's best to use force=True
     mkfs(path, fstype, strict=strict, force=True, uuid=info.get('uuid'),
-         label=info.get('label'), extra_options=info.get('extra_options'))
+         label=info.get('label'), extra_options=extra_options)
 
 # vi: ts=4 expandtab syntax=python
@@ -1,4 +1,5 @@
 import os
+import threading
 
 from curtin.log import LOG
 from curtin import util
@@ -35,6 +36,105 @@ def show_maps():
     return _extract_mpath_data(cmd, 'maps')
 
 
+class MultipathTopology(object):
+    """
+    Snapshot of multipath paths and device mapper names.
+
+    Each kind of data is read with a single query ('multipathd show paths'
+    and 'dmsetup ls') the first time it is needed
+    and is indexed for constant time member to map, map to members and map
+    to partitions lookups.  The snapshot is kept until invalidate() is
+    called, which reload(), remove_map() and remove_partition() do and
+    which must happen after partitions of a multipath map are changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = None
+        self._dm_names = None
+
+    def invalidate(self):
+        with self._lock:
+            self._paths = None
+            self._dm_names = None
+
+    def _load_paths(self):
+        with self._lock:
+            if self._paths is None:
+                rows = show_paths()
+                member_map = {}
+                map_members = {}
+                for row in rows:
+                    mp_id = row.get('multipath')
+                    if not row.get('device') or not mp_id or 'orphan' in mp_id:
+                        continue
+                    member = '/dev/' + row['device']
+                    member_map[member] = mp_id
+                    map_members.setdefault(mp_id, []).append(member)
+                self._paths = {'rows': rows, 'member_map': member_map,
+                               'map_members': map_members, 'settled': False}
+            return self._paths
+
+    def _load_dm_names(self):
+        with self._lock:
+            if self._dm_names is None:
+                mapping = dmname_to_blkdev_mapping()
+                partitions = {}
+                for dm_name in mapping:
+                    # partition maps are named <map>-part<N> (or <map>-<N>
+                    # with some kpartx delimiters), index them under every
+                    # prefix ending before a '-'
+                    parts = dm_name.split('-')
+                    for i in range(1, len(parts)):
+                        partitions.setdefault(
+                            '-'.join(parts[:i]), []).append(dm_name)
+                self._dm_names = {'blkdev': mapping,
+                                  'partitions': partitions}
+            return self._dm_names
+
+    def paths(self):
+        """Return the rows of multipathd show paths."""
+        return self._load_paths()['rows']
+
+    def has_orphans(self):
+        return any('orphan' in row.get('multipath', '')
+                   for row in self.paths())
+
+    def settled(self):
+        """Return True once orphan paths of this snapshot were waited for."""
+        return self._load_paths()['settled']
+
+    def mark_settled(self):
+        self._load_paths()['settled'] = True
+
+    def member_map(self, devpath):
+        """Return the map holding path devpath (/dev/sdX), or None."""
+        return self._load_paths()['member_map'].get(devpath)
+
+    def map_members(self, mpath_id):
+        """Return the paths (/dev/sdX) of map mpath_id."""
+        return list(self._load_paths()['map_members'].get(mpath_id, []))
+
+    def dm_blkdevs(self):
+        """Return a dict mapping device mapper names to /dev/dm-X."""
+        return dict(self._load_dm_names()['blkdev'])
+
+    def dm_blkdev(self, dm_name):
+        return self._load_dm_names()['blkdev'].get(dm_name)
+
+    def map_partitions(self, mpath_id):
+        """Return the device mapper names of the partitions of mpath_id."""
+        return list(self._load_dm_names()['partitions'].get(mpath_id, []))
+
+
+MULTIPATH_TOPOLOGY = MultipathTopology()
+
+
+def invalidate():
+    """Discard the multipath topology after maps or partitions changed."""
+    MULTIPATH_TOPOLOGY.invalidate()
+
+
 def dmname_to_blkdev_mapping():
     """ Use dmsetup ls output to build a dict of DM_NAME, /dev/dm-x values."""
     data, _err = util.subp(['dmsetup', 'ls', '-o', 'blkdevname'], capture=True)
@@ -99,43 +199,50 @@ def mpath_partition_to_mpath_id_and_partnumber(devpath):
 def remove_partition(devpath, retries=10):
     """ Remove a multipath partition mapping. """
     LOG.debug('multipath: removing multipath partition: %s', devpath)
-    for _ in range(0, retries):
-        util.subp(['dmsetup', 'remove', '--force', '--retry', devpath])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
-            return
+    try:
+        for _ in range(0, retries):
+            util.subp(['dmsetup', 'remove', '--force', '--retry', devpath])
+            udev.udevadm_settle()
+            if not os.path.exists(devpath):
+                return
 
-    util.wait_for_removal(devpath)
+        util.wait_for_removal(devpath)
+    finally:
+        invalidate()
 
 
 def remove_map(map_id, retries=10):
     """ Remove a multipath device mapping. """
     LOG.debug('multipath: removing multipath map: %s', map_id)
     devpath = '/dev/mapper/%s' % map_id
-    for _ in range(0, retries):
-        util.subp(['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
-            return
+    try:
+        for _ in range(0, retries):
+            util.subp(['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
+            udev.udevadm_settle()
+            if not os.path.exists(devpath):
+                return
 
-    util.wait_for_removal(devpath)
+        util.wait_for_removal(devpath)
+    finally:
+        invalidate()
 
 
 def find_mpath_members(multipath_id, paths=None):
     """ Return a list of device path for each member of aspecified mpath_id."""
-    if not paths:
-        paths = show_paths()
+    if paths:
+        return ['/dev/' + path['device']
+                for path in paths if path['multipath'] == multipath_id]
+
+    if not MULTIPATH_TOPOLOGY.settled():
         for retry in range(0, 5):
-            orphans = [path for path in paths if 'orphan' in path['multipath']]
-            if len(orphans):
-                udev.udevadm_settle()
-                paths = show_paths()
-            else:
+            if not MULTIPATH_TOPOLOGY.has_orphans():
                 break
+            # paths not yet claimed by a map, give multipathd time to settle
+            udev.udevadm_settle()
+            invalidate()
+        MULTIPATH_TOPOLOGY.mark_settled()
 
-    members = ['/dev/' + path['device']
-               for path in paths if path['multipath'] == multipath_id]
-    return members
+    return MULTIPATH_TOPOLOGY.map_members(multipath_id)
 
 
 def find_mpath_id(devpath):
@@ -146,13 +253,13 @@ def find_mpath_id(devpath):
 
 def find_mpath_id_by_path(devpath, paths=None):
     """ Return the mpath_id associated with a specified device path. """
-    if not paths:
-        paths = show_paths()
-
     if devpath.startswith('/dev/dm-'):
         raise ValueError('find_mpath_id_by_path does not handle '
                          'device-mapper devices: %s' % devpath)
 
+    if not paths:
+        return MULTIPATH_TOPOLOGY.member_map(devpath)
+
     for path in paths:
         if devpath == '/dev/' + path['device']:
             return path['multipath']
@@ -162,13 +269,11 @@ def find_mpath_id_by_path(devpath, paths=None):
 
 def find_mpath_id_by_parent(multipath_id, partnum=None):
     """ Return the mpath_id associated with a specified device path. """
-    devmap = dmname_to_blkdev_mapping()
-    LOG.debug('multipath: dm_name blk map: %s', devmap)
     dm_name = multipath_id
     if partnum:
         dm_name += "-part%d" % int(partnum)
 
-    return (dm_name, devmap.get(dm_name))
+    return (dm_name, MULTIPATH_TOPOLOGY.dm_blkdev(dm_name))
 
 
 def find_mpath_partitions(mpath_id):
@@ -182,18 +287,23 @@ def find_mpath_partitions(mpath_id):
     if not mpath_id:
         raise ValueError('Invalid mpath_id parameter: %s' % mpath_id)
 
-    return (mp_id for (mp_id, _dm_dev) in dmname_to_blkdev_mapping().items()
-            if mp_id.startswith(mpath_id + '-'))
+    return iter(MULTIPATH_TOPOLOGY.map_partitions(mpath_id))
 
 
 def get_mpath_id_from_device(device):
+    info = udev.udevadm_info(device)
     # /dev/dm-X
-    if is_mpath_device(device) or is_mpath_partition(device):
-        info = udev.udevadm_info(device)
+    if (is_mpath_device(device, info=info) or
+            is_mpath_partition(device, info=info)):
         return info.get('DM_NAME')
     # /dev/sdX
-    if is_mpath_member(device):
-        return find_mpath_id_by_path(device)
+    if is_mpath_member(device, info=info):
+        mpath_id = find_mpath_id_by_path(device)
+        if mpath_id is None:
+            # udev knows the path, the topology snapshot predates it
+            invalidate()
+            mpath_id = find_mpath_id_by_path(device)
+        return mpath_id
 
     return None
 
@@ -202,7 +312,7 @@ def force_devmapper_symlinks():
     """Check if /dev/mapper/mpath* files are symlinks, if not trigger udev."""
     LOG.debug('Verifying /dev/mapper/mpath* files are symlinks')
     needs_trigger = []
-    for mp_id, dm_dev in dmname_to_blkdev_mapping().items():
+    for mp_id, dm_dev in MULTIPATH_TOPOLOGY.dm_blkdevs().items():
         if mp_id.startswith('mpath'):
             mapper_path = '/dev/mapper/' + mp_id
             if not os.path.islink(mapper_path):
@@ -226,7 +336,10 @@ def force_devmapper_symlinks():
 
 def reload():
     """ Request multipath to force reload devmaps. """
-    util.subp(['multipath', '-r'])
+    try:
+        util.subp(['multipath', '-r'])
+    finally:
+        invalidate()
 
 
 def multipath_supported():
@@ -23,12 +23,17 @@ definitions = {
              'pattern': r'^([1-9]\d*(.\d+)?|\d+.\d+)(K|M|G|T)?B?'},
     'wipe': {
         'type': 'string',
-        'enum': ['random', 'superblock', 'superblock-recursive', 'zero'],
+        'enum': ['discard', 'random', 'superblock', 'superblock-recursive',
+                 'zero'],
     },
     'uuid': {
         'type': 'string',
         'pattern': _uuid_pattern,
     },
+    'zfs_profile': {
+        'type': 'string',
+        'enum': ['database', 'general', 'incompressible', 'vm-images'],
+    },
     'params': {
         'type': 'object',
         'patternProperties': {
@@ -165,6 +170,18 @@ DM_CRYPT = {
         'keyfile': {'$ref': '#/definitions/id'},
         'preserve': {'$ref': '#/definitions/preserve'},
         'type': {'const': 'dm_crypt'},
+        'pbkdf': {'type': 'string',
+                  'enum': ['argon2i', 'argon2id', 'pbkdf2']},
+        'pbkdf-memory': {'type': 'integer', 'minimum': 32},
+        'iter-time': {'type': 'integer', 'minimum': 1},
+        'sector-size': {'type': 'integer',
+                        'enum': [512, 1024, 2048, 4096]},
+        'perf': {'type': 'array',
+                 'items': {'type': 'string',
+                           'enum': ['no_read_workqueue',
+                                    'no_write_workqueue',
+                                    'same_cpu_crypt',
+                                    'submit_from_crypt_cpus']}},
     },
 }
 FORMAT = {
@@ -334,6 +351,9 @@ RAID = {
         'wipe': {'$ref': '#/definitions/wipe'},
         'spare_devices': {'$ref': '#/definitions/devices'},
         'container': {'$ref': '#/definitions/id'},
+        'resync': {'type': 'string',
+                   'enum': ['resync', 'assume-clean', 'throttle', 'wait']},
+        'sync_speed_max': {'type': 'integer', 'minimum': 1},
         'type': {'const': 'raid'},
         'raidlevel': {
             'type': ['integer', 'string'],
@@ -362,6 +382,7 @@ ZFS = {
     'properties': {
         'id': {'$ref': '#/definitions/id'},
         'pool': {'$ref': '#/definitions/ref_id'},
+        'profile': {'$ref': '#/definitions/zfs_profile'},
         'properties': {'$ref': '#/definitions/params'},
         'volume': {'$ref': '#/definitions/name'},
         'type': {'const': 'zfs'},
@@ -382,6 +403,7 @@ ZPOOL = {
         'pool': {'$ref': '#/definitions/name'},
         'pool_properties': {'$ref': '#/definitions/params'},
         'fs_properties': {'$ref': '#/definitions/params'},
+        'profile': {'$ref': '#/definitions/zfs_profile'},
         'mountpoint': {
             'type': 'string',
             'oneOf': [
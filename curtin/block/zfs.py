@@ -9,19 +9,36 @@ import os
 from curtin.config import merge_config
 from curtin import distro
 from curtin import util
-from . import blkid, get_supported_filesystems
+from . import blkid, get_blockdev_sector_size, get_supported_filesystems
 
 ZPOOL_DEFAULT_PROPERTIES = {
     'ashift': 12,
     'version': 28,
 }
 
+# largest ashift zfs supports (64KiB sectors)
+ZPOOL_MAX_ASHIFT = 16
+
 ZFS_DEFAULT_PROPERTIES = {
     'atime': 'off',
     'canmount': 'off',
     'normalization': 'formD',
 }
 
+# Dataset property profiles for the zpool and zfs 'profile' keys.  Pools
+# of the default version 28 lack the lz4_compress feature, their profile
+# datasets use compression=on, which is lzjb there.  Recordsizes stay within
+# what version 28 supports (no large_blocks feature, 128K at most).
+ZFS_PROFILES = {
+    'general': {'compression': 'lz4'},
+    'database': {'compression': 'lz4', 'recordsize': '16K'},
+    'vm-images': {'compression': 'lz4', 'recordsize': '64K'},
+    'incompressible': {'compression': 'off'},
+}
+# pool version of pools with feature flags, which zpool create enables all
+# of (lz4_compress among them)
+ZPOOL_FEATURES_VERSION = 5000
+
 ZFS_UNSUPPORTED_ARCHES = ['i386']
 ZFS_UNSUPPORTED_RELEASES = ['precise', 'trusty']
 
@@ -73,6 +90,68 @@ def _join_pool_volume(poolname, volume):
     return os.path.normpath("%s/%s" % (poolname, volume))
 
 
+def zpool_has_lz4(pool_properties=None):
+    """
+    Return True if a pool created with pool_properties supports lz4.
+
+    :param pool_properties: dictionary of pool properties, merged over
+                            ZPOOL_DEFAULT_PROPERTIES as zpool_create does.
+    :returns: Boolean
+    """
+    pool_cfg = ZPOOL_DEFAULT_PROPERTIES.copy()
+    if pool_properties:
+        merge_config(pool_cfg, pool_properties)
+    try:
+        return int(pool_cfg.get('version')) >= ZPOOL_FEATURES_VERSION
+    except (TypeError, ValueError):
+        return False
+
+
+def zfs_profile_properties(profile, properties=None, pool_properties=None):
+    """
+    Return the properties of profile overridden by properties.
+
+    :param profile: Name of a profile in ZFS_PROFILES, or None.
+    :param properties: dictionary of properties which take precedence.
+    :param pool_properties: pool properties of the pool the profile is used
+                            in.  Pools without lz4 get compression=on.
+    :returns: dictionary of properties
+    :raises: ValueError: if profile is unknown
+    """
+    merged = {}
+    if profile:
+        if profile not in ZFS_PROFILES:
+            raise ValueError("Unknown zfs profile '%s', expected one of %s" %
+                             (profile, sorted(ZFS_PROFILES)))
+        merged.update(ZFS_PROFILES[profile])
+        if (merged.get('compression') == 'lz4' and
+                not zpool_has_lz4(pool_properties)):
+            merged['compression'] = 'on'
+    if properties:
+        merged.update(properties)
+    return merged
+
+
+def zpool_ashift(vdevs):
+    """
+    Return the ashift to create a pool of vdevs with.
+
+    The ashift matches the largest physical sector size of any vdev so
+    that no vdev is written in partial sectors.  It is never below the
+    default of 12 (4KiB): many drives with 4KiB sectors report 512 bytes
+    and a later replacement disk may well have 4KiB sectors.
+
+    :param vdevs: An iterable of block device paths.
+    :returns: integer ashift
+    """
+    ashift = ZPOOL_DEFAULT_PROPERTIES['ashift']
+    for vdev in vdevs:
+        (_logical, physical) = get_blockdev_sector_size(vdev)
+        ashift = max(ashift, min(physical.bit_length() - 1,
+                                 ZPOOL_MAX_ASHIFT))
+    return ashift
+
+
 def zfs_supported():
     """Return a boolean indicating if zfs is supported."""
     try:
@@ -140,6 +219,9 @@ def zpool_create(poolname, vdevs, mountpoint=None, altroot=None,
             raise TypeError("vdevs must be iterable, not: %s" % str(vdevs))
 
     pool_cfg = ZPOOL_DEFAULT_PROPERTIES.copy()
+    # Set the zpool.cache file while creating the pool rather than with
+    # a separate 'zpool set'
+    pool_cfg['cachefile'] = '/etc/zfs/zpool.cache'
     if pool_properties:
         merge_config(pool_cfg, pool_properties)
     zfs_cfg = ZFS_DEFAULT_PROPERTIES.copy()
@@ -158,12 +240,8 @@ def zpool_create(poolname, vdevs, mountpoint=None, altroot=None,
     cmd = ["zpool", "create"] + options + [poolname] + vdevs
     util.subp(cmd, capture=True)
 
-    # Trigger generation of zpool.cache file
-    cmd = ["zpool", "set", "cachefile=/etc/zfs/zpool.cache", poolname]
-    util.subp(cmd, capture=True)
-
 
-def zfs_create(poolname, volume, zfs_properties=None):
+def zfs_create(poolname, volume, zfs_properties=None, parents=False):
     """
     Create a filesystem dataset within the specified zpool.
 
@@ -175,6 +253,9 @@ def zfs_create(poolname, volume, zfs_properties=None):
                            of the filesystems created under the pool. If
                            value is None then no properties will be set on
                            the filesystem.
+    :param parents: Boolean, create any missing parent datasets (with
+                    default properties) first.  The dataset itself must not
+                    exist yet.
     :returns: None
     :raises: ValueError: raises exceptions on missing/bad input.
     :raises: ProcessExecutionError: raised on unhandled exceptions from
@@ -190,9 +271,15 @@ def zfs_create(poolname, volume, zfs_properties=None):
     if zfs_properties:
         merge_config(zfs_cfg, zfs_properties)
 
-    options = _join_flags('-o', zfs_cfg)
+    dataset = _join_pool_volume(poolname, volume)
+    parent = os.path.dirname(dataset)
+    # -p succeeds for an existing dataset without setting its properties, so
+    # it is only used for the parents
+    if parents and os.path.dirname(parent):
+        util.subp(["zfs", "create", "-p", parent], capture=True)
 
-    cmd = ["zfs", "create"] + options + [_join_pool_volume(poolname, volume)]
+    options = _join_flags('-o', zfs_cfg)
+    cmd = ["zfs", "create"] + options + [dataset]
     util.subp(cmd, capture=True)
 
     # mount volume if it canmount=noauto
@@ -9,16 +9,20 @@ from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 from curtin.storage_config import (extract_storage_ordered_dict,
-                                   ptable_uuid_to_flag_entry)
+                                   get_item_direct_dependencies,
+                                   ptable_uuid_to_flag_entry,
+                                   IndexedStorageConfig)
 
 
 from . import populate_one_subcmd
 from curtin.udev import (compose_udev_equality, udevadm_settle,
-                         udevadm_trigger, udevadm_info)
+                         udevadm_trigger, udevadm_info, udevadm_info_db)
 
 import glob
+import json
 import os
 import platform
+import re
 import string
 import sys
 import tempfile
@@ -54,6 +58,93 @@ MSDOS_FLAGS = {
     'logical': 'logical',
 }
 
+# partition tables read while verifying preserved partitions, reset for each
+# block-meta run and invalidated whenever a handler writes a partition table
+PTABLE_CACHE = block.PartitionTableCache()
+
+# ids of lvm_partition items created along with their volume group
+CREATED_LVOLS = set()
+
+# ids of dasd items formatted before the rest of the storage config, and the
+# default number of dasds formatted concurrently
+FORMATTED_DASDS = set()
+DASD_FORMAT_WORKERS = 4
+
+# cache set uuid of each bcache cache device item, and the bcache devices
+# created along with an earlier bcache item on the same cache set
+BCACHE_CACHE_SETS = {}
+CREATED_BCACHES = {}
+
+# ids of the storage config items configured so far by this block-meta run
+CONFIGURED_ITEMS = set()
+
+# volumes needing dname rules and the mounts needing fstab entries, both
+# written together once all storage is configured, see write_dnames_and_fstab
+DNAME_VOLUMES = []
+FSTAB_ENTRIES = []
+
+# pool name -> the zfs datasets the storage config creates in it, filled on
+# first use in each block-meta run
+ZFS_DATASETS = {}
+
+# Extra mount options used while curtin writes the target when block-meta
+# install-mount-options is enabled, by filesystem type ('*' applies to all).
+# Mounts made with them are remounted with their final options once the
+# install has finished, see restore_install_mount_options.
+INSTALL_MOUNT_OPTIONS = {
+    '*': 'noatime,lazytime',
+    'ext4': 'nobarrier',
+    'xfs': 'logbsize=256k',
+}
+# an install option is not used if the final options contain any of these
+INSTALL_MOUNT_OPTION_CONFLICTS = {
+    'noatime': ['atime', 'noatime', 'relatime', 'strictatime'],
+    'lazytime': ['lazytime', 'nolazytime'],
+    'nobarrier': ['barrier', 'nobarrier'],
+    'journal_async_commit': ['journal_async_commit', 'journal_checksum',
+                             'nojournal_checksum', 'data=journal'],
+    'logbsize': ['logbsize'],
+}
+# the options which undo an install option on remount.  Options without one
+# (logbsize) cannot be changed by a remount and stay in effect until the
+# target is unmounted, fstab never contains them.  ext4 journal_async_commit
+# is not a default as ext4 refuses it in the default data=ordered mode.
+INSTALL_MOUNT_OPTION_UNDO = {
+    'noatime': 'relatime',
+    'lazytime': 'nolazytime',
+    'nobarrier': 'barrier',
+}
+INSTALL_MOUNTS_STATE_FILE = 'install_mounts.json'
+# install mount options by filesystem type for this block-meta run, empty
+# if disabled
+INSTALL_MOUNT_POLICY = {}
+# whether mkfs options are tuned to the device io topology in this
+# block-meta run
+MKFS_TUNING = {'enabled': False}
+
+# what the installed cryptsetup supports and the pbkdf parameters measured by
+# cryptsetup benchmark, both reset for each block-meta run
+CRYPTSETUP_CAPABILITIES = {}
+PBKDF_BENCHMARKS = {}
+
+# cryptsetup iteration time (ms) used when iter-time is not configured
+CRYPTSETUP_DEFAULT_ITER_TIME = 2000
+PBKDF2_MIN_ITERATIONS = 1000
+
+# storage config types whose handlers drive host-wide state (lvm metadata
+# scans, mdadm assembly and mdadm.conf, crypttab, fstab, ...).  Items in the
+# same group are never configured concurrently.
+HANDLER_LOCK_GROUPS = {
+    'bcache': 'bcache',
+    'dm_crypt': 'dm_crypt',
+    'lvm_partition': 'lvm',
+    'lvm_volgroup': 'lvm',
+    'mount': 'mount',
+    'raid': 'mdadm',
+    'zfs': 'zfs',
+    'zpool': 'zfs',
+}
+
 DNAME_BYID_KEYS = ['DM_UUID', 'ID_WWN_WITH_EXTENSION', 'ID_WWN', 'ID_SERIAL',
                    'ID_SERIAL_SHORT']
 CMD_ARGUMENTS = (
@@ -105,7 +196,8 @@ def block_meta(args):
 
     LOG.debug('clearing devices=%s', devices)
     if devices:
-        meta_clear(devices, state.get('report_stack_prefix', ''))
+        meta_clear(devices, state.get('report_stack_prefix', ''),
+                   workers=cfg.get('block-meta', {}).get('workers', 1))
 
     # dd-images requires use of meta_simple
     if len(dd_images) > 0 and args.force_mode is False:
@@ -230,31 +322,29 @@ def devsync(devpath):
 def determine_partition_number(partition_id, storage_config):
     vol = storage_config.get(partition_id)
     partnumber = vol.get('number')
-    if vol.get('flag') == "logical":
-        if not partnumber:
-            LOG.warn('partition \'number\' key not set in config:\n%s',
-                     util.json_dumps(vol))
-            partnumber = 5
-            for key, item in storage_config.items():
-                if item.get('type') == "partition" and \
-                        item.get('device') == vol.get('device') and\
-                        item.get('flag') == "logical":
-                    if item.get('id') == vol.get('id'):
-                        break
-                    else:
-                        partnumber += 1
-    else:
-        if not partnumber:
-            LOG.warn('partition \'number\' key not set in config:\n%s',
-                     util.json_dumps(vol))
-            partnumber = 1
-            for key, item in storage_config.items():
-                if item.get('type') == "partition" and \
-                        item.get('device') == vol.get('device'):
-                    if item.get('id') == vol.get('id'):
-                        break
-                    else:
-                        partnumber += 1
+    if partnumber:
+        return partnumber
+
+    LOG.warn('partition \'number\' key not set in config:\n%s',
+             util.json_dumps(vol))
+    logical = vol.get('flag') == "logical"
+    partnumber = 5 if logical else 1
+    if isinstance(storage_config, IndexedStorageConfig):
+        if logical:
+            index = storage_config.get_logical_partition_index(partition_id)
+        else:
+            index = storage_config.get_partition_index(partition_id)
+        if index is not None:
+            return partnumber + index
+
+    for key, item in storage_config.items():
+        if item.get('type') == "partition" and \
+                item.get('device') == vol.get('device') and \
+                (not logical or item.get('flag') == "logical"):
+            if item.get('id') == vol.get('id'):
+                break
+            else:
+                partnumber += 1
     return partnumber
 
 
@@ -300,7 +390,53 @@ def make_dname_byid(path, error_msg=None, info=None):
     return [[compose_udev_equality('ENV{%s}' % k, info[k]) for k in present]]
 
 
-def make_dname(volume, storage_config):
+class DeviceInfo(object):
+    """ udev properties, blkid tags and lsblk types of block devices.
+
+    These are read for all devices at once, with one udevadm info
+    --export-db, one lsblk and one blkid of the devices in blkid_devices,
+    rather than with a udevadm, blkid and lsblk call per device.
+    """
+
+    def __init__(self, blkid_devices=None):
+        udevadm_settle()
+        self._udev = udevadm_info_db()
+        self._lsblk = block._lsblock()
+        self._blkid = {}
+        for devname, tags in block.blkid_export(blkid_devices).items():
+            self._blkid[os.path.realpath(devname)] = tags
+        self._devnames = {}
+        for devname, info in self._udev.items():
+            for link in [devname] + info['DEVLINKS']:
+                self._devnames[link] = devname
+
+    def udev_info(self, path):
+        """Return the udev properties of the device at path."""
+        info = self._udev.get(
+            self._devnames.get(path, os.path.realpath(path)))
+        if info is None:
+            # not in the database read, ask udev for this device
+            info = udevadm_info(path=path)
+        return info
+
+    def blkid(self, path):
+        """Return the blkid tags of path, which must be in blkid_devices."""
+        return self._blkid.get(os.path.realpath(path), {})
+
+    def volume_type(self, path):
+        """Return the lsblk TYPE of the device at path."""
+        kname = block.path_to_kname(path)
+        if kname in self._lsblk:
+            return self._lsblk[kname]['TYPE']
+        return _get_volume_type(path)
+
+
+def make_dname(volume, storage_config, devices=None):
+    """ Write the by-dname udev rules for volume.
+
+    :param devices: DeviceInfo to read udev properties and blkid tags from,
+                    by default these are read for this volume alone.
+    """
     state = util.load_command_environment(strict=True)
     rules_dir = os.path.join(state['scratch'], "rules.d")
     vol = storage_config.get(volume)
@@ -308,7 +444,17 @@ def make_dname(volume, storage_config):
     ptuuid = None
     byid = None
     dname = vol.get('name')
-    if vol.get('type') in ["partition", "disk"]:
+    if vol.get('type') == "partition" and not dname:
+        # disks generate dname-part%n rules automatically
+        LOG.debug('No partition-specific dname')
+        return
+    if vol.get('type') in ["partition", "disk"] and devices:
+        tags = devices.blkid(path)
+        ptuuid = tags.get('PTUUID' if vol['type'] == 'disk' else 'PARTUUID')
+        if vol.get('type') == 'disk':
+            byid = make_dname_byid(path, error_msg="id=%s" % vol.get('id'),
+                                   info=devices.udev_info(path))
+    elif vol.get('type') in ["partition", "disk"]:
         (out, _err) = util.subp(["blkid", "-o", "export", path], capture=True,
                                 rcs=[0, 2], retries=[1, 1, 1])
         for line in out.splitlines():
@@ -337,15 +483,10 @@ def make_dname(volume, storage_config):
             matches += [
                 [compose_udev_equality('ENV{DEVTYPE}', "disk")] + rule]
     elif vol.get('type') == "partition":
-        # if partition has its own name, bind that to the existing PTUUID
-        if dname:
-            matches += [[compose_udev_equality('ENV{DEVTYPE}', "partition"),
-                        compose_udev_equality('ENV{ID_PART_ENTRY_UUID}',
-                                              ptuuid)]]
-        else:
-            # disks generate dname-part%n rules automatically
-            LOG.debug('No partition-specific dname')
-            return
+        # the partition has its own name, bind that to the existing PTUUID
+        matches += [[compose_udev_equality('ENV{DEVTYPE}', "partition"),
+                    compose_udev_equality('ENV{ID_PART_ENTRY_UUID}',
+                                          ptuuid)]]
     elif vol.get('type') == "raid":
         md_data = mdadm.mdadm_query_detail(path)
         md_uuid = md_data.get('MD_UUID')
@@ -361,7 +502,7 @@ def make_dname(volume, storage_config):
         matches += [[compose_udev_equality("ENV{CACHED_UUID}", bdev_uuid)]]
         bcache.write_label(sanitize_dname(dname), backing_dev)
     elif vol.get('type') == "lvm_partition":
-        info = udevadm_info(path=path)
+        info = devices.udev_info(path) if devices else udevadm_info(path=path)
         dname = info['DM_NAME']
         matches += [[compose_udev_equality("ENV{DM_NAME}", dname)]]
     else:
@@ -600,31 +741,100 @@ def dasd_handler(info, storage_config, handlers):
      'disk_layout': 'cdl',
     }
     """
-    device_id = info.get('device_id')
+    if info.get('id') in FORMATTED_DASDS:
+        LOG.debug('dasd %s was formatted with the other dasds', info['id'])
+        return
+
+    dasd_device = dasd.DasdDevice(info.get('device_id'))
+    mode = dasd_format_mode(info, dasd_device)
+    if mode:
+        format_dasd(info, dasd_device, mode)
+
+
+def dasd_format_mode(info, dasd_device):
+    """Return the dasdfmt mode a dasd config item needs, None if none.
+
+    A configured mode is used as is, otherwise a quick format is used when
+    only the disk layout or label differ from the configuration.
+
+    :raises: ValueError if the dasd needs formatting but is preserved.
+    """
+    mode = dasd_device.format_mode(info.get('blocksize'),
+                                   info.get('disk_layout'), info.get('label'))
+    if mode is None and not config.value_as_boolean(info.get('wipe')):
+        return None
+    if config.value_as_boolean(info.get('preserve')):
+        raise ValueError(
+            "dasd '%s' does not match configured properties and"
+            "preserve is set to true.  The dasd needs formatting"
+            "with the specified parameters to continue." % info.get('id'))
+    return info.get('mode') or mode or 'quick'
+
+
+def format_dasd(info, dasd_device, mode, progress=None):
+    """Run dasdfmt on dasd_device and verify it matches info afterwards."""
     blocksize = info.get('blocksize')
     disk_layout = info.get('disk_layout')
     label = info.get('label')
-    mode = info.get('mode')
-    force_format = config.value_as_boolean(info.get('wipe'))
 
-    dasd_device = dasd.DasdDevice(device_id)
-    if (force_format or dasd_device.needs_formatting(blocksize,
-                                                     disk_layout, label)):
-        if config.value_as_boolean(info.get('preserve')):
-            raise ValueError(
-                "dasd '%s' does not match configured properties and"
-                "preserve is set to true.  The dasd needs formatting"
-                "with the specified parameters to continue." % info.get('id'))
+    LOG.debug('Formatting dasd id=%s device_id=%s devname=%s mode=%s',
+              info.get('id'), dasd_device.device_id, dasd_device.devname,
+              mode)
+    dasd_device.format(blksize=blocksize, layout=disk_layout,
+                       set_label=label, mode=mode, progress=progress)
 
-        LOG.debug('Formatting dasd id=%s device_id=%s devname=%s',
-                  info.get('id'), device_id, dasd_device.devname)
-        dasd_device.format(blksize=blocksize, layout=disk_layout,
-                           set_label=label, mode=mode)
+    # check post-format to ensure values match
+    if dasd_device.needs_formatting(blocksize, disk_layout, label):
+        raise RuntimeError(
+            "Dasd %s failed to format" % dasd_device.devname)
 
-        # check post-format to ensure values match
-        if dasd_device.needs_formatting(blocksize, disk_layout, label):
-            raise RuntimeError(
-                "Dasd %s failed to format" % dasd_device.devname)
+
+def format_dasds(storage_config, workers=DASD_FORMAT_WORKERS,
+                 stack_prefix=''):
+    """Format the dasds of storage_config which need it concurrently.
+
+    A full dasdfmt of a large volume runs for a long time, so every dasd
+    that needs formatting is formatted up front with up to workers dasdfmt
+    processes at a time.  dasdfmt progress is reported as progress events.
+    dasd_handler skips the dasds formatted here.
+    """
+    pending = OrderedDict()
+    for info in storage_config.values():
+        if info.get('type') != 'dasd':
+            continue
+        dasd_device = dasd.DasdDevice(info.get('device_id'))
+        mode = dasd_format_mode(info, dasd_device)
+        if mode:
+            pending[info['id']] = (info, dasd_device, mode)
+    if not pending:
+        return
+
+    def format_one(item_id):
+        (info, dasd_device, mode) = pending[item_id]
+        event_name = '/'.join(filter(None, (stack_prefix, item_id,
+                                            'dasdfmt')))
+        reported = {}
+
+        def progress(cylinder, cylinders, percent):
+            if reported.get('percent') != percent:
+                reported['percent'] = percent
+                events.report_progress_event(
+                    event_name, 'dasdfmt of %s %d%% complete (cylinder %d of '
+                    '%d)' % (dasd_device.devname, percent, cylinder,
+                             cylinders))
+
+        with events.ReportEventStack(
+                name=event_name, reporting_enabled=True, level='INFO',
+                description='formatting dasd %s (%s)' % (dasd_device.devname,
+                                                         mode)):
+            format_dasd(info, dasd_device, mode, progress=progress)
+        FORMATTED_DASDS.add(item_id)
+
+    LOG.debug('Formatting %d dasd(s) with %s worker(s)', len(pending),
+              workers)
+    util.run_dependency_graph(
+        OrderedDict((item_id, []) for item_id in pending), format_one,
+        workers=min(int(workers), len(pending)))
 
 
 def disk_handler(info, storage_config, handlers):
@@ -676,6 +886,7 @@ def disk_handler(info, storage_config, handlers):
                 util.subp(["parted", disk, "--script", "mklabel", "msdos"])
             elif ptable == "vtoc":
                 util.subp(["fdasd", "-c", "/dev/null", disk])
+        PTABLE_CACHE.invalidate(disk)
         holders = clear_holders.get_holders(disk)
         if len(holders) > 0:
             LOG.info('Detected block holders on disk %s: %s', disk, holders)
@@ -684,10 +895,13 @@ def disk_handler(info, storage_config, handlers):
 
     # Make the name if needed
     if info.get('name'):
-        make_dname(info.get('id'), storage_config)
+        DNAME_VOLUMES.append(info.get('id'))
 
 
 def getnumberoflogicaldisks(device, storage_config):
+    if isinstance(storage_config, IndexedStorageConfig):
+        return storage_config.count_logical(device)
+
     logicaldisks = 0
     for key, item in storage_config.items():
         if item.get('device') == device and item.get('flag') == "logical":
@@ -696,6 +910,14 @@ def getnumberoflogicaldisks(device, storage_config):
 
 
 def find_previous_partition(disk_id, part_id, storage_config):
+    if isinstance(storage_config, IndexedStorageConfig):
+        # the last partition on this disk before part_id, skip 'extended'
+        for item_id in reversed(
+                storage_config.get_partitions_before(disk_id, part_id)):
+            if storage_config[item_id].get('flag') != "extended":
+                return determine_partition_number(item_id, storage_config)
+        return None
+
     last_partnum = None
     for item_id, command in storage_config.items():
         if item_id == part_id:
@@ -720,6 +942,9 @@ def find_extended_partition(part_device, storage_config):
         :param: storage_config: Ordered dict of storage configation
         :returns: string: item_id if found or None
     """
+    if isinstance(storage_config, IndexedStorageConfig):
+        return storage_config.get_extended_partition(part_device)
+
     for item_id, item in storage_config.items():
         if item.get('type') == "partition" and \
            item.get('device') == part_device and \
@@ -937,8 +1162,8 @@ def partition_handler(info, storage_config, handlers):
         if disk_ptable == 'vtoc':
             partition_verify_fdasd(disk, partnumber, info)
         else:
-            sfdisk_info = block.sfdisk_info(disk)
-            part_info = block.get_partition_sfdisk_info(part_path, sfdisk_info)
+            sfdisk_info = PTABLE_CACHE.sfdisk_info(disk)
+            part_info = PTABLE_CACHE.partition_info(disk, part_path)
             partition_verify_sfdisk(info, sfdisk_info['label'], part_info)
         LOG.debug(
             '%s partition %s already present, skipping create',
@@ -1001,6 +1226,7 @@ def partition_handler(info, storage_config, handlers):
             dasd_pt.add_partition(partnumber, length_bytes)
         else:
             raise ValueError("parent partition has invalid partition table")
+        PTABLE_CACHE.invalidate(disk)
 
         # ensure partition exists
         if multipath.is_mpath_device(disk):
@@ -1012,6 +1238,7 @@ def partition_handler(info, storage_config, handlers):
             if os.path.exists(part_path) and not os.path.islink(part_path):
                 util.del_file(part_path)
             util.subp(['kpartx', '-v', '-a', '-s', '-p', '-part', disk])
+            multipath.invalidate()
         else:
             part_path = block.dev_path(block.partition_kname(disk_kname,
                                                              partnumber))
@@ -1029,7 +1256,36 @@ def partition_handler(info, storage_config, handlers):
 
     # Make the name if needed
     if storage_config.get(device).get('name') and partition_type != 'extended':
-        make_dname(info.get('id'), storage_config)
+        DNAME_VOLUMES.append(info.get('id'))
+
+
+def get_volume_stack(volume, storage_config):
+    """Return paths of the devices volume is built on, top down.
+
+    Only single device layers are followed (partitions, dm_crypt, bcache
+    backing devices and volume groups of one physical volume), for the io
+    topology mkfs is tuned to.
+    """
+    stack = []
+    vol = storage_config.get(volume)
+    while vol:
+        vtype = vol.get('type')
+        if vtype == 'partition':
+            below = vol.get('device')
+        elif vtype == 'dm_crypt':
+            below = vol.get('volume')
+        elif vtype == 'bcache':
+            below = vol.get('backing_device')
+        elif vtype == 'lvm_partition':
+            below = vol.get('volgroup')
+        elif vtype == 'lvm_volgroup' and len(vol.get('devices', [])) == 1:
+            below = vol['devices'][0]
+        else:
+            break
+        vol = storage_config.get(below)
+        if vol and vol.get('type') != 'lvm_volgroup':
+            stack.append(get_path_to_storage_volume(below, storage_config))
+    return stack
 
 
 def format_handler(info, storage_config, handlers):
@@ -1048,7 +1304,11 @@ def format_handler(info, storage_config, handlers):
 
     # Make filesystem using block library
     LOG.debug("mkfs %s info: %s", volume_path, info)
-    mkfs.mkfs_from_config(volume_path, info)
+    if MKFS_TUNING['enabled']:
+        mkfs.mkfs_from_config(volume_path, info, tune=True,
+                              stack=get_volume_stack(volume, storage_config))
+    else:
+        mkfs.mkfs_from_config(volume_path, info)
 
     device_type = storage_config.get(volume).get('type')
     LOG.debug('Formated device type: %s', device_type)
@@ -1123,14 +1383,21 @@ def _get_volume_type(device_path):
     return lsblock[kname]['TYPE']
 
 
-def get_volume_spec(device_path):
+def get_volume_spec(device_path, devices=None):
     """
        Return the most reliable spec for a device per Ubuntu FSTAB wiki
 
        https://wiki.ubuntu.com/FSTAB
+
+       If given, udev properties and block type are read from DeviceInfo
+       devices instead of udevadm and lsblk.
     """
-    info = udevadm_info(path=device_path)
-    block_type = _get_volume_type(device_path)
+    if devices:
+        info = devices.udev_info(device_path)
+        block_type = devices.volume_type(device_path)
+    else:
+        info = udevadm_info(path=device_path)
+        block_type = _get_volume_type(device_path)
     LOG.debug('volspec: path=%s type=%s', device_path, block_type)
     LOG.debug('info[DEVLINKS] = %s', info['DEVLINKS'])
 
@@ -1189,10 +1456,11 @@ def proc_filesystems_passno(fstype):
     return "1"
 
 
-def fstab_line_for_data(fdata):
+def fstab_line_for_data(fdata, devices=None):
     """Return a string representing fdata in /etc/fstab format.
 
     :param fdata: a FstabData type
+    :param devices: DeviceInfo passed on to get_volume_spec
     :return a newline terminated string for /etc/fstab."""
     path = fdata.path
     if not path:
@@ -1204,7 +1472,7 @@ def fstab_line_for_data(fdata):
     if fdata.spec is None:
         if not fdata.device:
             raise ValueError("FstabData missing both spec and device.")
-        spec = get_volume_spec(fdata.device)
+        spec = get_volume_spec(fdata.device, devices=devices)
     else:
         spec = fdata.spec
 
@@ -1293,12 +1561,172 @@ def mount_handler(info, storage_config, handlers):
         'device': 'rootfs',
     }
 
-    Mount specified device under target at 'path' and generate
-    fstab entry.
+    Mount specified device under target at 'path'.  The fstab entry is
+    written by write_dnames_and_fstab.
     """
     state = util.load_command_environment(strict=True)
-    mount_apply(mount_data(info, storage_config),
-                target=state.get('target'), fstab=state.get('fstab'))
+    fdata = mount_data(info, storage_config)
+    if fdata.fstype != "swap":
+        mount_install_fstab_data(fdata, state)
+    FSTAB_ENTRIES.append(fdata)
+
+
+def install_mount_options(fdata, policy):
+    """Return the options to mount fdata with while curtin writes the target
+       and the options to remount it with afterwards.
+
+    :param fdata: a FstabData type
+    :param policy: dict of extra mount options by filesystem type, '*'
+                   applying to all, see INSTALL_MOUNT_OPTIONS
+    :return (install options, remount options), or (None, None) to mount
+            fdata with its final options
+    """
+    final = [opt for opt in (fdata.options or 'defaults').split(',') if opt]
+    # nothing is written to read-only mounts, bind mounts share the options
+    # of their source
+    if (not policy or not fdata.device or
+            fdata.fstype in (None, 'none', 'swap', 'bind') or
+            set(final) & set(['bind', 'ro', 'remount'])):
+        return None, None
+    final_names = set(final + [opt.split('=')[0] for opt in final])
+
+    extra = []
+    for opts in (policy.get('*'), policy.get(fdata.fstype)):
+        for opt in (opts or '').split(','):
+            name = opt.split('=')[0]
+            conflicts = INSTALL_MOUNT_OPTION_CONFLICTS.get(name, [name])
+            if not opt or opt in extra or set(conflicts) & final_names:
+                continue
+            extra.append(opt)
+    if not extra:
+        return None, None
+
+    undo = [INSTALL_MOUNT_OPTION_UNDO[opt] for opt in extra
+            if opt in INSTALL_MOUNT_OPTION_UNDO]
+    return ','.join(final + extra), ','.join(['remount'] + final + undo)
+
+
+def mount_install_fstab_data(fdata, state):
+    """Mount fdata under the target, with the install mount options of
+       INSTALL_MOUNT_POLICY if there are any.
+
+    Mounts made with install options are recorded in the install state
+    directory to be remounted with their final options by
+    restore_install_mount_options.  If mounting with the install options
+    fails, fdata is mounted with its final options.
+    """
+    target = state.get('target')
+    install_options, remount_options = install_mount_options(
+        fdata, INSTALL_MOUNT_POLICY)
+    if install_options and not state.get('fstab'):
+        LOG.warning('No install state directory, mounting %s with its '
+                    'final options', fdata.path)
+        install_options = None
+    if install_options:
+        # install options are only used for devices with a filesystem type,
+        # see install_mount_options.  A failure is expected on kernels not
+        # supporting an option, so is not logged as an error.
+        mp = paths.target_path(target, fdata.path)
+        util.ensure_dir(mp)
+        try:
+            util.subp(['mount', '-t', fdata.fstype, '-o', install_options,
+                       fdata.device, mp], capture=True)
+        except util.ProcessExecutionError as e:
+            LOG.warning('Mounting %s with install options %s failed, '
+                        'using %s: %s', fdata.path, install_options,
+                        fdata.options, e.stderr)
+        else:
+            record_install_mount(
+                os.path.join(os.path.dirname(state['fstab']),
+                             INSTALL_MOUNTS_STATE_FILE),
+                mp, remount_options)
+            return
+    mount_fstab_data(fdata, target=target)
+
+
+def record_install_mount(state_file, mountpoint, remount_options):
+    """Record mountpoint to be remounted with remount_options after install.
+    """
+    saved = []
+    if os.path.exists(state_file):
+        saved = json.loads(util.load_file(state_file))
+    saved.append([mountpoint, remount_options])
+    util.write_file(state_file, json.dumps(saved))
+
+
+def restore_install_mount_options(state_file):
+    """Remount each mount recorded in state_file with its final options.
+
+    All filesystems are synced first, so nothing written with the install
+    options is left to be written back.  Mounts which are gone are skipped;
+    the state file is removed.
+    """
+    if not os.path.exists(state_file):
+        return
+    saved = json.loads(util.load_file(state_file))
+    util.subp(['sync'])
+    for mountpoint, remount_options in saved:
+        if not os.path.ismount(mountpoint):
+            LOG.debug('%s is not mounted, not restoring mount options',
+                      mountpoint)
+            continue
+        LOG.info('Remounting %s with %s', mountpoint, remount_options)
+        try:
+            util.subp(['mount', '-o', remount_options, mountpoint],
+                      capture=True)
+        except util.ProcessExecutionError as e:
+            LOG.warning('Failed to remount %s with its final options: %s',
+                        mountpoint, e)
+    util.del_file(state_file)
+
+
+def get_install_mount_policy(setting):
+    """Return the install mount options policy for the block-meta
+       install-mount-options setting.
+
+    :param setting: false or None to disable install mount options, true for
+                    INSTALL_MOUNT_OPTIONS, or a dict of mount options by
+                    filesystem type which override INSTALL_MOUNT_OPTIONS
+    """
+    if isinstance(setting, dict):
+        policy = dict(INSTALL_MOUNT_OPTIONS)
+        policy.update(setting)
+        return policy
+    if config.value_as_boolean(setting):
+        return dict(INSTALL_MOUNT_OPTIONS)
+    return {}
+
+
+def write_dnames_and_fstab(storage_config, fstab):
+    """ Write the dname rules of DNAME_VOLUMES and append the fstab entries
+        of FSTAB_ENTRIES to fstab.
+
+    The udev properties and blkid tags of all the devices involved are read
+    once, see DeviceInfo.
+    """
+    if not DNAME_VOLUMES and not FSTAB_ENTRIES:
+        return
+
+    # only disks and named partitions have their blkid tags read
+    blkid_devices = [
+        get_path_to_storage_volume(volume, storage_config)
+        for volume in DNAME_VOLUMES
+        if storage_config[volume]['type'] == 'disk' or (
+            storage_config[volume]['type'] == 'partition' and
+            storage_config[volume].get('name'))]
+    devices = DeviceInfo(blkid_devices)
+
+    for volume in DNAME_VOLUMES:
+        make_dname(volume, storage_config, devices=devices)
+
+    if not fstab:
+        if FSTAB_ENTRIES:
+            LOG.info("fstab not in environment, so not writing")
+        return
+    lines = [fstab_line_for_data(fdata, devices=devices)
+             for fdata in FSTAB_ENTRIES]
+    if lines:
+        util.write_file(fstab, ''.join(lines), omode="a")
 
 
 def verify_volgroup_members(vg_name, pv_paths):
@@ -1343,12 +1771,40 @@ def lvm_volgroup_handler(info, storage_config, handlers):
         LOG.debug('lvm_volgroup %s already present, skipping create', name)
         create_vg = False
 
+    # The volume group and all the new logical volumes in it are created in
+    # one lvm shell session, see lvm.lvm_shell.  lvm_partition_handler
+    # then only wipes them and writes their dname rules.
+    # Use zero to clear target devices of any metadata
+    vgcreate = ['vgcreate', '--force', '--zero=y', '--yes',
+                name] + device_paths
+    lvols = [(lv_id, lvm_partition_create_cmd(lv_info, name))
+             for lv_id, lv_info in storage_config.items()
+             if lv_info.get('type') == 'lvm_partition' and
+             lv_info.get('volgroup') == info['id'] and
+             not config.value_as_boolean(lv_info.get('preserve'))]
+    commands = ([vgcreate] if create_vg else []) + [cmd for _, cmd in lvols]
+    if commands:
+        lvm.lvm_shell(commands)
+
+    # rerun whatever the shell did not create, failing with lvm's error,
+    # and refuse to carry on with a volume group that is only partly there
     if create_vg:
-        # Create vgrcreate command and run
-        # capture output to avoid printing it to log
-        # Use zero to clear target devices of any metadata
-        util.subp(['vgcreate', '--force', '--zero=y', '--yes',
-                   name] + device_paths, capture=True)
+        if not lvm.get_pvols_in_volgroup(name):
+            # capture output to avoid printing it to log
+            util.subp(vgcreate, capture=True)
+            lvm.invalidate()
+        found_pvs = set(lvm.get_pvols_in_volgroup(name))
+        if found_pvs != set(device_paths):
+            raise RuntimeError(
+                'lvm volgroup %s was not fully created, expected members %s, '
+                'found %s' % (name, set(device_paths), found_pvs))
+    for lv_id, cmd in lvols:
+        lv_name = storage_config[lv_id]['name']
+        if lv_name not in lvm.get_lvols_in_volgroup(name):
+            util.subp(cmd)
+            lvm.invalidate()
+            verify_lv_in_vg(lv_name, name)
+        CREATED_LVOLS.add(lv_id)
 
     # refresh lvmetad
     lvm.lvm_scan()
@@ -1379,6 +1835,23 @@ def lvm_partition_verify(lv_name, vg_name, info):
         verify_lv_size(lv_name, info['size'])
 
 
+def lvm_partition_create_cmd(info, volgroup):
+    """Return the lvcreate command for lvm_partition info in volgroup."""
+    # Use 'wipesignatures' (if available) and 'zero' to clear target lv
+    # of any fs metadata
+    cmd = ["lvcreate", volgroup, "--name", info['name'], "--zero=y"]
+    release = distro.lsb_release()['codename']
+    if release not in ['precise', 'trusty']:
+        cmd.extend(["--wipesignatures=y", "--yes"])
+
+    if info.get('size'):
+        size = util.human2bytes(info["size"])
+        cmd.extend(["--size", "{}B".format(size)])
+    else:
+        cmd.extend(["--extents", "100%FREE"])
+    return cmd
+
+
 def lvm_partition_handler(info, storage_config, handlers):
     volgroup = storage_config[info['volgroup']]['name']
     name = info['name']
@@ -1397,24 +1870,15 @@ def lvm_partition_handler(info, storage_config, handlers):
         LOG.debug('lvm_partition %s already present, skipping create', name)
         create_lv = False
 
-    if create_lv:
-        # Use 'wipesignatures' (if available) and 'zero' to clear target lv
-        # of any fs metadata
-        cmd = ["lvcreate", volgroup, "--name", name, "--zero=y"]
-        release = distro.lsb_release()['codename']
-        if release not in ['precise', 'trusty']:
-            cmd.extend(["--wipesignatures=y", "--yes"])
-
-        if info.get('size'):
-            size = util.human2bytes(info["size"])
-            cmd.extend(["--size", "{}B".format(size)])
-        else:
-            cmd.extend(["--extents", "100%FREE"])
-
-        util.subp(cmd)
+    if info['id'] in CREATED_LVOLS:
+        LOG.debug('lvm_partition %s created with its volgroup', name)
+    else:
+        if create_lv:
+            util.subp(lvm_partition_create_cmd(info, volgroup))
+            lvm.invalidate()
 
-    # refresh lvmetad
-    lvm.lvm_scan()
+        # refresh lvmetad
+        lvm.lvm_scan()
 
     wipe_mode = info.get('wipe', 'superblock')
     if wipe_mode and create_lv:
@@ -1422,7 +1886,7 @@ def lvm_partition_handler(info, storage_config, handlers):
         LOG.debug('Wiping logical volume %s mode=%s', lv_path, wipe_mode)
         block.wipe_volume(lv_path, mode=wipe_mode, exclusive=False)
 
-    make_dname(info['id'], storage_config)
+    DNAME_VOLUMES.append(info['id'])
 
 
 def verify_blkdev_used(dmcrypt_dev, expected_blkdev):
@@ -1441,6 +1905,145 @@ def dm_crypt_verify(dmcrypt_dev, volume_path):
     verify_blkdev_used(dmcrypt_dev, volume_path)
 
 
+def cryptsetup_capabilities():
+    """Return the options and defaults of the installed cryptsetup.
+
+    The result is parsed from cryptsetup --help once per block-meta run and
+    has the keys 'luks_type' (the luksFormat default, luks1 or luks2),
+    'pbkdf' (default pbkdf per luks type), 'pbkdf_options' (True if
+    --pbkdf and friends are known) and 'perf' (supported --perf-* flags).
+    """
+    if CRYPTSETUP_CAPABILITIES:
+        return CRYPTSETUP_CAPABILITIES
+    caps = {'luks_type': 'luks1', 'pbkdf': {'luks1': 'pbkdf2'},
+            'pbkdf_options': False, 'perf': set()}
+    try:
+        out, _err = util.subp(['cryptsetup', '--help'], capture=True)
+    except util.ProcessExecutionError as e:
+        LOG.warning('Failed to query cryptsetup options: %s', e)
+        out = ''
+    for line in out.splitlines():
+        line = line.strip()
+        match = re.match(r'Default PBKDF for (LUKS\d): (\w+)', line)
+        if match:
+            caps['pbkdf'][match.group(1).lower()] = match.group(2).lower()
+            continue
+        match = re.match(r'Default compiled-in metadata format is (LUKS\d)',
+                         line)
+        if match:
+            caps['luks_type'] = match.group(1).lower()
+            continue
+        if '--pbkdf-force-iterations' in line:
+            caps['pbkdf_options'] = True
+        for flag in re.findall(r'--perf-(\w+)', line):
+            caps['perf'].add(flag)
+    CRYPTSETUP_CAPABILITIES.update(caps)
+    return CRYPTSETUP_CAPABILITIES
+
+
+def cryptsetup_pbkdf_benchmark(pbkdf, iter_time=None, pbkdf_memory=None):
+    """Benchmark pbkdf once and return luksFormat options reusing the result.
+
+    luksFormat benchmarks the key derivation function of every volume it
+    formats.  When several volumes are formatted with the same settings,
+    the cost parameters measured here are passed to each luksFormat with
+    --pbkdf-force-iterations instead.  Returns None if the benchmark fails
+    or its output is not understood, luksFormat then measures on its own.
+    """
+    key = (pbkdf, iter_time, pbkdf_memory)
+    if key in PBKDF_BENCHMARKS:
+        return PBKDF_BENCHMARKS[key]
+
+    cmd = ['cryptsetup', 'benchmark', '--pbkdf', pbkdf]
+    if iter_time:
+        cmd.extend(['--iter-time', str(iter_time)])
+    if pbkdf_memory:
+        cmd.extend(['--pbkdf-memory', str(pbkdf_memory)])
+    options = None
+    try:
+        out, _err = util.subp(cmd, capture=True)
+    except util.ProcessExecutionError as e:
+        LOG.warning('cryptsetup benchmark of %s failed: %s', pbkdf, e)
+        out = ''
+    for line in out.splitlines():
+        match = re.match(r'\s*PBKDF2-\S+\s+(\d+) iterations per second',
+                         line)
+        if match and pbkdf == 'pbkdf2':
+            per_second = int(match.group(1))
+            iterations = per_second * (
+                iter_time or CRYPTSETUP_DEFAULT_ITER_TIME) // 1000
+            iterations = max(iterations, PBKDF2_MIN_ITERATIONS)
+            options = ['--pbkdf', pbkdf,
+                       '--pbkdf-force-iterations', str(iterations)]
+            break
+        match = re.match(r'\s*(argon2id?)\s+(\d+) iterations, (\d+) memory, '
+                         r'(\d+) parallel', line)
+        if match and match.group(1) == pbkdf:
+            options = ['--pbkdf', pbkdf,
+                       '--pbkdf-force-iterations', match.group(2),
+                       '--pbkdf-memory', match.group(3),
+                       '--pbkdf-parallel', match.group(4)]
+            break
+    if options:
+        LOG.debug('Reusing %s benchmark for luksFormat: %s', pbkdf, options)
+    else:
+        LOG.debug('No usable %s benchmark, luksFormat measures per volume',
+                  pbkdf)
+    PBKDF_BENCHMARKS[key] = options
+    return options
+
+
+def dm_crypt_format_options(info, storage_config):
+    """Return the key derivation and sector options for luksFormat."""
+    pbkdf = info.get('pbkdf')
+    pbkdf_memory = info.get('pbkdf-memory')
+    iter_time = info.get('iter-time')
+    sector_size = info.get('sector-size')
+
+    options = []
+    luks2 = bool(sector_size or pbkdf_memory or
+                 (pbkdf and pbkdf.startswith('argon2')))
+    if luks2:
+        options.extend(['--type', 'luks2'])
+    if sector_size:
+        options.extend(['--sector-size', str(sector_size)])
+
+    formatted = [item for item in storage_config.values()
+                 if item.get('type') == 'dm_crypt' and
+                 not config.value_as_boolean(item.get('preserve'))]
+    if len(formatted) > 1:
+        caps = cryptsetup_capabilities()
+        if caps['pbkdf_options']:
+            luks_type = 'luks2' if luks2 else caps['luks_type']
+            if not pbkdf:
+                pbkdf = caps['pbkdf'].get(luks_type, 'pbkdf2')
+            benchmark = cryptsetup_pbkdf_benchmark(pbkdf, iter_time,
+                                                   pbkdf_memory)
+            if benchmark:
+                return options + benchmark
+
+    if pbkdf:
+        options.extend(['--pbkdf', pbkdf])
+    if pbkdf_memory:
+        options.extend(['--pbkdf-memory', str(pbkdf_memory)])
+    if iter_time:
+        options.extend(['--iter-time', str(iter_time)])
+    return options
+
+
+def dm_crypt_perf_flags(info):
+    """Return the configured dm-crypt perf flags cryptsetup supports."""
+    flags = info.get('perf', [])
+    if not flags:
+        return []
+    supported = cryptsetup_capabilities()['perf']
+    for flag in flags:
+        if flag not in supported:
+            LOG.warning('cryptsetup does not support --perf-%s, ignoring it',
+                        flag)
+    return [flag for flag in flags if flag in supported]
+
+
 def dm_crypt_handler(info, storage_config, handlers):
     state = util.load_command_environment(strict=True)
     volume = info.get('volume')
@@ -1472,6 +2075,8 @@ def dm_crypt_handler(info, storage_config, handlers):
     else:
         raise ValueError("encryption key or keyfile must be specified")
 
+    perf_flags = dm_crypt_perf_flags(info)
+
     create_dmcrypt = True
     if preserve:
         dm_crypt_verify(dmcrypt_dev, volume_path)
@@ -1514,11 +2119,13 @@ def dm_crypt_handler(info, storage_config, handlers):
                 cmd.extend(["--cipher", cipher])
             if keysize:
                 cmd.extend(["--key-size", keysize])
+            cmd.extend(dm_crypt_format_options(info, storage_config))
             cmd.extend(["luksFormat", volume_path, keyfile])
             util.subp(cmd)
 
         cmd = ["cryptsetup", "open", "--type", luks_type, volume_path, dm_name,
                "--key-file", keyfile]
+        cmd.extend(["--perf-" + flag for flag in perf_flags])
 
         util.subp(cmd)
 
@@ -1541,8 +2148,11 @@ def dm_crypt_handler(info, storage_config, handlers):
         state_dir = os.path.dirname(state['fstab'])
         crypt_tab_location = os.path.join(state_dir, "crypttab")
         uuid = block.get_volume_uuid(volume_path)
+        options = ["luks"] + [flag.replace('_', '-') for flag in perf_flags]
         util.write_file(crypt_tab_location,
-                        "%s UUID=%s none luks\n" % (dm_name, uuid), omode="a")
+                        "%s UUID=%s none %s\n" % (dm_name, uuid,
+                                                  ",".join(options)),
+                        omode="a")
     else:
         LOG.info("fstab configuration is not present in environment, so \
             cannot locate an appropriate directory to write crypttab in \
@@ -1583,6 +2193,42 @@ def raid_verify(md_devname, raidlevel, device_paths, spare_paths, container):
         md_devname, raidlevel, device_paths, spare_paths, container)
 
 
+def raid_apply_resync_policy(md_devname, resync, info, state):
+    """Throttle or wait for the initial resync of a newly created array."""
+    if resync == 'throttle':
+        speed = int(info.get('sync_speed_max', mdadm.DEFAULT_SYNC_SPEED_MAX))
+        previous = mdadm.md_set_sync_speed_max(md_devname, speed)
+        if previous is None:
+            return
+        if state['fstab']:
+            # restored by curtin install once the install has finished
+            mdadm.md_record_sync_speed(
+                os.path.join(os.path.dirname(state['fstab']),
+                             mdadm.SYNC_SPEED_STATE_FILE),
+                md_devname, previous)
+        else:
+            LOG.warning('raid %s: no install state directory, '
+                        'sync_speed_max stays at %s', md_devname, speed)
+    elif resync == 'wait':
+        event_name = '/'.join(
+            filter(None, (state.get('report_stack_prefix'), info['id'],
+                          'resync')))
+        reported = {}
+
+        def progress(completed, total):
+            percent = int(completed * 100 / total) if total else 0
+            if reported.get('percent') != percent:
+                reported['percent'] = percent
+                events.report_progress_event(
+                    event_name, 'resync of %s %d%% complete' % (md_devname,
+                                                                percent))
+
+        with events.ReportEventStack(
+                name=event_name, reporting_enabled=True, level='INFO',
+                description='waiting for resync of %s' % md_devname):
+            mdadm.md_block_until_in_sync(md_devname, progress=progress)
+
+
 def raid_handler(info, storage_config, handlers):
     state = util.load_command_environment(strict=True)
     devices = info.get('devices')
@@ -1629,10 +2275,26 @@ def raid_handler(info, storage_config, handlers):
         LOG.debug('raid %s already present, skipping create', md_devname)
         create_raid = False
 
+    resync = info.get('resync', 'resync')
     if create_raid:
+        assume_clean = False
+        if resync == 'assume-clean':
+            members = (devices or []) + (spare_devices or [])
+            zeroed = bool(members) and all(
+                storage_config[member].get('wipe') == 'zero'
+                for member in members)
+            assume_clean = (not container and
+                            mdadm.md_assume_clean_safe(raidlevel, zeroed))
+            if not assume_clean:
+                LOG.info('raid %s: skipping the initial resync of raidlevel '
+                         '%s is not safe, throttling it instead',
+                         md_devname, raidlevel)
+                resync = 'throttle'
         mdadm.mdadm_create(md_devname, raidlevel,
                            device_paths, spare_device_paths, container_dev,
-                           info.get('mdname', ''), metadata)
+                           info.get('mdname', ''), metadata,
+                           assume_clean=assume_clean)
+        raid_apply_resync_policy(md_devname, resync, info, state)
 
     wipe_mode = info.get('wipe')
     if wipe_mode:
@@ -1646,7 +2308,7 @@ def raid_handler(info, storage_config, handlers):
             block.wipe_volume(md_devname, mode=wipe_mode, exclusive=False)
 
     # Make dname rule for this dev
-    make_dname(info.get('id'), storage_config)
+    DNAME_VOLUMES.append(info.get('id'))
 
     # A mdadm.conf will be created in the same directory as the fstab in the
     # configuration. This will then be copied onto the installed system later.
@@ -1759,12 +2421,27 @@ def bcache_handler(info, storage_config, handlers):
             LOG.debug('bcache %s already present, skipping create', info['id'])
 
     cset_uuid = bcache_dev = None
+    if info['id'] in CREATED_BCACHES:
+        bcache_dev = CREATED_BCACHES[info['id']]
+        LOG.debug('bcache %s created along with its cache set siblings',
+                  info['id'])
+        create_bcache = False
+
     if create_bcache and cache_device:
-        cset_uuid = bcache.create_cache_device(cache_device)
+        cset_uuid = BCACHE_CACHE_SETS.get(info['cache_device'])
+        if not cset_uuid:
+            cset_uuid = bcache.create_cache_device(cache_device)
+            BCACHE_CACHE_SETS[info['cache_device']] = cset_uuid
 
     if create_bcache and backing_device:
-        bcache_dev = bcache.create_backing_device(backing_device, cache_device,
-                                                  cache_mode, cset_uuid)
+        batch = [(info['id'], backing_device, cache_mode)]
+        batch.extend(bcache_siblings(info, storage_config))
+        bcache_devs = bcache.create_backing_devices(
+            [(path, mode) for _, path, mode in batch], cache_device,
+            cset_uuid)
+        for (item_id, _, _), dev in zip(batch, bcache_devs):
+            CREATED_BCACHES[item_id] = dev
+        bcache_dev = CREATED_BCACHES[info['id']]
 
     if cache_mode and not backing_device:
         raise ValueError("cache mode specified which can only be set on "
@@ -1777,7 +2454,7 @@ def bcache_handler(info, storage_config, handlers):
 
     if info.get('name'):
         # Make dname rule for this dev
-        make_dname(info.get('id'), storage_config)
+        DNAME_VOLUMES.append(info.get('id'))
 
     if info.get('ptable'):
         handlers['disk'](info, storage_config, handlers)
@@ -1786,6 +2463,28 @@ def bcache_handler(info, storage_config, handlers):
               backing_device, cache_device)
 
 
+def bcache_siblings(info, storage_config):
+    """Return (id, backing device path, cache mode) for each bcache item
+       which can be created together with bcache item info.
+
+       These are the bcache items on the same cache device which are not
+       preserved and whose backing device is already configured.
+    """
+    siblings = []
+    for item_id, item in storage_config.items():
+        if (item_id == info['id'] or item.get('type') != 'bcache' or
+                item.get('cache_device') != info.get('cache_device') or
+                item_id in CREATED_BCACHES or
+                item.get('backing_device') not in CONFIGURED_ITEMS or
+                config.value_as_boolean(item.get('preserve'))):
+            continue
+        siblings.append((item_id,
+                         get_path_to_storage_volume(item['backing_device'],
+                                                    storage_config),
+                         item.get('cache_mode', None)))
+    return siblings
+
+
 def zpool_handler(info, storage_config, handlers):
     """
     Create a zpool based in storage_configuration
@@ -1800,12 +2499,18 @@ def zpool_handler(info, storage_config, handlers):
     poolname = info.get('pool')
     mountpoint = info.get('mountpoint')
     pool_properties = info.get('pool_properties', {})
-    fs_properties = info.get('fs_properties', {})
+    fs_properties = zfs.zfs_profile_properties(info.get('profile'),
+                                               info.get('fs_properties', {}),
+                                               pool_properties)
     altroot = state['target']
 
     if not vdevs or not poolname:
         raise ValueError("pool and vdevs for zpool must be specified")
 
+    if 'ashift' not in pool_properties:
+        pool_properties = dict(pool_properties,
+                               ashift=zfs.zpool_ashift(vdevs))
+
     # map storage volume to by-id path for persistent path
     vdevs_byid = []
     for vdev in vdevs:
@@ -1825,6 +2530,22 @@ def zpool_handler(info, storage_config, handlers):
                      zfs_properties=fs_properties)
 
 
+def _zfs_dataset_path(volume):
+    return os.path.normpath('/' + volume.lstrip('/'))
+
+
+def get_zfs_datasets(poolname, storage_config):
+    """ Return the set of dataset paths the storage config creates in the
+        pool poolname.  The config is scanned once per block-meta run."""
+    if not ZFS_DATASETS:
+        for item in storage_config.values():
+            if item.get('type') == 'zfs':
+                ZFS_DATASETS.setdefault(
+                    get_poolname(item, storage_config), set()).add(
+                        _zfs_dataset_path(item.get('volume', '')))
+    return ZFS_DATASETS.get(poolname, set())
+
+
 def zfs_handler(info, storage_config, handlers):
     """
     Create a zfs filesystem
@@ -1834,11 +2555,19 @@ def zfs_handler(info, storage_config, handlers):
     state = util.load_command_environment(strict=True)
     poolname = get_poolname(info, storage_config)
     volume = info.get('volume')
-    properties = info.get('properties', {})
+    pool = storage_config.get(info.get('pool')) or {}
+    properties = zfs.zfs_profile_properties(info.get('profile'),
+                                            info.get('properties', {}),
+                                            pool.get('pool_properties'))
 
     LOG.info('Creating zfs dataset %s/%s with properties %s',
              poolname, volume, properties)
-    zfs.zfs_create(poolname, volume, zfs_properties=properties)
+    # parents of the dataset which are not in the storage config need no
+    # item of their own, configured parents are created before it
+    parent = os.path.dirname(_zfs_dataset_path(volume))
+    zfs.zfs_create(poolname, volume, zfs_properties=properties,
+                   parents=parent not in
+                   get_zfs_datasets(poolname, storage_config) | set(['/']))
 
     mountpoint = properties.get('mountpoint')
     if mountpoint:
@@ -1936,7 +2665,7 @@ def zfsroot_update_storage_config(storage_config):
             'id': baseid + "_zfsroot_pool",
             'pool': 'rpool',
             'vdevs': vdevs,
-            'mountpoint': '/'
+            'mountpoint': '/',
         }
         container = {
             'type': 'zfs',
@@ -1968,11 +2697,58 @@ def zfsroot_update_storage_config(storage_config):
     return ret
 
 
-def meta_clear(devices, report_prefix=''):
+def get_storage_config_graph(storage_config):
+    """Return an OrderedDict mapping each storage config id to the set of
+       ids which must be configured before it.
+
+       Besides the ids an item references, each item depends upon the
+       previous item (in config order) built on any of the same underlying
+       disks, so every disk is still configured in config order.  Mounts
+       additionally depend upon the previous mount.  Only earlier items are
+       ever depended upon, so running the graph serially in order matches
+       the config order.
+
+    :param: storage_config: Ordered dict of storage configation
+    """
+    dasds = dict((item.get('device_id'), item_id)
+                 for item_id, item in storage_config.items()
+                 if item.get('type') == 'dasd')
+    graph = OrderedDict()
+    roots = {}
+    last_in_chain = {}
+    for item_id, item in storage_config.items():
+        deps = set(dep for dep in get_item_direct_dependencies(item)
+                   if dep in graph)
+        dasd_id = dasds.get(item.get('device_id'))
+        if item.get('type') == 'disk' and dasd_id in graph:
+            deps.add(dasd_id)
+
+        item_roots = set()
+        for dep in deps:
+            item_roots.update(roots[dep])
+        if not item_roots:
+            item_roots = set([item_id])
+        roots[item_id] = item_roots
+
+        chains = [('disk', root) for root in item_roots]
+        if item.get('type') == 'mount':
+            chains.append(('mount',))
+        for chain in chains:
+            if chain in last_in_chain:
+                deps.add(last_in_chain[chain])
+            last_in_chain[chain] = item_id
+
+        graph[item_id] = deps
+
+    return graph
+
+
+def meta_clear(devices, report_prefix='', workers=1):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: workers: the number of storage stacks to shut down concurrently
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
@@ -1980,8 +2756,8 @@ def meta_clear(devices, report_prefix=''):
             name=report_prefix + '/clear-holders',
             reporting_enabled=True, level='INFO',
             description="removing previous storage devices"):
-        clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        clear_holders.start_clear_holders_deps(devices)
+        clear_holders.clear_holders(devices, workers=int(workers))
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(devices)
 
@@ -2028,17 +2804,52 @@ def meta_custom(args):
             'partition': partition_handler_v2,
             })
 
-    storage_config_dict = zfsroot_update_storage_config(storage_config_dict)
+    storage_config_dict = IndexedStorageConfig(
+        zfsroot_update_storage_config(storage_config_dict))
+    PTABLE_CACHE.clear()
+    CREATED_LVOLS.clear()
+    CRYPTSETUP_CAPABILITIES.clear()
+    PBKDF_BENCHMARKS.clear()
+    FORMATTED_DASDS.clear()
+    BCACHE_CACHE_SETS.clear()
+    CREATED_BCACHES.clear()
+    CONFIGURED_ITEMS.clear()
+    del DNAME_VOLUMES[:]
+    del FSTAB_ENTRIES[:]
+    ZFS_DATASETS.clear()
+    INSTALL_MOUNT_POLICY.clear()
+    INSTALL_MOUNT_POLICY.update(get_install_mount_policy(
+        cfg.get('block-meta', {}).get('install-mount-options')))
+    MKFS_TUNING['enabled'] = config.value_as_boolean(
+        cfg.get('block-meta', {}).get('mkfs-tuning', False))
 
     # set up reportstack
     stack_prefix = state.get('report_stack_prefix', '')
 
-    for item_id, command in storage_config_dict.items():
+    # log in to all iSCSI disks together instead of one by one as their
+    # paths are looked up
+    iscsi.connect_disks(iscsi.get_iscsi_volumes_from_config(cfg))
+
+    format_dasds(storage_config_dict,
+                 workers=cfg.get('block-meta', {}).get(
+                     'dasd-format-workers', DASD_FORMAT_WORKERS),
+                 stack_prefix=stack_prefix)
+
+    # independent disks (and what is built on them) may be configured
+    # concurrently, each item gets its own event name so start and finish
+    # events of concurrent items pair up.
+    workers = int(cfg.get('block-meta', {}).get('workers', 1))
+
+    def handle_item(item_id):
+        command = storage_config_dict[item_id]
         handler = command_handlers.get(command['type'])
         if not handler:
             raise ValueError("unknown command type '%s'" % command['type'])
+        event_name = stack_prefix
+        if workers > 1:
+            event_name = '/'.join(filter(None, (stack_prefix, item_id)))
         with events.ReportEventStack(
-                name=stack_prefix, reporting_enabled=True, level="INFO",
+                name=event_name, reporting_enabled=True, level="INFO",
                 description="configuring %s: %s" % (command['type'],
                                                     command['id'])):
             try:
@@ -2047,6 +2858,17 @@ def meta_custom(args):
                 LOG.error("An error occured handling '%s': %s - %s" %
                           (item_id, type(error).__name__, error))
                 raise
+            CONFIGURED_ITEMS.add(item_id)
+
+    def handler_lock(item_id):
+        return HANDLER_LOCK_GROUPS.get(storage_config_dict[item_id]['type'])
+
+    LOG.debug('block-meta: configuring storage with %s worker(s)', workers)
+    util.run_dependency_graph(get_storage_config_graph(storage_config_dict),
+                              handle_item, workers=workers,
+                              lock_key=handler_lock)
+
+    write_dnames_and_fstab(storage_config_dict, state.get('fstab'))
 
     if args.testmode:
         util.subp(['losetup', '--detach'] + list(DEVS))
@@ -1,15 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import sys
+from collections import OrderedDict
+
 import curtin.block as block
 from . import populate_one_subcmd
 from .. import log
+from .. import util
 
 LOG = log.LOG
 
 
 def wipe_main(args):
-    for blockdev in args.devices:
+    def wipe(blockdev):
         try:
             LOG.debug('Wiping volume %s with mode=%s', blockdev, args.mode)
             block.wipe_volume(blockdev, mode=args.mode)
@@ -17,7 +20,16 @@ def wipe_main(args):
             sys.stderr.write(
                 "Failed to wipe volume %s in mode %s: %s" %
                 (blockdev, args.mode, e))
-            sys.exit(1)
+            raise
+
+    # the devices do not depend on each other, up to 'workers' of them are
+    # wiped at the same time
+    try:
+        util.run_dependency_graph(
+            OrderedDict((blockdev, []) for blockdev in args.devices), wipe,
+            workers=args.workers)
+    except Exception:
+        sys.exit(1)
     sys.exit(0)
 
 
@@ -25,7 +37,11 @@ CMD_ARGUMENTS = (
     ((('-m', '--mode'),
       {'help': 'mode for wipe.', 'action': 'store',
        'default': 'superblock',
-       'choices': ['zero', 'superblock', 'superblock-recursive', 'random']}),
+       'choices': ['zero', 'superblock', 'superblock-recursive', 'random',
+                   'discard']}),
+     (('-w', '--workers'),
+      {'help': 'number of devices to wipe at the same time',
+       'default': 1, 'type': int}),
      ('devices',
       {'help': 'devices to wipe', 'default': [], 'nargs': '+'}),
      )
@@ -11,7 +11,7 @@ import subprocess
 import sys
 import tempfile
 
-from curtin.block import iscsi, zfs
+from curtin.block import iscsi, mdadm, zfs
 from curtin import config
 from curtin import distro
 from curtin import util
@@ -21,6 +21,8 @@ from curtin.log import LOG, logged_time
 from curtin.reporter.legacy import load_reporter
 from curtin.reporter import events
 from . import populate_one_subcmd
+from .block_meta import (INSTALL_MOUNTS_STATE_FILE,
+                         restore_install_mount_options)
 
 INSTALL_LOG = "/var/log/curtin/install.log"
 # Upon error, curtin creates a tar of all related logs at ERROR_TARFILE
@@ -478,6 +480,22 @@ def cmd_install(args):
             create_log_tarfile(error_tarfile, cfg)
         raise e
     finally:
+        if workingd:
+            # let arrays whose resync was throttled for the install
+            # resync at full speed again.
+            mdadm.md_restore_sync_speed(
+                os.path.join(os.path.dirname(workingd.fstab),
+                             mdadm.SYNC_SPEED_STATE_FILE))
+            # sync and remount what block-meta mounted with install mount
+            # options with the final options from the storage config.  A
+            # failure here must not hide the outcome of the install.
+            try:
+                restore_install_mount_options(
+                    os.path.join(os.path.dirname(workingd.fstab),
+                                 INSTALL_MOUNTS_STATE_FILE))
+            except Exception as e:
+                LOG.warning('Failed to restore final mount options: %s', e)
+
         log_target_path = instcfg.get('save_install_log', SAVE_INSTALL_LOG)
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
@@ -10,9 +10,10 @@ CMD_ARGUMENTS = (
      {'help': 'apply storage config validator to config file',
       'action': 'store_true', 'required': True}),
     (('-c', '--config'),
-     {'help': 'path to configuration file to validate.',
-      'required': True, 'metavar': 'FILE', 'action': 'store',
-      'dest': 'schema_cfg'}),
+     {'help': ('path to configuration file to validate. May be given '
+               'more than once, or with several files.'),
+      'required': True, 'metavar': 'FILE', 'action': 'append',
+      'nargs': '+', 'dest': 'schema_cfg'}),
 )
 
 
@@ -30,10 +31,11 @@ def schema_validate_storage(confpath):
 def schema_validate_main(args):
     errors = []
     if args.storage:
-        sys.stdout.write(
-            'Validating storage config in %s:\n' % args.schema_cfg)
-        if schema_validate_storage(args.schema_cfg) != 0:
-            errors.append('storage')
+        for confpath in [path for paths in args.schema_cfg for path in paths]:
+            sys.stdout.write(
+                'Validating storage config in %s:\n' % confpath)
+            if schema_validate_storage(confpath) != 0:
+                errors.append(confpath)
 
     return len(errors)
 
@@ -15,6 +15,7 @@ from . import instantiated_handler_registry
 FINISH_EVENT_TYPE = 'finish'
 START_EVENT_TYPE = 'start'
 RESULT_EVENT_TYPE = 'result'
+PROGRESS_EVENT_TYPE = 'progress'
 
 DEFAULT_EVENT_ORIGIN = 'curtin'
 
@@ -128,6 +129,17 @@ def report_start_event(event_name, event_description, level=None):
     return report_event(event)
 
 
+def report_progress_event(event_name, event_description, level=None):
+    """Report a "progress" event for a long running operation.
+
+    Progress events may be sent any number of times between the start and
+    finish events of event_name, see :py:func:`report_start_event`.
+    """
+    event = ReportingEvent(PROGRESS_EVENT_TYPE, event_name, event_description,
+                           level=level)
+    return report_event(event)
+
+
 class ReportEventStack(object):
     """Context Manager for using :py:func:`report_event`
 
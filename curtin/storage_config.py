@@ -1,5 +1,6 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 from collections import namedtuple, OrderedDict
+import bisect
 import copy
 import operator
 import os
@@ -43,22 +44,25 @@ MBR_BOOT_FLAG = '0x80'
 
 PTABLE_TYPE_MAP = dict(GPT_GUID_TO_CURTIN_MAP, **MBR_TYPE_TO_CURTIN_MAP)
 
-StorageConfig = namedtuple('StorageConfig', ('type', 'schema'))
+StorageConfigType = namedtuple('StorageConfigType', ('type', 'schema'))
+# the previous name of StorageConfigType
+StorageConfig = StorageConfigType
 STORAGE_CONFIG_TYPES = {
-    'bcache': StorageConfig(type='bcache', schema=schemas.BCACHE),
-    'dasd': StorageConfig(type='dasd', schema=schemas.DASD),
-    'disk': StorageConfig(type='disk', schema=schemas.DISK),
-    'dm_crypt': StorageConfig(type='dm_crypt', schema=schemas.DM_CRYPT),
-    'format': StorageConfig(type='format', schema=schemas.FORMAT),
-    'lvm_partition': StorageConfig(type='lvm_partition',
-                                   schema=schemas.LVM_PARTITION),
-    'lvm_volgroup': StorageConfig(type='lvm_volgroup',
-                                  schema=schemas.LVM_VOLGROUP),
-    'mount': StorageConfig(type='mount', schema=schemas.MOUNT),
-    'partition': StorageConfig(type='partition', schema=schemas.PARTITION),
-    'raid': StorageConfig(type='raid', schema=schemas.RAID),
-    'zfs': StorageConfig(type='zfs', schema=schemas.ZFS),
-    'zpool': StorageConfig(type='zpool', schema=schemas.ZPOOL),
+    'bcache': StorageConfigType(type='bcache', schema=schemas.BCACHE),
+    'dasd': StorageConfigType(type='dasd', schema=schemas.DASD),
+    'disk': StorageConfigType(type='disk', schema=schemas.DISK),
+    'dm_crypt': StorageConfigType(type='dm_crypt', schema=schemas.DM_CRYPT),
+    'format': StorageConfigType(type='format', schema=schemas.FORMAT),
+    'lvm_partition': StorageConfigType(type='lvm_partition',
+                                       schema=schemas.LVM_PARTITION),
+    'lvm_volgroup': StorageConfigType(type='lvm_volgroup',
+                                      schema=schemas.LVM_VOLGROUP),
+    'mount': StorageConfigType(type='mount', schema=schemas.MOUNT),
+    'partition': StorageConfigType(type='partition',
+                                   schema=schemas.PARTITION),
+    'raid': StorageConfigType(type='raid', schema=schemas.RAID),
+    'zfs': StorageConfigType(type='zfs', schema=schemas.ZFS),
+    'zpool': StorageConfigType(type='zpool', schema=schemas.ZPOOL),
 }
 
 
@@ -102,38 +106,87 @@ def load_and_validate(config_path):
     return validate_config(config.get('storage'), sourcefile=config_path)
 
 
+# the storage config schema with the config items only required to have a
+# type; each item is instead validated against the schema of its type.
+_STORAGE_CONFIG_ITEMS_SCHEMA = copy.deepcopy(STORAGE_CONFIG_SCHEMA)
+_STORAGE_CONFIG_ITEMS_SCHEMA['properties']['config']['items'] = {
+    'type': 'object',
+    'required': ['type'],
+}
+
+_SCHEMA_VALIDATORS = {}
+
+
+def _get_schema_validator(stype=None):
+    """ Return a jsonschema validator for the schema of storage type stype,
+        or for the storage config itself if stype is None.  Each validator
+        is built, and its schema checked, only once.
+    """
+    validator = _SCHEMA_VALIDATORS.get(stype)
+    if validator is None:
+        try:
+            import jsonschema
+        except ImportError:
+            LOG.error('Cannot validate storage config, missing jsonschema')
+            raise
+        if stype is None:
+            schema = _STORAGE_CONFIG_ITEMS_SCHEMA
+        else:
+            schema = STORAGE_CONFIG_TYPES[stype].schema
+        validator_cls = jsonschema.validators.validator_for(schema)
+        validator_cls.check_schema(schema)
+        validator = validator_cls(schema)
+        _SCHEMA_VALIDATORS[stype] = validator
+    return validator
+
+
+def _schema_error(validator, instance):
+    """ Return the most relevant schema error for instance or None."""
+    from jsonschema.exceptions import best_match
+    return best_match(validator.iter_errors(instance))
+
+
+def _is_storage_item(config):
+    return (isinstance(config, dict) and 'type' in config and
+            'config' not in config and 'version' not in config)
+
+
+def _validate_storage_item(item, sourcefile):
+    item_type = item['type']
+    if not isinstance(item_type, util.string_types) or \
+            item_type not in STORAGE_CONFIG_TYPES:
+        msg = "Unknown storage type: %s in %s" % (item_type, item)
+        raise ValueError(msg)
+
+    error = _schema_error(_get_schema_validator(item_type), item)
+    if error is not None:
+        msg = "%s in %s\n%s" % (error.message, sourcefile,
+                                util.json_dumps(item))
+        raise ValueError(msg)
+
+
 def validate_config(config, sourcefile=None):
-    """Validate storage config object."""
+    """Validate storage config object.
+
+    config may be a storage config or a single storage config item.
+    """
     if not sourcefile:
         sourcefile = ''
-    try:
-        import jsonschema
-        jsonschema.validate(config, STORAGE_CONFIG_SCHEMA)
-    except ImportError:
-        LOG.error('Cannot validate storage config, missing jsonschema')
-        raise
-    except jsonschema.exceptions.ValidationError as e:
+
+    if _is_storage_item(config):
+        return _validate_storage_item(config, sourcefile)
+
+    e = _schema_error(_get_schema_validator(), config)
+    if e is not None:
         if isinstance(e.instance, int):
             msg = 'Unexpected value (%s) for property "%s"' % (e.path[0],
                                                                e.instance)
             raise ValueError(msg)
-        if 'type' not in e.instance:
-            msg = "%s in %s" % (e.message, e.instance)
-            raise ValueError(msg)
+        msg = "%s in %s" % (e.message, e.instance)
+        raise ValueError(msg)
 
-        instance_type = e.instance['type']
-        stype = get_storage_types().get(instance_type)
-        if stype:
-            try:
-                jsonschema.validate(e.instance, stype.schema)
-            except jsonschema.exceptions.ValidationError as f:
-                msg = "%s in %s\n%s" % (f.message, sourcefile,
-                                        util.json_dumps(e.instance))
-                raise(ValueError(msg))
-        else:
-            msg = "Unknown storage type: %s in %s" % (instance_type,
-                                                      e.instance)
-            raise ValueError(msg)
+    for item in config['config']:
+        _validate_storage_item(item, sourcefile)
 
 
 # FIXME: move this map to each types schema and extract these
@@ -171,6 +224,28 @@ def _stype_to_deps(stype):
     return depends_keys[stype]
 
 
+def get_item_direct_dependencies(item_cfg):
+    """ Return a list of the storage_config ids that item_cfg references.
+
+        Only the item's own references are returned, not those of the
+        items it references.  Unknown storage types have no dependencies.
+    """
+    try:
+        dep_keys = _stype_to_deps(item_cfg.get('type'))
+    except KeyError:
+        return []
+
+    deps = []
+    for dep_key in sorted(dep_keys):
+        dep_value = item_cfg.get(dep_key)
+        if not dep_value:
+            continue
+        if not isinstance(dep_value, list):
+            dep_value = [dep_value]
+        deps.extend(dep_value)
+    return deps
+
+
 def _stype_to_order_key(stype):
     default_sort = {'id'}
     order_key = {
@@ -248,49 +323,147 @@ def _validate_dep_type(source_id, dep_key, dep_id, sconfig):
     return result
 
 
-def find_item_dependencies(item_id, config, validate=True):
-    """ Walk a storage config collecting any dependent device ids."""
-
-    if not config or not isinstance(config, OrderedDict):
-        raise ValueError('Invalid config. Must be non-empty OrderedDict')
-
-    item_cfg = config.get(item_id)
-    if not item_cfg:
-        return None
+class _DependencyResolver(object):
+    """ Resolve storage config dependencies against an index of the config.
 
-    def _find_same_dep(dep_key, dep_value, config):
-        return [item_id for item_id, item_cfg in config.items()
-                if item_cfg.get(dep_key) == dep_value]
-
-    deps = []
-    item_type = item_cfg.get('type')
-    item_order = _stype_to_order_key(item_type)
-    for dep_key in _stype_to_deps(item_type):
-        if dep_key in item_cfg:
-            dep_value = item_cfg[dep_key]
-            if not isinstance(dep_value, list):
-                dep_value = [dep_value]
-            deps.extend(dep_value)
-            for dep in dep_value:
-                if validate:
-                    _validate_dep_type(item_id, dep_key, dep, config)
-
-                # find other items with the same dep_key, dep_value
-                same_deps = _find_same_dep(dep_key, dep, config)
-                sdeps_cfgs = [cfg for sdep, cfg in config.items()
-                              if sdep in same_deps]
-                sorted_deps = (
-                    sorted(sdeps_cfgs,
-                           key=operator.itemgetter(*list(item_order))))
-                for sdep in sorted_deps:
-                    deps.append(sdep['id'])
+        Items are indexed by the values of their dependency keys so that
+        items sharing a dependency are found without rescanning the whole
+        config, and each item's dependencies are computed only once.
+    """
 
+    def __init__(self, config):
+        if not config or not isinstance(config, OrderedDict):
+            raise ValueError('Invalid config. Must be non-empty OrderedDict')
+        self.config = config
+        self._deps = {}
+        self._trees = {}
+        self._siblings = {}
+        self._resolving = set()
+
+        # (dep_key, dep_value) -> [item_id, ...] in config order
+        self._index = {}
+        dep_keys = set()
+        for stype in STORAGE_CONFIG_TYPES:
+            dep_keys.update(_stype_to_deps(stype))
+        for item_id, item_cfg in config.items():
+            for dep_key in dep_keys:
+                dep_value = item_cfg.get(dep_key)
+                if dep_value is None or not _is_hashable(dep_value):
+                    continue
+                self._index.setdefault(
+                    (dep_key, dep_value), []).append(item_id)
+
+    def _find_same_dep(self, dep_key, dep_value):
+        if dep_value is None or not _is_hashable(dep_value):
+            return [item_id for item_id, item_cfg in self.config.items()
+                    if item_cfg.get(dep_key) == dep_value]
+        return self._index.get((dep_key, dep_value), [])
+
+    def _sorted_same_deps(self, dep_key, dep_value, item_type):
+        """ Return ids of items with the same dep_key, dep_value sorted by
+            the order key of item_type. """
+        cache_key = None
+        if _is_hashable(dep_value):
+            cache_key = (dep_key, dep_value, item_type)
+            if cache_key in self._siblings:
+                return self._siblings[cache_key]
+        item_order = _stype_to_order_key(item_type)
+        sdeps_cfgs = [self.config[sdep]
+                      for sdep in self._find_same_dep(dep_key, dep_value)]
+        sorted_deps = [
+            sdep['id'] for sdep in
+            sorted(sdeps_cfgs, key=operator.itemgetter(*list(item_order)))]
+        if cache_key is not None:
+            self._siblings[cache_key] = sorted_deps
+        return sorted_deps
+
+    def _direct_deps(self, item_id, item_cfg, validate):
+        """ Yield (dep, same_deps) for each dependency of item_cfg. """
+        item_type = item_cfg.get('type')
+        for dep_key in _stype_to_deps(item_type):
+            if dep_key in item_cfg:
+                dep_value = item_cfg[dep_key]
+                if not isinstance(dep_value, list):
+                    dep_value = [dep_value]
+                for dep in dep_value:
+                    if validate:
+                        _validate_dep_type(item_id, dep_key, dep, self.config)
+                    yield dep, self._sorted_same_deps(dep_key, dep, item_type)
+
+    def _enter(self, item_id):
+        if item_id in self._resolving:
+            raise ValueError(
+                'Circular dependency found in storage config at id: %s' %
+                item_id)
+        self._resolving.add(item_id)
+
+    def find(self, item_id, validate=True):
+        """ Return the list of dependent device ids of item_id."""
+        item_cfg = self.config.get(item_id)
+        if not item_cfg:
+            return None
+        if validate and item_id in self._deps:
+            return self._deps[item_id]
+
+        self._enter(item_id)
+        try:
+            deps = []
+            for dep, same_deps in self._direct_deps(item_id, item_cfg,
+                                                    validate):
+                deps.append(dep)
+                deps.extend(same_deps)
                 # find lower level deps
-                lower_deps = find_item_dependencies(dep, config)
+                lower_deps = self.find(dep)
                 if lower_deps:
                     deps.extend(lower_deps)
+        finally:
+            self._resolving.discard(item_id)
+
+        if validate:
+            self._deps[item_id] = deps
+        return deps
+
+    def tree_ids(self, item_id):
+        """ Return a tuple of item_id followed by each of its dependencies,
+            without duplicates, in the order find() first lists them."""
+        if item_id in self._trees:
+            return self._trees[item_id]
+        item_cfg = self.config.get(item_id)
+        if not item_cfg:
+            return (item_id,)
+
+        self._enter(item_id)
+        try:
+            ids = OrderedDict({item_id: None})
+            for dep, same_deps in self._direct_deps(item_id, item_cfg, True):
+                ids[dep] = None
+                for sdep in same_deps:
+                    ids[sdep] = None
+                for lower_dep in self.tree_ids(dep):
+                    ids[lower_dep] = None
+        finally:
+            self._resolving.discard(item_id)
+
+        self._trees[item_id] = tuple(ids)
+        return self._trees[item_id]
+
+    def config_tree(self, item_id):
+        return OrderedDict((dep, self.config[dep])
+                           for dep in self.tree_ids(item_id))
+
+
+def _is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
 
-    return deps
+
+def find_item_dependencies(item_id, config, validate=True):
+    """ Walk a storage config collecting any dependent device ids."""
+    deps = _DependencyResolver(config).find(item_id, validate=validate)
+    return list(deps) if deps is not None else None
 
 
 def get_config_tree(item, storage_config):
@@ -300,12 +473,7 @@ def get_config_tree(item, storage_config):
 
     '''
     sconfig = extract_storage_ordered_dict(storage_config)
-    # Create the OrderedDict by inserting the top-most item
-    # and then inserting the next dependency.
-    item_deps = OrderedDict({item: sconfig[item]})
-    for dep in find_item_dependencies(item, sconfig):
-        item_deps[dep] = sconfig[dep]
-    return item_deps
+    return _DependencyResolver(sconfig).config_tree(item)
 
 
 def merge_config_trees_to_list(config_trees):
@@ -319,26 +487,19 @@ def merge_config_trees_to_list(config_trees):
         that composed devices are listed last.
     '''
 
-    reg = {}
-    # reg[sda] = {level=0, config={}}
-    # reg[sdd] = {level=0, config={}}
-    # reg[sde] = {level=0, config={}}
-    # reg[sdf] = {level=0, config={}}
-    # reg[md0] = {level=3, config={'devices': [sdd, sde, sdf]}}
-    # reg[sda5] = {level=1, config={'device': sda}}
-    # reg[bcache1_raid] =
-    #    {level=5, config={'backing': ['md0'], 'cache': ['sda5']}}
-    max_level = 0
+    reg = set()
+    # levels[1] = [sda, sdd, sde, sdf]
+    # levels[2] = [sda5]
+    # levels[4] = [md0]
+    # levels[6] = [bcache1_raid]
+    levels = {}
     for tree in config_trees:
-        top_item_id = list(tree.keys())[0]  # first insertion has the most deps
-        level = len(tree.keys())
-        if level > max_level:
-            max_level = level
-        item_cfg = tree[top_item_id]
+        top_item_id = next(iter(tree))  # first insertion has the most deps
         if top_item_id in reg:
             LOG.warning('Dropping Duplicate id: %s' % top_item_id)
             continue
-        reg[top_item_id] = {'level': level, 'config': item_cfg}
+        reg.add(top_item_id)
+        levels.setdefault(len(tree), []).append(tree[top_item_id])
 
     def sort_level(configs):
         sreg = {}
@@ -357,20 +518,29 @@ def merge_config_trees_to_list(config_trees):
 
         return result
 
-    # [entry for tag in tags]
     merged = []
-    for lvl in range(0, max_level + 1):
-        level_configs = []
-        for item_id, entry in reg.items():
-            if entry['level'] == lvl:
-                level_configs.append(entry['config'])
-
-        sconfigs = sort_level(level_configs)
-        merged.extend(sconfigs)
+    for lvl in sorted(levels):
+        merged.extend(sort_level(levels[lvl]))
 
     return merged
 
 
+def sort_storage_config(config):
+    """ Return the storage config list items ordered so that each item
+        follows the items it depends upon.
+    """
+    if not config:
+        return []
+
+    LOG.debug("Generating storage config dependencies")
+    resolver = _DependencyResolver(
+        OrderedDict((cfg["id"], cfg) for cfg in config))
+    ctrees = [resolver.config_tree(cfg.get('id')) for cfg in config]
+
+    LOG.debug("Merging storage config dependencies")
+    return merge_config_trees_to_list(ctrees)
+
+
 def config_tree_to_list(config_tree):
     """ ConfigTrees are OrderedDicts which insert dependent storage configs
         from leaf to root.  Reversing this insertion order creates a list
@@ -395,6 +565,178 @@ def extract_storage_ordered_dict(config):
     return OrderedDict((d["id"], d) for d in scfg)
 
 
+class _StorageConfigIndex(object):
+    """ Partitions of each device in a storage config, by item id."""
+
+    __slots__ = ('order', 'partitions', 'partition_orders', 'partition_pos',
+                 'logical_pos', 'logical_count', 'extended')
+
+    def __init__(self, storage_config):
+        # item_id -> position in the storage config
+        self.order = {}
+        # device_id -> [partition_id, ...] and their positions
+        self.partitions = {}
+        self.partition_orders = {}
+        # partition_id -> index into partitions[device_id]
+        self.partition_pos = {}
+        # logical partition_id -> index among the logical partitions of its
+        # device
+        self.logical_pos = {}
+        # device_id -> count of any items flagged logical on the device
+        self.logical_count = {}
+        # device_id -> first extended partition_id
+        self.extended = {}
+
+        logical = {}
+        for position, (item_id, item) in enumerate(storage_config.items()):
+            self.order[item_id] = position
+            device = item.get('device')
+            flag = item.get('flag')
+            if flag == 'logical':
+                self.logical_count[device] = (
+                    self.logical_count.get(device, 0) + 1)
+            if item.get('type') == 'partition':
+                parts = self.partitions.setdefault(device, [])
+                self.partition_pos[item_id] = len(parts)
+                parts.append(item_id)
+                self.partition_orders.setdefault(device, []).append(position)
+                if flag == 'logical':
+                    self.logical_pos[item_id] = logical.get(device, 0)
+                    logical[device] = self.logical_pos[item_id] + 1
+                elif flag == 'extended':
+                    self.extended.setdefault(device, item_id)
+
+
+class IndexedStorageConfig(OrderedDict):
+    """ An ordered dictionary of storage config items keyed by id.
+
+        Besides the items, an IndexedStorageConfig indexes the partitions of
+        each device so handlers need not scan the whole config for them.
+        The index is built on first use and dropped whenever items are added
+        or removed; items are not expected to be modified in place once
+        indexed.
+    """
+
+    __slots__ = ('_index',)
+
+    def __init__(self, *args, **kwargs):
+        self._index = None
+        super(IndexedStorageConfig, self).__init__(*args, **kwargs)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = _StorageConfigIndex(self)
+        return self._index
+
+    def _invalidate(self):
+        self._index = None
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        self._invalidate()
+        super(IndexedStorageConfig, self).__setitem__(key, value, *args,
+                                                      **kwargs)
+
+    def __delitem__(self, key, *args, **kwargs):
+        self._invalidate()
+        super(IndexedStorageConfig, self).__delitem__(key, *args, **kwargs)
+
+    def clear(self):
+        self._invalidate()
+        super(IndexedStorageConfig, self).clear()
+
+    def pop(self, *args):
+        self._invalidate()
+        return super(IndexedStorageConfig, self).pop(*args)
+
+    def popitem(self, *args, **kwargs):
+        self._invalidate()
+        return super(IndexedStorageConfig, self).popitem(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._invalidate()
+        return super(IndexedStorageConfig, self).setdefault(key, default)
+
+    def move_to_end(self, *args, **kwargs):
+        self._invalidate()
+        return super(IndexedStorageConfig, self).move_to_end(*args, **kwargs)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
+
+    def get_partition_index(self, partition_id):
+        """ Return the position of partition_id among the partitions on
+            its device or None if partition_id is not a partition."""
+        return self.index.partition_pos.get(partition_id)
+
+    def get_partitions_before(self, device_id, item_id):
+        """ Return the ids of partitions on device_id which precede item_id
+            in config order.  All of them if item_id is not present."""
+        parts = self.index.partitions.get(device_id, [])
+        position = self.index.order.get(item_id)
+        if position is None:
+            return list(parts)
+        orders = self.index.partition_orders.get(device_id, [])
+        return parts[:bisect.bisect_left(orders, position)]
+
+    def get_logical_partition_index(self, partition_id):
+        """ Return the position of partition_id among the logical partitions
+            on its device or None if it is not a logical partition."""
+        return self.index.logical_pos.get(partition_id)
+
+    def count_logical(self, device_id):
+        """ Return the number of items on device_id flagged logical."""
+        return self.index.logical_count.get(device_id, 0)
+
+    def get_extended_partition(self, device_id):
+        """ Return the id of the extended partition on device_id or None."""
+        return self.index.extended.get(device_id)
+
+
+class ProbertIndex(object):
+    """ Lookup tables over probert 'blockdev' data.
+
+        The tables are built in one pass over the data so that a single
+        ProbertIndex can serve every ProbertParser of a probe.
+    """
+
+    __slots__ = ('blockdev_data', 'devlinks', '_ptable_entries')
+
+    def __init__(self, blockdev_data):
+        self.blockdev_data = blockdev_data or {}
+        # any DEVLINKS entry (by-id, by-path, mapper, ...) -> kernel devname
+        self.devlinks = {}
+        # parent devname -> {partition devname: partition table entry}
+        self._ptable_entries = {}
+
+        for devname, bdata in self.blockdev_data.items():
+            if not bdata:
+                continue
+            for link in bdata.get('DEVLINKS', '').split():
+                self.devlinks.setdefault(link, devname)
+
+    def lookup_devname(self, devname):
+        """ Return the kernel devname of devname or of the device which
+            has devname as a devlink, None if not found."""
+        if devname in self.blockdev_data:
+            return devname
+        return self.devlinks.get(devname)
+
+    def ptable_entry(self, parent_devname, devname):
+        """ Return the partition table entry of parent_devname for the
+            partition devname, None if not found."""
+        entries = self._ptable_entries.get(parent_devname)
+        if entries is None:
+            entries = {}
+            parent = self.blockdev_data.get(parent_devname) or {}
+            ptable = parent.get('partitiontable') or {}
+            for pentry in ptable.get('partitions', []):
+                entries.setdefault(self.lookup_devname(pentry['node']),
+                                   pentry)
+            self._ptable_entries[parent_devname] = entries
+        return entries.get(devname)
+
+
 class ProbertParser(object):
     """ Base class for parsing probert storage configuration.
 
@@ -409,7 +751,7 @@ class ProbertParser(object):
     probe_data_key = None
     class_data = None
 
-    def __init__(self, probe_data):
+    def __init__(self, probe_data, index=None):
         if not probe_data or not isinstance(probe_data, dict):
             raise ValueError('Invalid probe_data: %s' % probe_data)
 
@@ -431,6 +773,15 @@ class ProbertParser(object):
         if not self.blockdev_data:
             LOG.warning('probe_data missing valid "blockdev" data')
 
+        # parsers of the same probe_data may share one ProbertIndex
+        self._index = index
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = ProbertIndex(self.blockdev_data)
+        return self._index
+
     def parse(self):
         raise NotImplementedError()
 
@@ -443,15 +794,7 @@ class ProbertParser(object):
             the dictionary keys, search under 'DEVLINKS' of each
             device and return the dictionary for the kernel.
         """
-        if devname in self.blockdev_data:
-            return devname
-
-        for bd_key, bdata in self.blockdev_data.items():
-            devlinks = bdata.get('DEVLINKS', '').split()
-            if devname in devlinks:
-                return bd_key
-
-        return None
+        return self.index.lookup_devname(devname)
 
     def is_mpath_member(self, blockdev):
         return multipath.is_mpath_member(blockdev.get('DEVNAME', ''), blockdev)
@@ -514,8 +857,8 @@ class BcacheParser(ProbertParser):
 
     probe_data_key = 'bcache'
 
-    def __init__(self, probe_data):
-        super(BcacheParser, self).__init__(probe_data)
+    def __init__(self, probe_data, index=None):
+        super(BcacheParser, self).__init__(probe_data, index=index)
         self.backing = self.class_data.get('backing', {})
         self.caching = self.class_data.get('caching', {})
 
@@ -560,17 +903,12 @@ class BcacheParser(ProbertParser):
 
             return None
 
-        def _find_bcache_devname(uuid, backing_data, blockdev_data):
+        def _find_bcache_devname(uuid, backing_data):
             by_uuid = '/dev/bcache/by-uuid/' + uuid
             label = _sb_get(backing_data, 'dev.label')
-            for devname, data in blockdev_data.items():
-                if not devname:
-                    continue
-                if devname.startswith('/dev/bcache'):
-                    # DEVLINKS is a space separated list
-                    devlinks = data.get('DEVLINKS', '').split()
-                    if by_uuid in devlinks:
-                        return devname
+            devname = self.index.devlinks.get(by_uuid)
+            if devname and devname.startswith('/dev/bcache'):
+                return devname
             if label:
                 return label
             LOG.warning('Failed to find bcache %s ' % (by_uuid))
@@ -590,7 +928,7 @@ class BcacheParser(ProbertParser):
         cache_device = _find_cache_device(backing_data, self.caching)
         cache_mode = _cache_mode(backing_data)
         bcache_name = os.path.basename(_find_bcache_devname(backing_uuid,
-                                       backing_data, self.blockdev_data))
+                                                            backing_data))
         bcache_entry = {'type': 'bcache', 'id': 'disk-%s' % bcache_name,
                         'name': bcache_name}
 
@@ -777,12 +1115,7 @@ class BlockdevParser(ProbertParser):
                     return None
             ptable = parent_blockdev.get('partitiontable')
             if ptable:
-                part = None
-                for pentry in ptable['partitions']:
-                    if self.lookup_devname(pentry['node']) == devname:
-                        part = pentry
-                        break
-
+                part = self.index.ptable_entry(parent_devname, devname)
                 if part is None:
                     raise RuntimeError(
                         "Couldn't find partition entry in table")
@@ -1294,8 +1627,11 @@ def extract_storage_config(probe_data, strict=False):
     configs = []
     errors = []
     LOG.debug('Extracting storage config from probe data')
+    index = None
+    if probe_data and isinstance(probe_data, dict):
+        index = ProbertIndex(probe_data.get('blockdev'))
     for ptype, pname in convert_map.items():
-        parser = pname(probe_data)
+        parser = pname(probe_data, index=index)
         found_cfgs, found_errs = parser.parse()
         configs.extend(found_cfgs)
         errors.extend(found_errs)
@@ -1340,16 +1676,9 @@ def extract_storage_config(probe_data, strict=False):
               yaml.dump({'storage': ordered},
                         indent=4, default_flow_style=False))
 
-    LOG.debug("Generating storage config dependencies")
-    ctrees = []
-    for cfg in ordered:
-        tree = get_config_tree(cfg.get('id'), final_config)
-        ctrees.append(tree)
-
-    LOG.debug("Merging storage config dependencies")
     merged_config = {
         'version': 2,
-        'config': merge_config_trees_to_list(ctrees)
+        'config': sort_storage_config(ordered)
     }
     LOG.debug("Merged storage config:\n%s",
               yaml.dump({'storage': merged_config},
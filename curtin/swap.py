@@ -1,13 +1,47 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import array
+import errno
+import fcntl
 import os
 import resource
+import struct
 
 from .log import LOG
 from . import util
 from curtin import paths
 from curtin import distro
 
+# linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xc020660b
+FS_IOC_GETFLAGS = (2 << 30) | (struct.calcsize('l') << 16) | (0x66 << 8) | 1
+FS_IOC_SETFLAGS = (1 << 30) | (struct.calcsize('l') << 16) | (0x66 << 8) | 2
+FS_NOCOW_FL = 0x00800000
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+# extents which the kernel cannot map a swapfile onto
+FIEMAP_EXTENT_UNUSABLE = (
+    0x2 |       # FIEMAP_EXTENT_UNKNOWN
+    0x4 |       # FIEMAP_EXTENT_DELALLOC
+    0x8 |       # FIEMAP_EXTENT_ENCODED
+    0x100 |     # FIEMAP_EXTENT_NOT_ALIGNED
+    0x200 |     # FIEMAP_EXTENT_DATA_INLINE
+    0x400 |     # FIEMAP_EXTENT_DATA_TAIL
+    0x2000)     # FIEMAP_EXTENT_SHARED
+FIEMAP_HEADER = '=QQIIII'
+FIEMAP_EXTENT = '=QQQ2QI3I'
+FIEMAP_BATCH = 256
+
+# filesystems without fallocate support, where glibc's posix_fallocate
+# emulation writes a byte per block
+SWAP_NO_FALLOCATE = ['ext2', 'ext3']
+# the first target kernel (major, minor) whose swapon accepts the unwritten
+# extents of fallocated swapfiles; older kernels reject them as holes
+SWAP_FALLOCATE_MIN_KERNEL = {
+    'xfs': (4, 18),
+}
+SWAP_ZERO_BUFLEN = 8 * 1024 * 1024
+
 
 def suggested_swapsize(memsize=None, maxsize=None, fsys=None):
     # make a suggestion on the size of swap for this system.
@@ -107,6 +141,129 @@ def can_use_swapfile(target, fstype):
         raise RuntimeError('ZFS cannot use swapfiles')
 
 
+def get_file_extents(fd):
+    """Return the (logical, length, flags) extents of the open file fd.
+
+    Delayed allocations are flushed first.  Ranges of the file which are
+    not covered by any extent are holes.
+    :raises: IOError or OSError if the filesystem does not support FIEMAP
+    """
+    header_len = struct.calcsize(FIEMAP_HEADER)
+    extent_len = struct.calcsize(FIEMAP_EXTENT)
+    extents = []
+    start = 0
+    while True:
+        buf = bytearray(struct.pack(
+            FIEMAP_HEADER, start, 2 ** 64 - 1 - start, FIEMAP_FLAG_SYNC, 0,
+            FIEMAP_BATCH, 0) + b'\0' * (extent_len * FIEMAP_BATCH))
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+        mapped = struct.unpack_from(FIEMAP_HEADER, buf)[3]
+        if not mapped:
+            return extents
+        for num in range(mapped):
+            fields = struct.unpack_from(FIEMAP_EXTENT, buf,
+                                        header_len + num * extent_len)
+            logical, length, flags = fields[0], fields[2], fields[5]
+            extents.append((logical, length, flags))
+            if flags & FIEMAP_EXTENT_LAST:
+                return extents
+        start = logical + length
+
+
+def swapfile_extents_ok(fd, size):
+    """Return True if the first size bytes of fd are allocated in extents
+       the kernel can use for swap: no holes and nothing delayed, inline,
+       encoded or shared.  Unwritten (preallocated) extents are usable.
+    """
+    try:
+        extents = get_file_extents(fd)
+    except (IOError, OSError) as e:
+        LOG.debug('Cannot map swapfile extents: %s', e)
+        return False
+    end = 0
+    for logical, length, flags in extents:
+        if logical > end or flags & FIEMAP_EXTENT_UNUSABLE:
+            return False
+        end = max(end, logical + length)
+    return end >= size
+
+
+def _set_nocow(fd):
+    """Disable copy-on-write (chattr +C) for the empty file fd."""
+    # the kernel reads and writes an int despite the ioctl's long size
+    flags = array.array('i', [0])
+    fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags, True)
+    flags[0] |= FS_NOCOW_FL
+    fcntl.ioctl(fd, FS_IOC_SETFLAGS, flags)
+
+
+def _fallocate(fd, size):
+    """Allocate size bytes for fd, returns False if it is not supported."""
+    if not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        LOG.debug('posix_fallocate failed: %s', e)
+        return False
+    return True
+
+
+def _write_zeros(fd, size, buflen=SWAP_ZERO_BUFLEN):
+    """Write size bytes of zeros to fd in buflen sized writes."""
+    buf = memoryview(b'\0' * buflen)
+    written = 0
+    while written < size:
+        written += os.write(fd, buf[:min(buflen, size - written)])
+
+
+def swapfile_can_fallocate(fstype, kernel_version=None):
+    """Return True if a fallocated swapfile on fstype works with the target
+       kernel, kernel_version being its (major, minor) version."""
+    if fstype in SWAP_NO_FALLOCATE:
+        return False
+    min_version = SWAP_FALLOCATE_MIN_KERNEL.get(fstype)
+    if min_version is None:
+        return True
+    return bool(kernel_version) and tuple(kernel_version) >= min_version
+
+
+def allocate_swapfile(fpath, size, fstype=None, kernel_version=None):
+    """Create a file of size bytes at fpath which mkswap and swapon accept.
+
+    The file is allocated with posix_fallocate and used if FIEMAP shows
+    that it has no holes and only extents usable for swap, as with ext4
+    and with xfs on target kernels 4.18 and later (see
+    SWAP_FALLOCATE_MIN_KERNEL).  On btrfs the file is made no-COW first,
+    which is what btrfs requires of swapfiles.  Otherwise zeros are
+    written to the file in large buffers.
+
+    :param kernel_version: (major, minor) version of the target kernel
+    """
+    if os.path.lexists(fpath):
+        os.unlink(fpath)
+    fd = os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        if fstype == 'btrfs':
+            try:
+                _set_nocow(fd)
+            except (IOError, OSError) as e:
+                LOG.warning('Failed to disable copy-on-write on %s: %s',
+                            fpath, e)
+        if (swapfile_can_fallocate(fstype, kernel_version) and
+                _fallocate(fd, size) and swapfile_extents_ok(fd, size)):
+            LOG.debug('Allocated swapfile %s with fallocate', fpath)
+        else:
+            LOG.debug('Allocating swapfile %s by writing zeros', fpath)
+            os.ftruncate(fd, 0)
+            _write_zeros(fd, size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def setup_swapfile(target, fstab=None, swapfile=None, size=None, maxsize=None,
                    force=False):
     if size is None:
@@ -133,28 +290,29 @@ def setup_swapfile(target, fstab=None, swapfile=None, size=None, maxsize=None,
             LOG.debug('Not creating swap: %s', err)
             return
 
-    allocate_cmd = 'fallocate -l "${2}M" "$1"'
-    # fallocate uses IOCTLs to allocate space in a filesystem, however it's not
-    # clear (from curtin's POV) that it creates non-sparse files on btrfs or
-    # xfs as required by mkswap so we'll skip fallocate for now and use dd. It
-    # is also plain not supported on ext2 and ext3.
-    if fstype in ['btrfs', 'ext2', 'ext3', 'xfs']:
-        allocate_cmd = 'dd if=/dev/zero "of=$1" bs=1M "count=$2"'
-
-    mbsize = str(int(size / (2 ** 20)))
+    kernel_version = None
+    if fstype in SWAP_FALLOCATE_MIN_KERNEL:
+        try:
+            pkg_ver = get_target_kernel_version(target)
+        except RuntimeError as err:
+            LOG.debug('Unable to read target kernel version: %s', err)
+            pkg_ver = None
+        if pkg_ver:
+            kernel_version = (pkg_ver['major'], pkg_ver['minor'])
+
+    mbsize = int(size / (2 ** 20))
     msg = "creating swap file '%s' of %sMB" % (swapfile, mbsize)
     fpath = os.path.sep.join([target, swapfile])
     try:
         util.ensure_dir(os.path.dirname(fpath))
         with util.LogTimer(LOG.debug, msg):
-            util.subp(
-                ['sh', '-c',
-                 ('rm -f "$1" && umask 0066 && truncate -s 0 "$1" && '
-                  '{ chattr +C "$1" || true; } && ') + allocate_cmd +
-                 (' && mkswap "$1" || { r=$?; rm -f "$1"; exit $r; }'),
-                 'setup_swap', fpath, mbsize])
+            allocate_swapfile(fpath, mbsize * 2 ** 20, fstype=fstype,
+                              kernel_version=kernel_version)
+            util.subp(['mkswap', fpath])
     except Exception:
         LOG.warn("failed %s" % msg)
+        if os.path.exists(fpath):
+            os.unlink(fpath)
         raise
 
     if fstab is None:
@@ -1,7 +1,11 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
-import shlex
 import os
+import select
+import shlex
+import socket
+import threading
+import time
 
 from curtin import util
 from curtin.log import logged_call, LOG
@@ -13,6 +17,17 @@ except AttributeError:
     import pipes
     shlex_quote = pipes.quote
 
+# netlink protocol and multicast group on which the kernel sends uevents
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+# some sysfs objects (bcache cache sets for example) are created without a
+# uevent, so paths are also rechecked this often (in seconds)
+UEVENT_POLL_INTERVAL = 0.1
+
+# block-meta may configure storage concurrently, settles are run one at a
+# time so that they do not interleave with each other
+_SETTLE_LOCK = threading.Lock()
+
 
 def compose_udev_equality(key, value):
     """Return a udev comparison clause, like `ACTION=="add"`."""
@@ -61,7 +76,8 @@ def udevadm_settle(exists=None, timeout=None):
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
 
-    util.subp(settle_cmd)
+    with _SETTLE_LOCK:
+        util.subp(settle_cmd)
 
 
 def udevadm_trigger(devices):
@@ -71,6 +87,79 @@ def udevadm_trigger(devices):
     udevadm_settle()
 
 
+def _uevent_socket():
+    """Return a non-blocking socket receiving kernel uevents, or None."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, socket.error) as e:
+        LOG.debug('Unable to open uevent socket: %s', e)
+        return None
+    try:
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+        sock.setblocking(False)
+    except socket.error as e:
+        LOG.debug('Unable to listen for uevents: %s', e)
+        sock.close()
+        return None
+    return sock
+
+
+def _drain_uevents(sock):
+    """Read and discard every uevent queued on sock."""
+    while True:
+        try:
+            if not sock.recv(8192):
+                return
+        except socket.error:
+            return
+
+
+def wait_for_paths(paths, timeout=30, exists=True):
+    """Wait until each of paths exists, or with exists=False is removed.
+
+    Instead of sleeping between checks, the paths are checked again as soon
+    as the kernel sends a uevent, and at least every UEVENT_POLL_INTERVAL
+    seconds for objects which appear without one.
+
+    :param paths: list of filesystem (usually sysfs) paths to wait for
+    :param timeout: maximum number of seconds to wait
+    :param exists: wait for the paths to exist (True) or be removed (False)
+    :returns: list of paths which did not reach the wanted state in time
+    """
+    def pending():
+        return [path for path in paths if os.path.exists(path) != exists]
+
+    missing = pending()
+    if not missing:
+        return missing
+
+    LOG.debug('Waiting up to %ss for %s %s', timeout,
+              'creation of' if exists else 'removal of', missing)
+    deadline = time.time() + timeout
+    sock = _uevent_socket()
+    try:
+        while missing:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            wait = min(remaining, UEVENT_POLL_INTERVAL)
+            if sock:
+                readable, _, _ = select.select([sock], [], [], wait)
+                if readable:
+                    _drain_uevents(sock)
+            else:
+                time.sleep(wait)
+            missing = pending()
+    finally:
+        if sock:
+            sock.close()
+
+    if missing:
+        LOG.debug('Timed out waiting for %s', missing)
+    return missing
+
+
 def udevadm_info(path=None):
     """ Return a dictionary populated by properties of the device specified
         in the `path` variable via querying udev 'property' database.
@@ -129,4 +218,35 @@ def udevadm_info(path=None):
     return info
 
 
+def udevadm_info_db(output=None):
+    """ Return the udev properties of every block device in the udev
+        database, read with a single `udevadm info --export-db`.
+
+    :params: output: udevadm info --export-db output to parse instead
+    :returns: dictionary mapping each device's DEVNAME to a dictionary of
+              its properties.  Unlike udevadm_info, DEVLINKS is always a
+              list.
+    """
+    if output is None:
+        output, _ = util.subp(['udevadm', 'info', '--export-db'],
+                              capture=True)
+
+    devices = {}
+    # each device is a block of "<prefix>: <data>" lines, properties use
+    # the E: prefix and are not quoted
+    for record in output.split('\n\n'):
+        info = {}
+        for line in record.splitlines():
+            if not line.startswith('E: ') or '=' not in line:
+                continue
+            key, value = line[3:].split('=', 1)
+            info[key] = value
+        if info.get('SUBSYSTEM') != 'block' or not info.get('DEVNAME'):
+            continue
+        info['DEVLINKS'] = info.get('DEVLINKS', '').split()
+        devices[info['DEVNAME']] = info
+
+    return devices
+
+
 # vi: ts=4 expandtab syntax=python
@@ -15,6 +15,7 @@ import subprocess
 import stat
 import sys
 import tempfile
+import threading
 import time
 
 # avoid the dependency to python3-six as used in cloud-init
@@ -416,6 +417,79 @@ class LogTimer(object):
                      (self.msg, time.time() - self.start))
 
 
+def run_dependency_graph(graph, func, workers=1, lock_key=None):
+    """Call func(node) for each node of graph once its dependencies are done.
+
+    :param graph: OrderedDict mapping each node to an iterable of the nodes
+                  it depends upon.  Dependencies not present in graph are
+                  ignored.  Ready nodes are started in graph order.
+    :param func: callable invoked as func(node).
+    :param workers: maximum number of concurrent func calls.  With 1 (the
+                    default) nodes are run serially in graph order.
+    :param lock_key: optional callable returning a hashable key for a node;
+                     nodes with the same non-None key never run concurrently.
+    :raises: the first exception raised by func.  No new nodes are started
+             after a failure, and nodes already running are waited for.
+    :raises: ValueError if the remaining nodes can never become ready.
+    """
+    if workers is None or int(workers) <= 1:
+        for node in graph:
+            func(node)
+        return
+
+    workers = int(workers)
+    pending = collections.OrderedDict(
+        (node, set(deps or []) & set(graph)) for node, deps in graph.items())
+    done = set()
+    running = {}
+    held = set()
+    errors = []
+    cond = threading.Condition()
+
+    def _worker(node, key):
+        error = None
+        try:
+            func(node)
+        except BaseException as e:
+            error = e
+        with cond:
+            del running[node]
+            held.discard(key)
+            if error is not None:
+                errors.append(error)
+            else:
+                done.add(node)
+            cond.notify()
+
+    with cond:
+        while pending or running:
+            if not errors:
+                for node, deps in list(pending.items()):
+                    if len(running) >= workers:
+                        break
+                    if not deps.issubset(done):
+                        continue
+                    key = lock_key(node) if lock_key else None
+                    if key is not None:
+                        if key in held:
+                            continue
+                        held.add(key)
+                    del pending[node]
+                    thread = threading.Thread(target=_worker, args=(node, key))
+                    thread.daemon = True
+                    running[node] = thread
+                    thread.start()
+            if not running:
+                if errors:
+                    break
+                raise ValueError(
+                    'Unsatisfiable dependencies for: %s' % list(pending))
+            cond.wait()
+
+    if errors:
+        raise errors[0]
+
+
 def is_mounted(target, src=None, opts=None):
     # return whether or not src is mounted on target
     mounts = ""
@@ -1,15 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import errno
 import functools
 import json
 import os
 import mock
+import re
+import struct
 import sys
 import textwrap
 
 from collections import OrderedDict
 
-from .helpers import CiTestCase, simple_mocked_open
+from .helpers import CiTestCase, populate_dir, simple_mocked_open
 from curtin import util
 from curtin import block
 
@@ -29,6 +32,39 @@ class TestBlock(CiTestCase):
         mock_util.subp.assert_called_with(expected_call, capture=True)
         self.assertEqual(uuid, "182e8e23-5322-46c9-a1b8-cf2c6a88f9f7")
 
+    @mock.patch("curtin.block.util.subp")
+    def test_blkid_export(self, mock_subp):
+        """blkid_export reads the tags of all devices with one blkid."""
+        mock_subp.return_value = (textwrap.dedent("""\
+            DEVNAME=/dev/sda
+            PTUUID=2b5b27a2
+            PTTYPE=dos
+
+            DEVNAME=/dev/sda1
+            LABEL=my\\ root
+            UUID=182e8e23-5322-46c9-a1b8-cf2c6a88f9f7
+            TYPE=ext4
+            PARTUUID=2b5b27a2-01
+            """), "")
+
+        expected = {
+            '/dev/sda': {'DEVNAME': '/dev/sda', 'PTUUID': '2b5b27a2',
+                         'PTTYPE': 'dos'},
+            '/dev/sda1': {'DEVNAME': '/dev/sda1', 'LABEL': 'my root',
+                          'UUID': '182e8e23-5322-46c9-a1b8-cf2c6a88f9f7',
+                          'TYPE': 'ext4', 'PARTUUID': '2b5b27a2-01'}}
+        self.assertEqual(expected,
+                         block.blkid_export(['/dev/sda', '/dev/sda1']))
+        mock_subp.assert_called_once_with(
+            ['blkid', '-o', 'export', '/dev/sda', '/dev/sda1'],
+            capture=True, rcs=[0, 2], retries=[1, 1, 1])
+
+    @mock.patch("curtin.block.util.subp")
+    def test_blkid_export_no_devices(self, mock_subp):
+        """blkid_export does not run blkid without devices."""
+        self.assertEqual({}, block.blkid_export([]))
+        self.assertEqual(0, mock_subp.call_count)
+
     @mock.patch("curtin.block.get_proc_mounts")
     @mock.patch("curtin.block._lsblock")
     def test_get_mountpoints(self, mock_lsblk, mock_proc_mounts):
@@ -106,6 +142,28 @@ class TestBlock(CiTestCase):
             mock_os_listdir.return_value = ["other"]
             block.lookup_disk(serial)
 
+    @mock.patch("curtin.block.multipath")
+    @mock.patch("curtin.block.os.path.realpath")
+    @mock.patch("curtin.block.os.path.exists")
+    @mock.patch("curtin.block.os.listdir")
+    def test_lookup_disk_mpath_member(self, mock_os_listdir,
+                                      mock_os_path_exists,
+                                      mock_os_path_realpath, mock_mpath):
+        serial = "SERIAL123"
+        mock_os_listdir.return_value = ["scsi-%s" % serial]
+        mock_os_path_exists.return_value = True
+        mock_os_path_realpath.return_value = "/dev/sda"
+        mock_mpath.is_mpath_device.return_value = False
+        mock_mpath.is_mpath_member.return_value = True
+        mock_mpath.get_mpath_id_from_device.return_value = 'mpatha'
+
+        self.assertEqual('/dev/mapper/mpatha', block.lookup_disk(serial))
+        mock_mpath.get_mpath_id_from_device.assert_called_with('/dev/sda')
+
+        # a member without a map is used as it is
+        mock_mpath.get_mpath_id_from_device.return_value = None
+        self.assertEqual('/dev/sda', block.lookup_disk(serial))
+
     @mock.patch("curtin.block.multipath")
     @mock.patch("curtin.block.os.path.realpath")
     @mock.patch("curtin.block.os.path.exists")
@@ -422,19 +480,238 @@ class TestWipeVolume(CiTestCase):
             mock_wipe_file.assert_called_with(self.dev, exclusive=True)
 
     @mock.patch('curtin.block.wipe_file')
-    def test_wipe_random(self, mock_wipe_file):
-        with simple_mocked_open() as mock_open:
-            block.wipe_volume(self.dev, mode='random')
-            mock_open.assert_called_with('/dev/urandom', 'rb')
-            mock_wipe_file.assert_called_with(
-                self.dev, exclusive=True,
-                reader=mock_open.return_value.__enter__().read)
+    @mock.patch('curtin.block.RandomStream')
+    def test_wipe_random(self, m_stream, mock_wipe_file):
+        block.wipe_volume(self.dev, mode='random')
+        m_stream.assert_called_with()
+        mock_wipe_file.assert_called_with(
+            self.dev, exclusive=True,
+            reader=m_stream.return_value.__enter__.return_value.read)
+        self.assertTrue(m_stream.return_value.__exit__.called)
+
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.blkdev_range_ioctl')
+    @mock.patch('curtin.block.is_block_device')
+    def test_wipe_zero_offloaded(self, m_is_block, m_ioctl, m_wipe_file):
+        """wipe_volume mode=zero uses BLKZEROOUT on block devices"""
+        m_is_block.return_value = True
+        m_ioctl.return_value = True
+        block.wipe_volume(self.dev, exclusive=False, mode='zero')
+        m_ioctl.assert_called_with(self.dev, block.BLKZEROOUT,
+                                   exclusive=False)
+        self.assertEqual(0, m_wipe_file.call_count)
+
+        m_ioctl.return_value = False
+        block.wipe_volume(self.dev, exclusive=False, mode='zero')
+        m_wipe_file.assert_called_with(self.dev, exclusive=False)
+
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.blkdev_range_ioctl')
+    @mock.patch('curtin.block.is_block_device')
+    def test_wipe_discard(self, m_is_block, m_ioctl, m_wipe_file):
+        """wipe_volume mode=discard prefers secure discard, then discard"""
+        m_is_block.return_value = True
+        m_ioctl.side_effect = lambda path, req, exclusive: (
+            req == block.BLKDISCARD)
+        block.wipe_volume(self.dev, mode='discard')
+        self.assertEqual(
+            [mock.call(self.dev, block.BLKSECDISCARD, exclusive=True),
+             mock.call(self.dev, block.BLKDISCARD, exclusive=True)],
+            m_ioctl.call_args_list)
+        self.assertEqual(0, m_wipe_file.call_count)
+
+    @mock.patch('curtin.block.wipe_file')
+    @mock.patch('curtin.block.blkdev_range_ioctl')
+    @mock.patch('curtin.block.is_block_device')
+    def test_wipe_discard_unsupported_zeros(self, m_is_block, m_ioctl,
+                                            m_wipe_file):
+        """wipe_volume mode=discard zeros devices without discard support"""
+        m_is_block.return_value = True
+        m_ioctl.return_value = False
+        block.wipe_volume(self.dev, mode='discard')
+        self.assertEqual(
+            [block.BLKSECDISCARD, block.BLKDISCARD, block.BLKZEROOUT],
+            [c[0][1] for c in m_ioctl.call_args_list])
+        m_wipe_file.assert_called_with(self.dev, exclusive=True)
 
     def test_bad_input(self):
         with self.assertRaises(ValueError):
             block.wipe_volume(self.dev, mode='invalidmode')
 
 
+class TestRandomStream(CiTestCase):
+
+    def check_stream(self, generator):
+        with block.RandomStream(generator, buflen=4096, depth=2) as stream:
+            self.assertEqual(generator, stream.generator)
+            data = [stream.read(size) for size in (4096, 1000, 5000, 4096)]
+        self.assertEqual([4096, 1000, 5000, 4096], [len(d) for d in data])
+        self.assertEqual(len(data), len(set(data)))
+        self.assertNotEqual(b'\0' * 4096, data[0])
+
+    def test_urandom_generator(self):
+        self.check_stream('urandom')
+
+    def test_aes_ctr_generator(self):
+        if not util.which('openssl'):
+            self.skipTest('openssl not available')
+        self.check_stream('aes-ctr')
+
+    @mock.patch('curtin.block.subprocess.Popen')
+    def test_aes_ctr_key_not_on_command_line(self, m_popen):
+        """the aes-ctr passphrase goes to openssl on stdin, not argv"""
+        m_popen.return_value.stdout.read.return_value = b'\1' * 1024
+        with block.RandomStream('aes-ctr', buflen=1024):
+            pass
+        args = m_popen.call_args[0][0]
+        self.assertEqual(['-pass', 'stdin'],
+                         args[args.index('-pass'):args.index('-pass') + 2])
+        self.assertNotIn('-K', args)
+        self.assertNotIn('-iv', args)
+        written = m_popen.return_value.stdin.write.call_args[0][0]
+        self.assertEqual(65, len(written))
+        self.assertTrue(written.endswith(b'\n'))
+        self.assertNotIn(written.strip().decode(), ' '.join(args))
+        self.assertTrue(m_popen.return_value.stdin.close.called)
+
+    @mock.patch('curtin.block.util.which')
+    def test_default_generator(self, m_which):
+        m_which.return_value = None
+        with block.RandomStream(buflen=1024) as stream:
+            self.assertEqual('urandom', stream.generator)
+        m_which.assert_called_with('openssl')
+
+    def test_unknown_generator(self):
+        with self.assertRaises(ValueError):
+            block.RandomStream('rot13')
+
+    def test_generator_errors_raise(self):
+        stream = block.RandomStream('urandom', buflen=4096)
+        with mock.patch.object(stream, '_source') as m_source:
+            m_source.read.return_value = b'short'
+            # buffers produced before the source was replaced come first
+            with self.assertRaises(IOError):
+                for _ in range(10):
+                    stream.read(4096)
+        stream.close()
+
+    def test_wipe_file_with_stream(self):
+        path = self.tmp_path('random.img')
+        with open(path, 'wb') as fp:
+            fp.truncate(3 * 4096 + 100)
+        with block.RandomStream('urandom', buflen=4096) as stream:
+            block.wipe_file(path, reader=stream.read, buflen=4096)
+        data = util.load_file(path, decode=False)
+        self.assertEqual(3 * 4096 + 100, len(data))
+        self.assertNotIn(b'\0' * 512, data)
+
+
+class TestQuickZero(CiTestCase):
+
+    MiB = 1024 * 1024
+
+    def setUp(self):
+        super(TestQuickZero, self).setUp()
+        self.disk = self.tmp_path('disk.img')
+        with open(self.disk, 'wb') as fp:
+            fp.write(b'\xff' * 16 * self.MiB)
+        sysfs = self.tmp_dir()
+        # partitions of 4M at 1M, 512K at 6M and 2K at 8M (512b sectors)
+        parts = {'disk1': (2048, 8192), 'disk2': (12288, 1024),
+                 'disk3': (16384, 4)}
+        populate_dir(sysfs, dict(
+            item for (kname, (start, size)) in parts.items()
+            for item in (('%s/start' % kname, str(start)),
+                         ('%s/size' % kname, str(size)))))
+        self.add_patch('curtin.block.is_block_device', 'm_is_block')
+        self.add_patch('curtin.block.get_sysfs_partitions', 'm_parts')
+        self.m_is_block.return_value = True
+        self.m_parts.return_value = [os.path.join(sysfs, kname)
+                                     for kname in sorted(parts)]
+
+    def zeroed_ranges(self):
+        data = util.load_file(self.disk, decode=False)
+        return [m.span() for m in re.finditer(b'\0+', data)]
+
+    @mock.patch('curtin.block.exclusive_open')
+    def test_partitions_zeroed_with_one_open(self, m_open):
+        """quick_zero zeros disk and partitions through a single open"""
+        m_open.side_effect = lambda path, exclusive: open(path, 'rb+')
+        block.quick_zero(self.disk)
+        m_open.assert_called_once_with(self.disk, exclusive=True)
+        MiB = self.MiB
+        self.assertEqual(
+            [(0, 2 * MiB),  # disk start and disk1 start
+             (4 * MiB, 5 * MiB),  # disk1 end
+             (6 * MiB, 6 * MiB + 512 * 1024),  # all of disk2
+             (8 * MiB, 8 * MiB + 2048),  # all of disk3
+             (15 * MiB, 16 * MiB)],  # disk end
+            self.zeroed_ranges())
+
+    def test_no_partitions(self):
+        """quick_zero(partitions=False) only zeros the start and end"""
+        block.quick_zero(self.disk, partitions=False)
+        self.assertEqual([(0, self.MiB), (15 * self.MiB, 16 * self.MiB)],
+                         self.zeroed_ranges())
+        self.assertEqual(0, self.m_parts.call_count)
+
+    def test_zero_file_at_offsets(self):
+        """zero_file_at_offsets zeros buflen * count at each offset"""
+        block.zero_file_at_offsets(self.disk, [4096, -8192], buflen=512,
+                                   count=4)
+        self.assertEqual([(4096, 6144), (16 * self.MiB - 8192,
+                                         16 * self.MiB - 6144)],
+                         self.zeroed_ranges())
+
+    def test_zero_file_at_offsets_shortened(self):
+        """zero_file_at_offsets shortens writes past the end of the file"""
+        block.zero_file_at_offsets(self.disk, [16 * self.MiB - 100, -1,
+                                               17 * self.MiB])
+        self.assertEqual([(16 * self.MiB - 100, 16 * self.MiB)],
+                         self.zeroed_ranges())
+        with self.assertRaises(ValueError):
+            block.zero_file_at_offsets(self.disk, [-100], strict=True)
+
+
+class TestBlkdevRangeIoctl(CiTestCase):
+
+    def setUp(self):
+        super(TestBlkdevRangeIoctl, self).setUp()
+        self.path = self.tmp_path('disk.img')
+        with open(self.path, 'wb') as fp:
+            fp.truncate(4 * 1024 * 1024)
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_range_covers_device(self, m_ioctl):
+        """blkdev_range_ioctl passes the whole device as the byte range"""
+        self.assertTrue(block.blkdev_range_ioctl(
+            self.path, block.BLKZEROOUT, exclusive=False))
+        (_fd, request, arg) = m_ioctl.call_args[0]
+        self.assertEqual(block.BLKZEROOUT, request)
+        self.assertEqual((0, 4 * 1024 * 1024), struct.unpack('=QQ', arg))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_unsupported_returns_false(self, m_ioctl):
+        """blkdev_range_ioctl returns False if the ioctl is unsupported"""
+        for err in (errno.EOPNOTSUPP, errno.ENOTTY):
+            m_ioctl.side_effect = OSError(err, os.strerror(err))
+            self.assertFalse(block.blkdev_range_ioctl(
+                self.path, block.BLKDISCARD, exclusive=False))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_io_errors_raise(self, m_ioctl):
+        """blkdev_range_ioctl raises errors other than unsupported"""
+        m_ioctl.side_effect = OSError(errno.EIO, os.strerror(errno.EIO))
+        with self.assertRaises(OSError):
+            block.blkdev_range_ioctl(self.path, block.BLKZEROOUT,
+                                     exclusive=False)
+
+    def test_regular_file_is_unsupported(self):
+        """the ioctls are not supported on regular files"""
+        self.assertFalse(block.blkdev_range_ioctl(
+            self.path, block.BLKZEROOUT, exclusive=False))
+
+
 class TestBlockKnames(CiTestCase):
     """Tests for some of the kname functions in block"""
 
@@ -927,4 +1204,50 @@ class TestSfdiskInfo(CiTestCase):
         self.assertEqual([], self.m_load_json.call_args_list)
 
 
+class TestPartitionTableCache(CiTestCase):
+
+    def setUp(self):
+        super(TestPartitionTableCache, self).setUp()
+        self.add_patch('curtin.block.sfdisk_info', 'm_sfdisk_info')
+        self.table = {
+            'label': 'gpt', 'device': '/dev/vdb', 'unit': 'sectors',
+            'partitions': [
+                {'node': '/dev/vdb%d' % num, 'start': 2048 * num,
+                 'size': 2048, 'type': '0FC63DAF-8483-4772-8E79-3D69D8477DE4'}
+                for num in range(1, 5)]}
+        self.m_sfdisk_info.return_value = self.table
+        self.cache = block.PartitionTableCache()
+
+    def test_table_read_once_per_disk(self):
+        """sfdisk runs once for all lookups on a disk"""
+        self.assertEqual(self.table, self.cache.sfdisk_info('/dev/vdb'))
+        for (num, part) in enumerate(self.table['partitions'], 1):
+            self.assertEqual(part, self.cache.partition_info(
+                '/dev/vdb', '/dev/vdb%d' % num))
+        self.m_sfdisk_info.assert_called_once_with('/dev/vdb')
+
+    def test_invalidate_rereads_table(self):
+        """an invalidated table is read again"""
+        self.cache.sfdisk_info('/dev/vdb')
+        self.cache.invalidate('/dev/vdb')
+        self.cache.sfdisk_info('/dev/vdb')
+        self.cache.sfdisk_info('/dev/vdb')
+        self.assertEqual(2, self.m_sfdisk_info.call_count)
+        self.cache.clear()
+        self.cache.sfdisk_info('/dev/vdb')
+        self.assertEqual(3, self.m_sfdisk_info.call_count)
+
+    def test_read_failures_not_cached(self):
+        """a table which could not be read is read again"""
+        self.m_sfdisk_info.return_value = {}
+        self.assertEqual({}, self.cache.sfdisk_info('/dev/vdb'))
+        self.cache.sfdisk_info('/dev/vdb')
+        self.assertEqual(2, self.m_sfdisk_info.call_count)
+
+    def test_missing_partition_raises(self):
+        """partition_info raises RuntimeError for unknown partitions"""
+        with self.assertRaisesRegex(RuntimeError, '/dev/vdb9'):
+            self.cache.partition_info('/dev/vdb', '/dev/vdb9')
+
+
 # vi: ts=4 expandtab syntax=python
@@ -445,4 +445,111 @@ class TestBlockBcache(CiTestCase):
         m_wait.assert_called_with(stop_path, retries=bcache.BCACHE_RETRIES)
 
 
+class TestBcacheRegistration(CiTestCase):
+
+    def setUp(self):
+        super(TestBcacheRegistration, self).setUp()
+        self.add_patch('curtin.block.bcache.wait_for_paths', 'm_wait')
+        self.add_patch('curtin.block.bcache.register_bcache', 'm_register')
+        self.add_patch('curtin.block.bcache.validate_bcache_ready',
+                       'm_validate')
+        self.add_patch('curtin.block.bcache.os.path.exists', 'm_exists')
+        self.add_patch('curtin.block.bcache.time.sleep', 'm_sleep')
+
+    def test_registered_by_udev(self):
+        """ensure_bcaches_registered does not register udev's devices."""
+        self.m_exists.return_value = True
+        bcache.ensure_bcaches_registered({
+            '/dev/vdb': '/sys/class/block/vdb/bcache',
+            '/dev/vdc': '/sys/class/block/vdc/bcache'})
+        self.assertEqual(1, self.m_wait.call_count)
+        self.assertEqual(0, self.m_register.call_count)
+        self.assertEqual(
+            [mock.call('/dev/vdb', '/sys/class/block/vdb/bcache'),
+             mock.call('/dev/vdc', '/sys/class/block/vdc/bcache')],
+            self.m_validate.call_args_list)
+
+    def test_registers_missing_devices_once(self):
+        """ensure_bcaches_registered registers devices udev did not."""
+        present = set(['/sys/class/block/vdb/bcache'])
+        self.m_exists.side_effect = lambda path: path in present
+
+        def wait_for_paths(paths, timeout):
+            # udev registers nothing, curtin's registration shows up
+            if self.m_register.called:
+                present.update(paths)
+            return []
+        self.m_wait.side_effect = wait_for_paths
+
+        bcache.ensure_bcaches_registered({
+            '/dev/vdb': '/sys/class/block/vdb/bcache',
+            '/dev/vdc': '/sys/class/block/vdc/bcache'})
+        self.assertEqual([mock.call('/dev/vdc')],
+                         self.m_register.call_args_list)
+        self.assertEqual(
+            [mock.call(['/sys/class/block/vdc/bcache'],
+                       timeout=bcache.BCACHE_UDEV_REGISTRATION_TIMEOUT)],
+            self.m_wait.call_args_list[1:])
+
+    def test_raises_on_timeout(self):
+        """ensure_bcaches_registered raises RuntimeError after timeout."""
+        self.m_exists.return_value = True
+        self.m_validate.side_effect = OSError('no cache links')
+        with self.assertRaises(RuntimeError):
+            bcache.ensure_bcaches_registered(
+                {'/dev/vdb': '/sys/fs/bcache/cset'}, timeout=0.05)
+        self.assertEqual(0, self.m_register.call_count)
+
+
+class TestCreateBackingDevices(CiTestCase):
+
+    def setUp(self):
+        super(TestCreateBackingDevices, self).setUp()
+        self.add_patch('curtin.block.bcache.util.subp', 'm_subp')
+        self.add_patch('curtin.block.bcache.sys_block_path', 'm_sysblock')
+        self.add_patch('curtin.block.bcache.os.path.exists', 'm_exists')
+        self.add_patch('curtin.block.bcache.ensure_bcaches_registered',
+                       'm_ensure')
+        self.add_patch('curtin.block.clear_holders.get_holders', 'm_holders')
+        self.add_patch('curtin.block.bcache.attach_backing_to_cacheset',
+                       'm_attach')
+        self.add_patch('curtin.block.bcache.set_cache_mode', 'm_mode')
+        self.m_sysblock.side_effect = (
+            lambda dev: '/sys/class/block/' + os.path.basename(dev))
+        self.m_exists.return_value = False
+        holders = {'/dev/vdb': ['bcache0'], '/dev/vdc': ['bcache1']}
+        self.m_holders.side_effect = lambda dev: holders[dev]
+
+    def test_create_backing_devices_in_one_batch(self):
+        """create_backing_devices formats and registers all together."""
+        self.assertEqual(
+            ['/dev/bcache0', '/dev/bcache1'],
+            bcache.create_backing_devices(
+                [('/dev/vdb', 'writeback'), ('/dev/vdc', None)],
+                '/dev/vdd', 'cset'))
+        self.m_subp.assert_called_once_with(
+            ['make-bcache', '-B', '/dev/vdb', '/dev/vdc'])
+        self.m_ensure.assert_called_once_with({
+            '/dev/vdb': '/sys/class/block/vdb/bcache',
+            '/dev/vdc': '/sys/class/block/vdc/bcache'})
+        self.assertEqual([mock.call('/dev/vdb', '/dev/vdd', 'cset'),
+                          mock.call('/dev/vdc', '/dev/vdd', 'cset')],
+                         self.m_attach.call_args_list)
+        self.m_mode.assert_called_once_with('bcache0', 'writeback')
+
+    def test_create_backing_devices_raises_on_old_bcache(self):
+        """create_backing_devices refuses devices with an old bcache."""
+        self.m_exists.return_value = True
+        with self.assertRaises(RuntimeError):
+            bcache.create_backing_devices([('/dev/vdb', None)], '/dev/vdd',
+                                          'cset')
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_create_backing_device(self):
+        """create_backing_device creates a single bcache device."""
+        self.assertEqual('/dev/bcache0', bcache.create_backing_device(
+            '/dev/vdb', '/dev/vdd', 'writeback', 'cset'))
+        self.m_subp.assert_called_once_with(['make-bcache', '-B', '/dev/vdb'])
+
+
 # vi: ts=4 expandtab syntax=python
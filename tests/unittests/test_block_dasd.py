@@ -1,5 +1,6 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import mock
 import random
 import string
 import textwrap
@@ -293,6 +294,30 @@ class TestNeedsFormatting(CiTestCase):
             self.dasd.needs_formatting(
                 self.blocksize, self.disk_layout, None))
 
+    def test_format_mode_full_for_unformatted_disk(self):
+        self.m_not_fmt.return_value = True
+        self.assertEqual(
+            'full', self.dasd.format_mode(
+                self.blocksize, self.disk_layout, self.label))
+
+    def test_format_mode_full_for_blocksize_mismatch(self):
+        self.assertEqual(
+            'full', self.dasd.format_mode(
+                512, self.random_string(), self.random_string()))
+
+    def test_format_mode_quick_for_layout_or_label_mismatch(self):
+        self.assertEqual(
+            'quick', self.dasd.format_mode(
+                self.blocksize, self.random_string(), self.label))
+        self.assertEqual(
+            'quick', self.dasd.format_mode(
+                self.blocksize, self.disk_layout, self.random_string()))
+
+    def test_format_mode_none_if_matching(self):
+        self.assertIsNone(
+            self.dasd.format_mode(
+                self.blocksize, self.disk_layout, self.label))
+
 
 class TestFormat(CiTestCase):
 
@@ -376,6 +401,54 @@ class TestFormat(CiTestCase):
              '--mode=quick', '--force', self.dasd.devname], capture=True)
 
 
+DASDFMT_PERCENTAGE_OUTPUT = """\
+cyl       1 of   10017 |  0%
+cyl     101 of   10017 |  1%
+cyl    5009 of   10017 | 50%
+cyl   10017 of   10017 |100%
+Finished formatting the device.
+Rereading the partition table... ok
+"""
+
+
+class TestDasdfmtProgress(CiTestCase):
+
+    def test_parse_dasdfmt_progress(self):
+        parsed = [dasd.parse_dasdfmt_progress(line)
+                  for line in DASDFMT_PERCENTAGE_OUTPUT.splitlines()]
+        self.assertEqual(
+            [(1, 10017, 0), (101, 10017, 1), (5009, 10017, 50),
+             (10017, 10017, 100), None, None], parsed)
+
+    def test_dasdfmt_with_progress_reports_and_returns_output(self):
+        fmtout = self.tmp_path('dasdfmt.out')
+        util.write_file(fmtout, DASDFMT_PERCENTAGE_OUTPUT)
+        reported = []
+        out = dasd._dasdfmt_with_progress(
+            ['cat', fmtout], lambda *args: reported.append(args))
+        self.assertEqual(4, len(reported))
+        self.assertEqual((10017, 10017, 100), reported[-1])
+        self.assertEqual('Finished formatting the device.\n'
+                         'Rereading the partition table... ok\n', out)
+
+    def test_dasdfmt_with_progress_raises_on_failure(self):
+        with self.assertRaises(util.ProcessExecutionError):
+            dasd._dasdfmt_with_progress(
+                ['sh', '-c', 'echo "cyl 1 of 2 | 50%"; exit 1'],
+                lambda *args: None)
+
+    @mock.patch('curtin.block.dasd._dasdfmt_with_progress')
+    @mock.patch('curtin.block.dasd.os.path.exists')
+    def test_format_with_progress_adds_percentage(self, m_exists, m_run):
+        m_exists.return_value = True
+        device = dasd.DasdDevice(random_device_id())
+        progress = mock.Mock()
+        device.format(mode='full', progress=progress)
+        m_run.assert_called_with(
+            ['dasdfmt', '-y', '--blocksize=4096', '--disk_layout=cdl',
+             '--mode=full', '--percentage', device.devname], progress)
+
+
 class TestDasdInfo(CiTestCase):
 
     info = textwrap.dedent("""\
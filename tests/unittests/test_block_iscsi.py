@@ -747,4 +747,80 @@ class TestBlockIscsiDisconnect(CiTestCase):
 
         self.mock_subp.assert_has_calls([], any_order=True)
 
+
+class TestBlockIscsiConnectDisks(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockIscsiConnectDisks, self).setUp()
+        for func in ('iscsiadm_sessions', 'iscsiadm_discovery',
+                     'iscsiadm_authenticate', 'iscsiadm_login',
+                     'iscsiadm_set_automatic', 'save_iscsi_config'):
+            self.add_patch('curtin.block.iscsi.' + func, 'm_' + func)
+        self.add_patch('curtin.block.iscsi.udev', 'm_udev')
+        self.add_patch('curtin.block.iscsi.os.path.exists', 'm_exists')
+        self.m_iscsiadm_sessions.return_value = ''
+        self.m_exists.return_value = True
+        self.add_patch('curtin.block.iscsi._ISCSI_DISKS', new={})
+        self.disks = [
+            'iscsi:10.0.0.1::3260:1:tgt-a',
+            'iscsi:10.0.0.1::3260:2:tgt-a',
+            'iscsi:10.0.0.1::3260:1:tgt-b',
+            'iscsi:user:secret@10.0.0.2::3260:1:tgt-c',
+        ]
+
+    def test_connect_disks_groups_by_portal_and_target(self):
+        """one discovery per portal and one login per target."""
+        disks = iscsi.connect_disks(self.disks + self.disks[:1])
+        self.assertEqual([('tgt-a', 1), ('tgt-a', 2), ('tgt-b', 1),
+                          ('tgt-c', 1)], [(d.target, d.lun) for d in disks])
+        self.assertEqual(['10.0.0.1:3260', '10.0.0.2:3260'],
+                         sorted(c[0][0] for c in
+                                self.m_iscsiadm_discovery.call_args_list))
+        self.assertEqual(
+            sorted([mock.call('tgt-a', '10.0.0.1:3260'),
+                    mock.call('tgt-b', '10.0.0.1:3260'),
+                    mock.call('tgt-c', '10.0.0.2:3260')]),
+            sorted(self.m_iscsiadm_login.call_args_list))
+        self.assertIn(
+            mock.call('tgt-c', '10.0.0.2:3260', 'user', 'secret', None, None),
+            self.m_iscsiadm_authenticate.call_args_list)
+        self.assertEqual(3, self.m_iscsiadm_set_automatic.call_count)
+        self.assertEqual(1, self.m_iscsiadm_sessions.call_count)
+        self.assertEqual(4, self.m_save_iscsi_config.call_count)
+        self.assertEqual(sorted(self.disks),
+                         sorted(iscsi.connected_disks()))
+
+    def test_connect_disks_skips_targets_with_sessions(self):
+        """targets already logged in are not discovered or logged in to."""
+        self.m_iscsiadm_sessions.return_value = (
+            'tcp: [1] 10.0.0.1:3260,1 tgt-a (non-flash)\n'
+            'tcp: [2] 10.0.0.2:3260,1 tgt-c (non-flash)\n')
+        iscsi.connect_disks(self.disks)
+        self.m_iscsiadm_discovery.assert_called_once_with('10.0.0.1:3260')
+        self.m_iscsiadm_login.assert_called_once_with('tgt-b',
+                                                      '10.0.0.1:3260')
+        self.assertEqual(3, self.m_iscsiadm_set_automatic.call_count)
+
+    def test_connected_disks_are_not_connected_again(self):
+        """ensure_disk_connected reuses disks from connect_disks."""
+        iscsi.connect_disks(self.disks)
+        self.m_iscsiadm_sessions.reset_mock()
+        self.m_iscsiadm_login.reset_mock()
+        disk = iscsi.ensure_disk_connected(self.disks[3])
+        self.assertEqual('tgt-c', disk.target)
+        iscsi.connect_disks(self.disks)
+        self.assertEqual(0, self.m_iscsiadm_sessions.call_count)
+        self.assertEqual(0, self.m_iscsiadm_login.call_count)
+
+    def test_connect_disks_raises_on_login_failure(self):
+        """a failed login is raised and no disk is remembered."""
+        self.m_iscsiadm_login.side_effect = util.ProcessExecutionError()
+        with self.assertRaises(util.ProcessExecutionError):
+            iscsi.connect_disks(self.disks)
+        self.assertEqual({}, iscsi.connected_disks())
+
+    def test_connect_disks_nothing_to_do(self):
+        self.assertEqual([], iscsi.connect_disks([]))
+        self.assertEqual(0, self.m_iscsiadm_sessions.call_count)
+
 # vi: ts=4 expandtab syntax=python
@@ -2,44 +2,38 @@
 
 from curtin.block import lvm
 
+from curtin import util
 from .helpers import CiTestCase
+import json
 import mock
 
 
 class TestBlockLvm(CiTestCase):
     vg_name = 'ubuntu-volgroup'
 
-    @mock.patch('curtin.block.lvm.util')
-    def test_filter_lvm_info(self, mock_util):
+    def setUp(self):
+        super(TestBlockLvm, self).setUp()
+        lvm.invalidate()
+
+    @mock.patch('curtin.block.lvm.util.subp')
+    def test_filter_lvm_info(self, m_subp):
         """make sure lvm._filter_lvm_info filters properly"""
-        match_name = "vg_name"
         query_results = ["lv_1", "lv_2"]
-        lvtool_name = 'lvscan'
-        query_name = 'lv_name'
-        # NOTE: i didn't use textwrap.dedent here on purpose, want to make sure
-        #       that the function can handle leading spaces as some of the
-        #       tools have spaces before the fist column in their output
-        mock_util.subp.return_value = (
-            """
-            matchfield_bad1{sep}qfield1
-            {matchfield_good}{sep}{query_good1}
-            matchfield_bad2{sep}qfield2
-            {matchfield_good}{sep}{query_good2}
-            """.format(matchfield_good=self.vg_name,
-                       query_good1=query_results[0],
-                       query_good2=query_results[1],
-                       sep=lvm._SEP), "")
-        result_list = lvm._filter_lvm_info(lvtool_name, match_name,
-                                           query_name, self.vg_name)
-        self.assertEqual(len(result_list), 2)
-        mock_util.subp.assert_called_with(
-            [lvtool_name, '-C', '--separator', lvm._SEP, '--noheadings', '-o',
-             '{},{}'.format(match_name, query_name)], capture=True)
+        m_subp.return_value = (json.dumps({'report': [
+            {'vg': [{'vg_name': 'vg_bad'}],
+             'lv': [{'lv_name': 'lv_bad', 'vg_name': 'vg_bad'}]},
+            {'vg': [{'vg_name': self.vg_name}],
+             'lv': [{'lv_name': name, 'vg_name': self.vg_name}
+                    for name in query_results]},
+        ]}), '')
+        result_list = lvm._filter_lvm_info('lvs', 'vg_name', 'lv_name',
+                                           self.vg_name)
         self.assertEqual(result_list, query_results)
         # make sure _filter_lvm_info can fail gracefully if no match
-        result_list = lvm._filter_lvm_info(lvtool_name, match_name,
-                                           query_name, 'bad_match_val')
+        result_list = lvm._filter_lvm_info('lvs', 'vg_name', 'lv_name',
+                                           'bad_match_val')
         self.assertEqual(len(result_list), 0)
+        self.assertEqual(1, m_subp.call_count)
 
     @mock.patch('curtin.block.lvm._filter_lvm_info')
     def test_get_lvm_info(self, mock_filter_lvm_info):
@@ -115,6 +109,113 @@ class TestBlockLvm(CiTestCase):
         mock_util.subp.has_calls(calls)
 
 
+class TestLvmShell(CiTestCase):
+
+    @mock.patch('curtin.block.lvm.invalidate')
+    @mock.patch('curtin.block.lvm.util.subp')
+    def test_lvm_shell_runs_commands_in_one_process(self, m_subp, m_inval):
+        m_subp.return_value = ('', '')
+        lvm.lvm_shell([['vgcreate', 'vg0', '/dev/sda2'],
+                       ['lvcreate', 'vg0', '--name', 'lv0', '--size', '1G']])
+        m_subp.assert_called_once_with(
+            ['lvm'], data=('vgcreate vg0 /dev/sda2\n'
+                           'lvcreate vg0 --name lv0 --size 1G\n'),
+            capture=True)
+        self.assertEqual(1, m_inval.call_count)
+
+    @mock.patch('curtin.block.lvm.invalidate')
+    @mock.patch('curtin.block.lvm.util.subp')
+    @mock.patch('curtin.block.lvm.LOG')
+    def test_lvm_shell_failure_is_logged(self, m_log, m_subp, m_inval):
+        m_subp.side_effect = util.ProcessExecutionError(cmd=['lvm'])
+        lvm.lvm_shell([['vgcreate', 'vg0', '/dev/sda2']])
+        self.assertEqual(1, m_inval.call_count)
+        self.assertEqual(1, m_log.warning.call_count)
+
+    @mock.patch('curtin.block.lvm.util.subp')
+    def test_lvm_shell_rejects_whitespace(self, m_subp):
+        with self.assertRaises(ValueError):
+            lvm.lvm_shell([['vgcreate', 'vg 0', '/dev/sda2']])
+        self.assertEqual(0, m_subp.call_count)
+
+
+class TestLvmState(CiTestCase):
+
+    fullreport = {'report': [
+        {'vg': [{'vg_name': 'vg0', 'vg_size': '20971520B',
+                 'vg_free': '0B'}],
+         'pv': [{'pv_name': '/dev/sda2', 'vg_name': 'vg0',
+                 'pv_size': '10485760B'},
+                {'pv_name': '/dev/sdb2', 'vg_name': 'vg0',
+                 'pv_size': '10485760B'}],
+         'lv': [{'lv_name': 'root', 'vg_name': 'vg0',
+                 'lv_size': '16777216B', 'lv_path': '/dev/vg0/root'},
+                {'lv_name': 'swap', 'vg_name': 'vg0',
+                 'lv_size': '4194304B', 'lv_path': '/dev/vg0/swap'}]},
+        {'vg': [],
+         'pv': [{'pv_name': '/dev/sdc1', 'vg_name': '',
+                 'pv_size': '10485760B'}],
+         'lv': []},
+    ]}
+
+    def setUp(self):
+        super(TestLvmState, self).setUp()
+        self.add_patch('curtin.block.lvm.util.subp', 'm_subp')
+        self.m_subp.return_value = (json.dumps(self.fullreport), '')
+        lvm.invalidate()
+        self.addCleanup(lvm.invalidate)
+
+    def test_lookups_share_one_fullreport(self):
+        """pv, lv and size lookups are answered from one lvm fullreport."""
+        self.assertEqual(['/dev/sda2', '/dev/sdb2'],
+                         lvm.get_pvols_in_volgroup('vg0'))
+        self.assertEqual(['root', 'swap'], lvm.get_lvols_in_volgroup('vg0'))
+        self.assertEqual(16777216, lvm.get_lv_size_bytes('root'))
+        self.assertIsNone(lvm.get_lv_size_bytes('missing'))
+        self.assertEqual([], lvm.get_lvols_in_volgroup('vg1'))
+        self.assertEqual(1, self.m_subp.call_count)
+        cmd = self.m_subp.call_args[0][0]
+        self.assertEqual(['lvm', 'fullreport', '--reportformat', 'json'],
+                         cmd[:4])
+
+    def test_invalidate_rereads_report(self):
+        """After invalidate() the next lookup reads a new report."""
+        self.assertEqual(['root', 'swap'], lvm.get_lvols_in_volgroup('vg0'))
+        self.m_subp.return_value = (json.dumps({'report': []}), '')
+        self.assertEqual(['root', 'swap'], lvm.get_lvols_in_volgroup('vg0'))
+        lvm.invalidate()
+        self.assertEqual([], lvm.get_lvols_in_volgroup('vg0'))
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch('curtin.block.lvm.distro')
+    def test_lvm_scan_invalidates(self, m_distro):
+        m_distro.lsb_release.return_value = {'codename': 'focal'}
+        lvm.get_lvols_in_volgroup('vg0')
+        lvm.lvm_scan()
+        lvm.get_lvols_in_volgroup('vg0')
+        self.assertEqual(2, len([c for c in self.m_subp.call_args_list
+                                 if c[0][0][0] == 'lvm']))
+
+    def test_fallback_without_fullreport(self):
+        """Without lvm fullreport the snapshot is read with pvs/vgs/lvs."""
+        outputs = {
+            'pvs': '  /dev/sda2=vg0=10485760B\n  /dev/sdc1==10485760B\n',
+            'vgs': '  vg0=20971520B=0B\n',
+            'lvs': '  root=vg0=16777216B=/dev/vg0/root\n',
+        }
+
+        def subp(cmd, capture=False):
+            if cmd[0] == 'lvm':
+                raise util.ProcessExecutionError(cmd=cmd, exit_code=3)
+            return (outputs[cmd[0]], '')
+
+        self.m_subp.side_effect = subp
+        self.assertEqual(['/dev/sda2'], lvm.get_pvols_in_volgroup('vg0'))
+        self.assertEqual(['root'], lvm.get_lvols_in_volgroup('vg0'))
+        self.assertEqual(16777216, lvm.get_lv_size_bytes('root'))
+        self.assertEqual(4, self.m_subp.call_count)
+
+
 class TestBlockLvmMultipathFilter(CiTestCase):
 
     def test_generate_multipath_dev_mapper_filter(self):
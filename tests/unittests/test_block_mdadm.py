@@ -156,6 +156,18 @@ class TestBlockMdadmCreate(CiTestCase):
         self.m_udevadm_settle.assert_has_calls(
             [call(), call(exists=md_devname)])
 
+    def test_mdadm_create_assume_clean(self):
+        md_devname = "/dev/md0"
+        devices = ["/dev/vdc1", "/dev/vdd1"]
+        self.mock_util.subp.side_effect = [("ubuntu", ""), ("", ""),
+                                           ("", ""), ("", "")]
+        mdadm.mdadm_create(md_devname=md_devname, raidlevel=1,
+                           devices=devices, assume_clean=True)
+        self.mock_util.subp.assert_any_call(
+            ["mdadm", "--create", md_devname, "--run", "--homehost=ubuntu",
+             "--raid-devices=2", "--metadata=default", "--level=1",
+             "--assume-clean"] + devices, capture=True)
+
     def test_mdadm_create_raid0_devshort(self):
         md_devname = "md0"
         raidlevel = 0
@@ -276,6 +288,110 @@ class TestBlockMdadmCreate(CiTestCase):
         self.mock_util.subp.assert_has_calls(expected_calls)
 
 
+class TestBlockMdadmResync(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockMdadmResync, self).setUp()
+        self.add_patch('curtin.block.mdadm.is_valid_device', 'mock_valid')
+        self.add_patch('curtin.block.mdadm.md_sysfs_attr_path', 'm_attr_path')
+        self.mock_valid.return_value = True
+        self.sysfs = self.tmp_dir()
+        self.m_attr_path.side_effect = (
+            lambda md_devname, attr: os.path.join(self.sysfs, attr))
+
+    def write_attr(self, attr, value):
+        util.write_file(os.path.join(self.sysfs, attr), value + '\n')
+
+    def test_parse_sync_completed(self):
+        self.assertEqual((10, 200), mdadm._parse_sync_completed('10 / 200'))
+        self.assertEqual(None, mdadm._parse_sync_completed('none'))
+        self.assertEqual(None, mdadm._parse_sync_completed(None))
+        self.assertEqual((0, 0), mdadm._parse_sync_completed('delayed'))
+
+    def test_block_until_in_sync_reports_progress(self):
+        """md_block_until_in_sync rereads sync_completed until 'none'."""
+        self.write_attr('sync_action', 'resync')
+        self.write_attr('sync_completed', '0 / 300')
+        remaining = ['100 / 300', '200 / 300', 'none']
+        seen = []
+
+        def progress(completed, total):
+            seen.append((completed, total))
+            if remaining:
+                value = remaining.pop(0)
+                self.write_attr('sync_completed', value)
+                if value == 'none':
+                    self.write_attr('sync_action', 'idle')
+
+        mdadm.md_block_until_in_sync('/dev/md0', progress=progress,
+                                     interval=0.01)
+        self.assertEqual([(0, 300), (100, 300), (200, 300)], seen)
+
+    def test_block_until_in_sync_waits_for_pending_resync(self):
+        """A resync which has not started yet is waited for."""
+        self.write_attr('sync_action', 'resync')
+        self.write_attr('sync_completed', 'none')
+        seen = []
+
+        def progress(completed, total):
+            seen.append((completed, total))
+            self.write_attr('sync_action', 'idle')
+
+        mdadm.md_block_until_in_sync('/dev/md0', progress=progress,
+                                     interval=0.01)
+        self.assertEqual([(0, 0)], seen)
+
+    def test_block_until_in_sync_no_attribute(self):
+        mdadm.md_block_until_in_sync('/dev/md0', interval=0.01)
+
+    def test_block_until_in_sync_timeout(self):
+        self.write_attr('sync_action', 'resync')
+        self.write_attr('sync_completed', '0 / 300')
+        with self.assertRaises(RuntimeError):
+            mdadm.md_block_until_in_sync('/dev/md0', timeout=0.05,
+                                         interval=0.01)
+
+    def test_set_sync_speed_max_returns_previous(self):
+        self.write_attr('sync_speed_max', '200000 (system)')
+        self.assertEqual('system',
+                         mdadm.md_set_sync_speed_max('/dev/md0', 1000))
+        self.assertEqual('1000', util.load_file(
+            os.path.join(self.sysfs, 'sync_speed_max')))
+        self.write_attr('sync_speed_max', '5000 (local)')
+        self.assertEqual('5000',
+                         mdadm.md_set_sync_speed_max('/dev/md0', 1000))
+
+    def test_set_sync_speed_max_no_attribute(self):
+        self.assertIsNone(mdadm.md_set_sync_speed_max('/dev/md0', 1000))
+
+    def test_record_and_restore_sync_speed(self):
+        state_file = self.tmp_path('md_sync_speed.json')
+        mdadm.md_record_sync_speed(state_file, '/dev/md0', 'system')
+        mdadm.md_record_sync_speed(state_file, '/dev/md0', '1000')
+        self.write_attr('sync_speed_max', '1000 (local)')
+        mdadm.md_restore_sync_speed(state_file)
+        self.assertEqual('system', util.load_file(
+            os.path.join(self.sysfs, 'sync_speed_max')))
+        self.assertFalse(os.path.exists(state_file))
+
+    def test_restore_sync_speed_skips_missing_arrays(self):
+        state_file = self.tmp_path('md_sync_speed.json')
+        mdadm.md_record_sync_speed(state_file, '/dev/md0', 'system')
+        mdadm.md_restore_sync_speed(state_file)
+        self.assertFalse(os.path.exists(state_file))
+
+    def test_assume_clean_safe(self):
+        for level in (1, '1', 'raid1', 'mirror', 10, 'raid10'):
+            self.assertTrue(mdadm.md_assume_clean_safe(level), level)
+        for level in (5, 'raid5', 6, 'raid6', 4):
+            self.assertFalse(mdadm.md_assume_clean_safe(level), level)
+            self.assertTrue(mdadm.md_assume_clean_safe(level, zeroed=True),
+                            level)
+        for level in (0, 'raid0', 'linear', 'stripe', 'container'):
+            self.assertFalse(mdadm.md_assume_clean_safe(level, zeroed=True),
+                             level)
+
+
 class TestBlockMdadmExamine(CiTestCase):
     def setUp(self):
         super(TestBlockMdadmExamine, self).setUp()
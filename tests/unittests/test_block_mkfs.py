@@ -2,8 +2,11 @@
 
 from curtin.block import mkfs
 
-from .helpers import CiTestCase
+from .helpers import CiTestCase, populate_dir
 import mock
+import os
+
+GiB = 1024 ** 3
 
 
 class TestBlockMkfs(CiTestCase):
@@ -34,15 +37,20 @@ class TestBlockMkfs(CiTestCase):
         # Only remaining vals in call should be mkfs.fstype and dev path
         self.assertEquals(len(call), 2)
 
+    @mock.patch("curtin.block.mkfs.get_topology")
     @mock.patch("curtin.block.mkfs.block")
     @mock.patch("curtin.block.mkfs.os")
     @mock.patch("curtin.block.mkfs.util")
     @mock.patch("curtin.block.mkfs.distro.lsb_release")
     def _run_mkfs_with_config(self, config, expected_cmd, expected_flags,
                               mock_lsb_release, mock_util, mock_os, mock_block,
-                              release="wily", strict=False):
+                              mock_topology, release="wily", strict=False):
         # Pretend we are on wily as there are no known edge cases for it
         mock_lsb_release.return_value = {"codename": release}
+        # a plain ssd, nothing to tune
+        mock_topology.return_value = {
+            'stripe_unit': 0, 'stripe_width': 0, 'rotational': False,
+            'discard': True, 'size': 10 * GiB}
         mock_os.path.exists.return_value = True
         mock_block.get_blockdev_sector_size.return_value = (512, 512)
 
@@ -174,4 +182,153 @@ class TestBlockMkfs(CiTestCase):
         uuid = mkfs.mkfs("/dev/null", "ext4")
         self.assertIsNotNone(uuid)
 
+
+class TestMkfsTopology(CiTestCase):
+
+    def setUp(self):
+        super(TestMkfsTopology, self).setUp()
+        self.sysfs = self.tmp_dir()
+        self.add_patch('curtin.block.mkfs.block.sys_block_path',
+                       'm_sys_block_path')
+        self.m_sys_block_path.side_effect = (
+            lambda devpath: os.path.join(self.sysfs, os.path.basename(
+                devpath)))
+
+    def add_device(self, kname, queue=None, md=None, size=20 * GiB):
+        files = {'%s/size' % kname: str(size // 512)}
+        for (attr, value) in (queue or {}).items():
+            files['%s/queue/%s' % (kname, attr)] = str(value)
+        for (attr, value) in (md or {}).items():
+            files['%s/md/%s' % (kname, attr)] = str(value)
+        populate_dir(self.sysfs, files)
+
+    def test_md_raid5_stripe(self):
+        self.add_device('md0', md={'level': 'raid5', 'raid_disks': 5,
+                                   'chunk_size': 524288},
+                        queue={'rotational': 1})
+        self.assertEqual(
+            {'stripe_unit': 524288, 'stripe_width': 4, 'rotational': True,
+             'discard': False, 'size': 20 * GiB},
+            mkfs.get_topology('/dev/md0'))
+
+    def test_md_data_disks(self):
+        for (level, disks, layout, expected) in (
+                ('raid0', 4, 0, 4), ('raid6', 6, 0, 4), ('raid4', 3, 0, 2),
+                ('raid10', 4, 0x102, 2), ('raid10', 6, 0x201, 3),
+                ('raid1', 2, 0, 0)):
+            md_sysfs = self.tmp_dir()
+            populate_dir(md_sysfs, {'level': level, 'raid_disks': str(disks),
+                                    'layout': str(layout)})
+            self.assertEqual(expected, mkfs._md_data_disks(md_sysfs), level)
+
+    def test_partition_uses_disk_queue(self):
+        self.add_device('md0', md={'level': 'raid6', 'raid_disks': 6,
+                                   'chunk_size': 65536},
+                        queue={'rotational': 0, 'discard_max_bytes': 4096})
+        populate_dir(self.sysfs, {'md0/md0p1/partition': '1',
+                                  'md0/md0p1/size': str(GiB // 512)})
+        os.symlink(os.path.join(self.sysfs, 'md0/md0p1'),
+                   os.path.join(self.sysfs, 'md0p1'))
+        self.assertEqual(
+            {'stripe_unit': 65536, 'stripe_width': 4, 'rotational': False,
+             'discard': True, 'size': GiB},
+            mkfs.get_topology('/dev/md0p1'))
+
+    def test_stripe_from_io_hints_below_in_stack(self):
+        """bcache does not pass io hints on, they are read from below."""
+        self.add_device('bcache0', queue={'rotational': 1,
+                                          'minimum_io_size': 512})
+        self.add_device('sdb', queue={'rotational': 1,
+                                      'minimum_io_size': 65536,
+                                      'optimal_io_size': 196608})
+        topology = mkfs.get_topology('/dev/bcache0', stack=['/dev/sdb'])
+        self.assertEqual((65536, 3), (topology['stripe_unit'],
+                                      topology['stripe_width']))
+
+    def test_unstriped_disk(self):
+        self.add_device('sda', queue={'rotational': 0,
+                                      'minimum_io_size': 4096,
+                                      'optimal_io_size': 0,
+                                      'discard_max_bytes': 2147450880})
+        self.assertEqual(
+            {'stripe_unit': 0, 'stripe_width': 0, 'rotational': False,
+             'discard': True, 'size': 20 * GiB},
+            mkfs.get_topology('/dev/sda'))
+
+
+class TestMkfsTuneExtraOptions(CiTestCase):
+
+    raid_hdd = {'stripe_unit': 65536, 'stripe_width': 4, 'rotational': True,
+                'discard': True, 'size': 20 * GiB}
+    ssd = {'stripe_unit': 0, 'stripe_width': 0, 'rotational': False,
+           'discard': True, 'size': 20 * GiB}
+
+    def test_ext4_striped_rotational(self):
+        self.assertEqual(
+            ['-E', 'stride=16,stripe_width=64,nodiscard'],
+            mkfs.tune_extra_options('ext4', self.raid_hdd))
+
+    def test_ext4_ssd_not_tuned(self):
+        self.assertEqual(['-O', '^metadata_csum'],
+                         mkfs.tune_extra_options('ext4', self.ssd,
+                                                 ['-O', '^metadata_csum']))
+
+    def test_ext4_small_filesystem_not_striped(self):
+        topology = dict(self.raid_hdd, size=256 * 1024 * 1024)
+        self.assertEqual(['-E', 'nodiscard'],
+                         mkfs.tune_extra_options('ext4', topology))
+
+    def test_ext_explicit_extended_options_win(self):
+        self.assertEqual(
+            ['-D', '-E', 'stripe-width=32,discard,offset=1024'],
+            mkfs.tune_extra_options(
+                'ext4', self.raid_hdd,
+                ['-D', '-E', 'stripe-width=32,discard', '-Eoffset=1024']))
+
+    def test_ext3_striped_rotational(self):
+        self.assertEqual(['-E', 'stride=16,stripe_width=64,nodiscard'],
+                         mkfs.tune_extra_options('ext3', self.raid_hdd))
+
+    def test_xfs_striped_rotational(self):
+        self.assertEqual(['-d', 'su=65536,sw=4', '-K'],
+                         mkfs.tune_extra_options('xfs', self.raid_hdd))
+
+    def test_xfs_explicit_stripe_wins(self):
+        self.assertEqual(['-K', '-d', 'sunit=128,swidth=512'],
+                         mkfs.tune_extra_options(
+                             'xfs', self.raid_hdd,
+                             ['-d', 'sunit=128,swidth=512']))
+
+    def test_other_filesystems_untouched(self):
+        self.assertEqual([], mkfs.tune_extra_options('btrfs', self.raid_hdd))
+
+    @mock.patch('curtin.block.mkfs.mkfs')
+    @mock.patch('curtin.block.mkfs.get_topology')
+    def test_mkfs_from_config_tunes(self, m_topology, m_mkfs):
+        m_topology.return_value = self.raid_hdd
+        mkfs.mkfs_from_config('/dev/md0', {'fstype': 'xfs'},
+                              stack=['/dev/sda'], tune=True)
+        m_topology.assert_called_with('/dev/md0', stack=['/dev/sda'])
+        m_mkfs.assert_called_with(
+            '/dev/md0', 'xfs', strict=False, force=True, uuid=None,
+            label=None, extra_options=['-d', 'su=65536,sw=4', '-K'])
+
+    @mock.patch('curtin.block.mkfs.mkfs')
+    @mock.patch('curtin.block.mkfs.get_topology')
+    def test_mkfs_from_config_without_topology(self, m_topology, m_mkfs):
+        m_topology.side_effect = OSError('no sysfs')
+        mkfs.mkfs_from_config('/dev/md0', {'fstype': 'xfs'}, tune=True)
+        m_mkfs.assert_called_with(
+            '/dev/md0', 'xfs', strict=False, force=True, uuid=None,
+            label=None, extra_options=None)
+
+    @mock.patch('curtin.block.mkfs.mkfs')
+    @mock.patch('curtin.block.mkfs.get_topology')
+    def test_mkfs_from_config_not_tuned_by_default(self, m_topology, m_mkfs):
+        mkfs.mkfs_from_config('/dev/md0', {'fstype': 'xfs'})
+        self.assertEqual(0, m_topology.call_count)
+        m_mkfs.assert_called_with(
+            '/dev/md0', 'xfs', strict=False, force=True, uuid=None,
+            label=None, extra_options=None)
+
 # vi: ts=4 expandtab syntax=python
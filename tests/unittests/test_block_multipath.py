@@ -20,6 +20,7 @@ class TestMultipath(CiTestCase):
         self.add_patch('curtin.block.multipath.udev', 'm_udev')
 
         self.m_subp.return_value = ("", "")
+        multipath.invalidate()
 
     def test_show_paths(self):
         """verify show_paths extracts mulitpath path data correctly."""
@@ -299,4 +300,103 @@ class TestMultipath(CiTestCase):
                          sorted(m_del_file.call_args_list))
 
 
+SHOW_PATHS_OUTPUT = '''\
+device='sda' serial='0QEMU_QEMU_HARDDISK_1' multipath='mpatha'
+device='sdb' serial='0QEMU_QEMU_HARDDISK_1' multipath='mpatha'
+device='sdc' serial='0QEMU_QEMU_HARDDISK_2' multipath='mpathb'
+device='sdd' serial='0QEMU_QEMU_HARDDISK_3' multipath='[orphan]'
+'''
+
+DMSETUP_LS_MPATH_OUTPUT = '''\
+mpatha	(dm-0)
+mpatha-part1	(dm-1)
+mpatha-part2	(dm-3)
+mpathb	(dm-2)
+'''
+
+
+class TestMultipathTopology(CiTestCase):
+
+    def setUp(self):
+        super(TestMultipathTopology, self).setUp()
+        self.add_patch('curtin.block.multipath.util.subp', 'm_subp')
+        self.add_patch('curtin.block.multipath.udev', 'm_udev')
+        self.outputs = {
+            'paths': SHOW_PATHS_OUTPUT,
+            'ls': DMSETUP_LS_MPATH_OUTPUT,
+        }
+
+        def subp(cmd, **kwargs):
+            for verb in self.outputs:
+                if verb in cmd:
+                    return (self.outputs[verb], '')
+            return ('', '')
+        self.m_subp.side_effect = subp
+        multipath.invalidate()
+
+    def queries(self):
+        return [c[0][0] for c in self.m_subp.call_args_list]
+
+    def test_lookups_query_each_kind_once(self):
+        """member and partition lookups share one query of each kind."""
+        topology = multipath.MULTIPATH_TOPOLOGY
+        self.outputs['paths'] = SHOW_PATHS_OUTPUT.replace('[orphan]',
+                                                          'mpathc')
+        for _ in range(3):
+            self.assertEqual('mpatha', topology.member_map('/dev/sdb'))
+            self.assertEqual('mpathb',
+                             multipath.find_mpath_id_by_path('/dev/sdc'))
+            self.assertIsNone(topology.member_map('/dev/sde'))
+            self.assertEqual(['/dev/sda', '/dev/sdb'],
+                             multipath.find_mpath_members('mpatha'))
+            self.assertEqual(['mpatha-part1', 'mpatha-part2'],
+                             sorted(multipath.find_mpath_partitions('mpatha')))
+            self.assertEqual([], topology.map_partitions('mpathb'))
+            self.assertEqual(('mpatha-part2', '/dev/dm-3'),
+                             multipath.find_mpath_id_by_parent('mpatha', 2))
+        self.assertEqual(2, self.m_subp.call_count)
+
+    def test_reload_and_remove_invalidate(self):
+        """reload, remove_map and remove_partition refresh the topology."""
+        for func, arg in ((multipath.reload, None),
+                          (multipath.remove_map, 'mpatha'),
+                          (multipath.remove_partition, '/dev/dm-1')):
+            self.assertEqual('mpatha',
+                             multipath.find_mpath_id_by_path('/dev/sda'))
+            with mock.patch('curtin.block.multipath.os.path.exists',
+                            return_value=False):
+                func(*([arg] if arg else []))
+            self.m_subp.reset_mock()
+            multipath.find_mpath_id_by_path('/dev/sda')
+            self.assertEqual(1, self.m_subp.call_count)
+
+    def test_find_mpath_members_waits_for_orphans(self):
+        """find_mpath_members re-reads paths while paths are orphaned."""
+        outputs = [SHOW_PATHS_OUTPUT,
+                   SHOW_PATHS_OUTPUT.replace('[orphan]', 'mpathc')]
+
+        def subp(cmd, **kwargs):
+            return (outputs.pop(0) if len(outputs) > 1 else outputs[0], '')
+        self.m_subp.side_effect = subp
+        self.assertEqual(['/dev/sdd'], multipath.find_mpath_members('mpathc'))
+        self.assertEqual(1, self.m_udev.udevadm_settle.call_count)
+
+    def test_find_mpath_members_waits_for_orphans_once(self):
+        """a path orphaned for good is only waited for once per snapshot."""
+        for _ in range(3):
+            self.assertEqual(['/dev/sdc'],
+                             multipath.find_mpath_members('mpathb'))
+        self.assertEqual(5, self.m_udev.udevadm_settle.call_count)
+        self.assertEqual(6, self.m_subp.call_count)
+
+    def test_get_mpath_id_from_device_refreshes_on_miss(self):
+        """a member missing from the snapshot causes one refresh."""
+        self.m_udev.udevadm_info.return_value = {
+            'DM_MULTIPATH_DEVICE_PATH': '1'}
+        self.assertIsNone(multipath.find_mpath_id_by_path('/dev/sde'))
+        self.outputs['paths'] += "device='sde' multipath='mpathc'\n"
+        self.assertEqual('mpathc',
+                         multipath.get_mpath_id_from_device('/dev/sde'))
+        self.assertEqual(1, self.m_udev.udevadm_info.call_count)
+
 # vi: ts=4 expandtab syntax=python
@@ -200,15 +200,16 @@ class TestBlockZfsZpoolCreate(CiTestCase):
         # the arg list sorted
         expected_args = [
             ['zpool', 'create', '-o', 'ashift=12', '-o', 'version=28',
+             '-o', 'cachefile=/etc/zfs/zpool.cache',
              '-O', 'normalization=formD', '-O', 'canmount=off',
              '-O', 'atime=off', '-O', 'mountpoint=%s' % mountpoint,
-             '-R', altroot, pool, vdev],
-            ['zpool', 'set', 'cachefile=/etc/zfs/zpool.cache', pool]]
+             '-R', altroot, pool, vdev]]
         expected_kwargs = {'capture': True}
         for index in range(0, len(expected_args)):
             _name, args, kwargs = self.mock_subp.mock_calls[index]
             self.assertEqual(sorted(expected_args[index]), sorted(args[0]))
             self.assertEqual(expected_kwargs, kwargs)
+        self.assertEqual(1, self.mock_subp.call_count)
 
 
 class TestBlockZfsZfsCreate(CiTestCase):
@@ -251,6 +252,23 @@ class TestBlockZfsZfsCreate(CiTestCase):
         self.mock_subp.assert_called_with(['zfs', 'create', 'rpool/ROOT'],
                                           capture=True)
 
+    def test_zfs_create_parents(self):
+        """ zfs.zfs_create creates missing parents if asked to """
+        zfs.zfs_create('rpool', 'ROOT/zfsroot', parents=True,
+                       zfs_properties={'canmount': 'off'})
+        self.assertEqual(
+            [mock.call(['zfs', 'create', '-p', 'rpool/ROOT'], capture=True),
+             mock.call(['zfs', 'create', '-o', 'canmount=off',
+                        'rpool/ROOT/zfsroot'], capture=True)],
+            self.mock_subp.call_args_list)
+
+    def test_zfs_create_parents_top_level(self):
+        """ zfs.zfs_create does not run -p for top level datasets """
+        zfs.zfs_create('rpool', 'ROOT', parents=True)
+        self.assertEqual(
+            [mock.call(['zfs', 'create', 'rpool/ROOT'], capture=True)],
+            self.mock_subp.call_args_list)
+
     def test_zfs_create_calls_mount_if_canmount_is_noauto(self):
         """ zfs.zfs_create calls zfs mount if canmount=noauto """
         pool = 'rpool'
@@ -262,6 +280,70 @@ class TestBlockZfsZfsCreate(CiTestCase):
                                           capture=True)
 
 
+class TestBlockZfsProfiles(CiTestCase):
+
+    def test_profile_properties_are_defaults(self):
+        """ explicit properties override the profile """
+        self.assertEqual(
+            {'compression': 'off', 'recordsize': '16K', 'atime': 'on'},
+            zfs.zfs_profile_properties('database', {'compression': 'off',
+                                                    'atime': 'on'}))
+
+    def test_profile_compression_follows_pool_version(self):
+        """ profiles use lz4 only on pools with feature flags """
+        self.assertEqual({'compression': 'on'},
+                         zfs.zfs_profile_properties('general'))
+        self.assertEqual(
+            {'compression': 'lz4'},
+            zfs.zfs_profile_properties('general', {},
+                                       {'version': 5000, 'ashift': 13}))
+        self.assertEqual(
+            {'compression': 'off'},
+            zfs.zfs_profile_properties('incompressible', {},
+                                       {'version': 5000}))
+
+    def test_zpool_has_lz4(self):
+        self.assertFalse(zfs.zpool_has_lz4())
+        self.assertFalse(zfs.zpool_has_lz4({'version': '28'}))
+        self.assertTrue(zfs.zpool_has_lz4({'version': '5000'}))
+
+    def test_no_profile(self):
+        self.assertEqual({}, zfs.zfs_profile_properties(None))
+        self.assertEqual({'a': 1}, zfs.zfs_profile_properties(None,
+                                                              {'a': 1}))
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            zfs.zfs_profile_properties('fast')
+
+    def test_profiles_match_schema(self):
+        from curtin.block import schemas
+        self.assertEqual(sorted(zfs.ZFS_PROFILES),
+                         schemas.definitions['zfs_profile']['enum'])
+
+
+class TestBlockZfsZpoolAshift(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockZfsZpoolAshift, self).setUp()
+        self.add_patch('curtin.block.zfs.get_blockdev_sector_size',
+                       'm_sector_size')
+
+    def test_ashift_at_least_default(self):
+        self.m_sector_size.return_value = (512, 512)
+        self.assertEqual(12, zfs.zpool_ashift(['/dev/sda', '/dev/sdb']))
+
+    def test_ashift_largest_physical_sector(self):
+        sizes = {'/dev/sda': (512, 4096), '/dev/nvme0n1': (4096, 16384),
+                 '/dev/sdb': (512, 512)}
+        self.m_sector_size.side_effect = lambda dev: sizes[dev]
+        self.assertEqual(14, zfs.zpool_ashift(sorted(sizes)))
+
+    def test_ashift_capped(self):
+        self.m_sector_size.return_value = (4096, 1 << 20)
+        self.assertEqual(16, zfs.zpool_ashift(['/dev/sda']))
+
+
 class TestBlockZfsZfsMount(CiTestCase):
 
     def setUp(self):
@@ -1,5 +1,6 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import copy
 import mock
 import os
 import textwrap
@@ -7,7 +8,7 @@ import uuid
 
 from curtin.block import clear_holders
 from curtin.util import ProcessExecutionError
-from .helpers import CiTestCase
+from .helpers import CiTestCase, populate_dir
 
 
 class TestClearHolders(CiTestCase):
@@ -89,6 +90,19 @@ class TestClearHolders(CiTestCase):
         self.assertEqual(res, uuid)
         mock_block.sysfs_to_devpath.assert_called_with(self.test_syspath)
 
+    @mock.patch('curtin.block.clear_holders.block')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_get_dmsetup_uuid_from_sysfs(self, mock_util, mock_block):
+        """clear_holders.get_dmsetup_uuid reads dm/uuid from sysfs"""
+        uuid = "LVM-Ldq1iDDwLm1G4G6kXMOqVXKsIhWbJtDd"
+        syspath = self.tmp_dir()
+        populate_dir(syspath, {'dm/uuid': uuid})
+        mock_util.load_file.return_value = uuid + '\n'
+        self.assertEqual(uuid, clear_holders.get_dmsetup_uuid(syspath))
+        mock_util.load_file.assert_called_with(
+            os.path.join(syspath, 'dm', 'uuid'))
+        self.assertEqual(0, mock_util.subp.call_count)
+
     @mock.patch('curtin.block.clear_holders.get_dmsetup_uuid')
     @mock.patch('curtin.block.clear_holders.block')
     def test_differentiate_lvm_and_crypt(
@@ -654,6 +668,64 @@ class TestClearHolders(CiTestCase):
                                   for e in res[:len(level)]}, level)
                 res = res[len(level):]
 
+    def test_get_shutdown_graph(self):
+        """clear_holders.get_shutdown_graph chains devices per stack"""
+        trees = self.example_holders_trees[1]
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        graph = clear_holders.get_shutdown_graph(trees, plan)
+        self.assertEqual([e['device'] for e in plan], list(graph))
+        vdb_stack = [e['device'] for e in plan
+                     if os.path.basename(e['device']) not in
+                     ('vdc', 'vdd', 'vdd1')]
+        self.assertEqual(set(), graph[vdb_stack[0]])
+        for (previous, device) in zip(vdb_stack, vdb_stack[1:]):
+            self.assertEqual({previous}, graph[device])
+        self.assertEqual(set(), graph['/sys/class/block/vdc'])
+        self.assertEqual(set(), graph['/sys/class/block/vdd/vdd1'])
+        self.assertEqual({'/sys/class/block/vdd/vdd1'},
+                         graph['/sys/class/block/vdd'])
+
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.gen_holders_trees')
+    def test_clear_holders_stacks_concurrently(self, m_gen_trees, m_exists):
+        """clear_holders shuts down stacks concurrently, in order per stack"""
+        m_gen_trees.return_value = self.example_holders_trees[1]
+        m_exists.return_value = True
+        plan = [e['device'] for e in
+                clear_holders.plan_shutdown_holder_trees(
+                    self.example_holders_trees[1])]
+        for workers in (1, 3):
+            shutdown = []
+            m_shutdown = mock.Mock(side_effect=shutdown.append)
+            dev_types = {dev_type: {'shutdown': m_shutdown}
+                         for dev_type in clear_holders.DEV_TYPES}
+            with mock.patch.dict(clear_holders.DEV_TYPES, dev_types):
+                clear_holders.clear_holders(['/dev/vdb', '/dev/vdc',
+                                             '/dev/vdd'], workers=workers)
+            self.assertEqual(sorted(plan), sorted(shutdown))
+            vdb_stack = [d for d in plan if 'vdb' in d or 'cache' in d or
+                         'md0' in d]
+            self.assertEqual(vdb_stack, [d for d in shutdown
+                                         if d in vdb_stack])
+            self.assertLess(shutdown.index('/sys/class/block/vdd/vdd1'),
+                            shutdown.index('/sys/class/block/vdd'))
+            if workers == 1:
+                self.assertEqual(plan, shutdown)
+
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.gen_holders_trees')
+    def test_clear_holders_stops_on_error(self, m_gen_trees, m_exists):
+        """clear_holders raises the first shutdown error, skipping the rest"""
+        m_gen_trees.return_value = self.example_holders_trees[0]
+        m_exists.return_value = True
+        m_shutdown = mock.Mock(side_effect=OSError('busy'))
+        dev_types = {dev_type: {'shutdown': m_shutdown}
+                     for dev_type in clear_holders.DEV_TYPES}
+        with mock.patch.dict(clear_holders.DEV_TYPES, dev_types):
+            with self.assertRaises(OSError):
+                clear_holders.clear_holders('/dev/sda', workers=4)
+        m_shutdown.assert_called_once_with('/sys/class/block/dm-3')
+
     def test_format_holders_tree(self):
         """test output of clear_holders.format_holders_tree"""
         test_trees_and_results = [
@@ -728,6 +800,73 @@ class TestClearHolders(CiTestCase):
         for tree, result in test_trees_and_results:
             self.assertEqual(clear_holders.get_holder_types(tree), result)
 
+    @mock.patch('curtin.block.clear_holders.block')
+    @mock.patch('curtin.block.clear_holders.get_holders')
+    def test_gen_holders_trees_shares_scan(self, m_get_holders, m_block):
+        """gen_holders_trees identifies each device once, sharing subtrees"""
+        holders = {'vdb1': ['md0'], 'vdc1': ['md0'], 'md0': ['bcache0'],
+                   'bcache0': [], 'vdb': [], 'vdc': []}
+        partitions = {'vdb': ['vdb1'], 'vdc': ['vdc1']}
+        types = {'vdb1': 'partition', 'vdc1': 'partition', 'md0': 'raid',
+                 'bcache0': 'bcache'}
+
+        def syspath(dev):
+            return '/sys/class/block/' + os.path.basename(dev)
+
+        m_block.sys_block_path.side_effect = syspath
+        m_block.path_to_kname.side_effect = os.path.basename
+        m_block.get_sysfs_partitions.side_effect = (
+            lambda dev: [syspath(p) for p in
+                         partitions.get(os.path.basename(dev), [])])
+        m_get_holders.side_effect = lambda dev: holders[os.path.basename(dev)]
+        identified = []
+
+        def ident(dev_type):
+            def _ident(device):
+                identified.append(device)
+                return types.get(os.path.basename(device)) == dev_type
+            return _ident
+
+        dev_types = {dev_type: {'ident': ident(dev_type)}
+                     for dev_type in ('partition', 'raid', 'bcache')}
+        with mock.patch.dict(clear_holders.DEV_TYPES, dev_types, clear=True):
+            (vdb, vdc) = clear_holders.gen_holders_trees(
+                ['/dev/vdb', '/dev/vdc'])
+
+        md0 = vdb['holders'][0]['holders'][0]
+        self.assertEqual('raid', md0['dev_type'])
+        self.assertEqual('bcache', md0['holders'][0]['dev_type'])
+        self.assertIs(md0, vdc['holders'][0]['holders'][0])
+        self.assertEqual(6, m_get_holders.call_count)
+        for device in ['vdb', 'vdc', 'vdb1', 'vdc1', 'md0', 'bcache0']:
+            self.assertLessEqual(
+                identified.count('/sys/class/block/' + device), 3)
+        self.assertEqual(
+            clear_holders.format_holders_tree(vdb),
+            textwrap.dedent("""
+                vdb
+                `-- vdb1
+                    `-- md0
+                        `-- bcache0
+                """).strip())
+
+    def test_plan_shutdown_holder_trees_shared_subtrees(self):
+        """plan_shutdown_holder_trees plans shared subtrees like copies"""
+        md0 = {'device': '/sys/class/block/md0', 'name': 'md0',
+               'dev_type': 'raid', 'holders': [
+                   {'device': '/sys/class/block/bcache0', 'name': 'bcache0',
+                    'dev_type': 'bcache', 'holders': []}]}
+        trees = [
+            {'device': '/sys/class/block/' + disk, 'name': disk,
+             'dev_type': 'disk', 'holders': [
+                 {'device': '/sys/class/block/%s1' % disk,
+                  'name': disk + '1', 'dev_type': 'partition',
+                  'holders': [md0]}]}
+            for disk in ('vdb', 'vdc', 'vdd')]
+        self.assertEqual(
+            clear_holders.plan_shutdown_holder_trees(copy.deepcopy(trees)),
+            clear_holders.plan_shutdown_holder_trees(trees))
+
     @mock.patch('curtin.block.clear_holders.os.path.exists')
     @mock.patch('curtin.block.clear_holders.block.sys_block_path')
     @mock.patch('curtin.block.clear_holders.gen_holders_tree')
@@ -802,4 +941,94 @@ class TestClearHolders(CiTestCase):
         clear_holders.shutdown_swap(blockdev)
         self.assertEqual(0, mock_util.subp.call_count)
 
+
+class TestScanStorageSignatures(CiTestCase):
+
+    size = 8 * 1024 * 1024
+
+    def make_device(self, *signatures):
+        """create a blank device image with signatures at (offset, data)"""
+        path = self.tmp_path('disk.img')
+        with open(path, 'wb') as fp:
+            fp.truncate(self.size)
+            for (offset, data) in signatures:
+                fp.seek(offset if offset >= 0 else self.size + offset)
+                fp.write(data)
+        return path
+
+    def test_blank_device(self):
+        """scan_storage_signatures finds nothing on a blank device"""
+        self.assertEqual(
+            set(), clear_holders.scan_storage_signatures(self.make_device()))
+
+    def test_missing_device_is_skipped(self):
+        """scan_storage_signatures skips devices which do not exist"""
+        self.assertEqual(set(), clear_holders.scan_storage_signatures(
+            [self.tmp_path('missing.img')]))
+
+    def test_lvm_crypt_and_zfs_signatures(self):
+        """scan_storage_signatures finds lvm, luks and zfs metadata"""
+        lvm_label = (512, b'LABELONE' + b'\0' * 16 + b'LVM2 001')
+        luks = (0, b'LUKS\xba\xbe')
+        uberblock = (-256 * 1024 + 128 * 1024 + 3 * 1024,
+                     b'\x0c\xb1\xba\x00\x00\x00\x00\x00')
+        for (signature, layer) in ((lvm_label, 'lvm'), (luks, 'crypt'),
+                                   (uberblock, 'zfs')):
+            self.assertEqual({layer}, clear_holders.scan_storage_signatures(
+                self.make_device(signature)))
+
+    def test_raid_and_bcache_signatures_return_all_layers(self):
+        """metadata of raid or bcache means any layer may be stacked above"""
+        all_layers = {'raid', 'lvm', 'bcache', 'crypt', 'zfs'}
+        md_magic = b'\xfc\x4e\x2b\xa9'
+        for signature in ((4096, md_magic), (0, md_magic),
+                          (-8192, md_magic), (-65536, md_magic),
+                          (4096 + 24, clear_holders.BCACHE_MAGIC)):
+            self.assertEqual(all_layers, clear_holders.scan_storage_signatures(
+                self.make_device(signature)))
+
+    @mock.patch('curtin.block.clear_holders.open', create=True)
+    def test_unreadable_device_returns_all_layers(self, m_open):
+        """scan_storage_signatures assumes all layers on read errors"""
+        m_open.side_effect = IOError('read error')
+        self.assertEqual({'raid', 'lvm', 'bcache', 'crypt', 'zfs'},
+                         clear_holders.scan_storage_signatures(
+                             self.make_device()))
+
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_start_clear_holders_deps_blank_devices(
+            self, m_util, m_mdadm, m_zfs, m_lvm, m_mp, m_udev):
+        """start_clear_holders_deps starts nothing for blank devices"""
+        m_mp.multipath_supported.return_value = False
+        clear_holders.start_clear_holders_deps([self.make_device()])
+        self.assertEqual(0, m_mdadm.mdadm_assemble.call_count)
+        self.assertEqual(0, m_lvm.lvm_scan.call_count)
+        self.assertEqual(0, m_udev.udevadm_settle.call_count)
+        self.assertEqual(0, m_util.load_kernel_module.call_count)
+        self.assertEqual(0, m_zfs.zfs_supported.call_count)
+
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_start_clear_holders_deps_lvm_device(
+            self, m_util, m_mdadm, m_zfs, m_lvm, m_mp, m_udev):
+        """start_clear_holders_deps only activates lvm for lvm metadata"""
+        m_mp.multipath_supported.return_value = False
+        device = self.make_device(
+            (512, b'LABELONE' + b'\0' * 16 + b'LVM2 001'))
+        clear_holders.start_clear_holders_deps([device])
+        self.assertEqual(0, m_mdadm.mdadm_assemble.call_count)
+        m_lvm.lvm_scan.assert_called_with(multipath=False)
+        m_lvm.activate_volgroups.assert_called_with(multipath=False)
+        m_udev.udevadm_settle.assert_called_with()
+        self.assertEqual(0, m_util.load_kernel_module.call_count)
+
 # vi: ts=4 expandtab syntax=python
@@ -3,9 +3,11 @@
 from argparse import Namespace
 from collections import OrderedDict
 import copy
-from mock import patch, call
+import json
+from mock import patch, call, PropertyMock
 import os
 import random
+import threading
 
 from curtin.block import dasd
 from curtin.commands import block_meta
@@ -314,6 +316,13 @@ class TestBlockMeta(CiTestCase):
                        'mock_block_rescan')
         self.add_patch('curtin.block.get_blockdev_sector_size',
                        'mock_block_sector_size')
+        self.add_patch('curtin.commands.block_meta.udevadm_info_db',
+                       'mock_udevadm_info_db')
+        self.add_patch('curtin.block._lsblock', 'mock_block_lsblock')
+        self.mock_udevadm_info_db.return_value = {}
+        self.mock_block_lsblock.return_value = {}
+        del block_meta.DNAME_VOLUMES[:]
+        del block_meta.FSTAB_ENTRIES[:]
 
         self.target = "my_target"
         self.config = {
@@ -403,6 +412,37 @@ class TestBlockMeta(CiTestCase):
                    'mkpart', 'primary', '2048s', '1001471s',
                    'set', '1', 'boot', 'on'], capture=True)])
 
+    @patch('curtin.block.sfdisk_info')
+    @patch('curtin.block.get_partition_sfdisk_info')
+    @patch('curtin.commands.block_meta.partition_verify_sfdisk')
+    def test_partition_handler_preserve_reads_ptable_once(
+            self, m_verify, m_get_part_info, m_sfdisk_info):
+        """ preserved partitions of a disk share one sfdisk read """
+        disk_kname = self.storage_config['sda']['path']
+        self.mock_getpath.return_value = disk_kname
+        self.mock_block_path_to_kname.return_value = 'xxx'
+        self.mock_block_sector_size.return_value = (512, 512)
+        m_sfdisk_info.return_value = {
+            'label': 'dos', 'partitions': [
+                {'node': '/dev/xxx1', 'start': 2048, 'size': 1000000,
+                 'type': '83'}]}
+        part_info = self.storage_config['sda-part1']
+        part_info['preserve'] = True
+        block_meta.PTABLE_CACHE.clear()
+        block_meta.partition_handler(part_info, self.storage_config, {})
+        block_meta.partition_handler(part_info, self.storage_config, {})
+        m_sfdisk_info.assert_called_once_with(os.path.realpath(disk_kname))
+        self.assertEqual(0, m_get_part_info.call_count)
+        self.assertEqual(
+            [call(part_info, 'dos',
+                  m_sfdisk_info.return_value['partitions'][0])] * 2,
+            m_verify.call_args_list)
+
+        # writing the disk's partition table invalidates the cached table
+        block_meta.PTABLE_CACHE.invalidate(disk_kname)
+        block_meta.partition_handler(part_info, self.storage_config, {})
+        self.assertEqual(2, m_sfdisk_info.call_count)
+
     @patch('curtin.util.write_file')
     def test_mount_handler_defaults(self, mock_write_file):
         """Test mount_handler has defaults to 'defaults' for mount options"""
@@ -422,6 +462,7 @@ class TestBlockMeta(CiTestCase):
         self.mock_get_volume_type.return_value = 'part'
 
         block_meta.mount_handler(mount_info, self.storage_config, {})
+        block_meta.write_dnames_and_fstab(self.storage_config, fstab)
         options = 'defaults'
         comment = "# / was on /wark/xxx during curtin installation"
         expected = "%s\n%s %s %s %s 0 1\n" % (comment,
@@ -450,6 +491,7 @@ class TestBlockMeta(CiTestCase):
         self.mock_get_volume_type.return_value = 'part'
 
         block_meta.mount_handler(mount_info, self.storage_config, {})
+        block_meta.write_dnames_and_fstab(self.storage_config, fstab)
         options = 'ro'
         comment = "# /readonly was on /wark/xxx during curtin installation"
         expected = "%s\n%s %s %s %s 0 1\n" % (comment,
@@ -479,6 +521,7 @@ class TestBlockMeta(CiTestCase):
         self.mock_get_volume_type.return_value = 'part'
 
         block_meta.mount_handler(mount_info, self.storage_config, {})
+        block_meta.write_dnames_and_fstab(self.storage_config, fstab)
         options = 'defaults'
         comment = "# /readonly was on /wark/xxx during curtin installation"
         expected = "%s\n%s %s %s %s 0 1\n" % (comment,
@@ -510,6 +553,7 @@ class TestBlockMeta(CiTestCase):
         self.mock_get_volume_type.return_value = 'part'
 
         block_meta.mount_handler(mount_info, self.storage_config, {})
+        block_meta.write_dnames_and_fstab(self.storage_config, fstab)
         options = 'defaults'
         comment = "# /readonly was on /wark/xxx during curtin installation"
         expected = "#curtin-test\n%s\n%s %s %s %s 0 1\n" % (comment,
@@ -525,6 +569,213 @@ class TestBlockMeta(CiTestCase):
         self.assertEqual(expected, rendered_fstab)
 
 
+class TestWriteDnamesAndFstab(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteDnamesAndFstab, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.add_patch(basepath + 'udevadm_info_db', 'm_info_db')
+        self.add_patch(basepath + 'udevadm_info', 'm_info')
+        self.add_patch('curtin.block._lsblock', 'm_lsblock')
+        self.add_patch('curtin.block.blkid_export', 'm_blkid')
+        self.add_patch('curtin.util.load_command_environment', 'm_load_env')
+        self.scratch = self.tmp_dir()
+        self.fstab = self.tmp_path('fstab')
+        self.m_load_env.return_value = {'scratch': self.scratch,
+                                        'fstab': self.fstab}
+        self.m_getpath.side_effect = lambda vol_id, _: '/dev/' + vol_id
+        self.m_info_db.return_value = {
+            '/dev/sda': {'DEVNAME': '/dev/sda', 'DEVTYPE': 'disk',
+                         'ID_SERIAL': 'disk-a',
+                         'DEVLINKS': ['/dev/disk/by-id/ata-disk-a']},
+            '/dev/sda1': {'DEVNAME': '/dev/sda1', 'DEVTYPE': 'partition',
+                          'DEVLINKS': ['/dev/disk/by-uuid/root-uuid']},
+            '/dev/sda2': {'DEVNAME': '/dev/sda2', 'DEVTYPE': 'partition',
+                          'DEVLINKS': ['/dev/disk/by-uuid/srv-uuid']},
+        }
+        self.m_lsblock.return_value = {
+            'sda': {'TYPE': 'disk'}, 'sda1': {'TYPE': 'part'},
+            'sda2': {'TYPE': 'part'}}
+        self.m_blkid.return_value = {
+            '/dev/sda': {'DEVNAME': '/dev/sda', 'PTUUID': 'pt-uuid'},
+            '/dev/sda1': {'DEVNAME': '/dev/sda1', 'PARTUUID': 'pt-uuid-01'},
+        }
+        self.storage_config = OrderedDict([
+            ('sda', {'id': 'sda', 'type': 'disk', 'name': 'main',
+                     'serial': 'disk-a'}),
+            ('sda1', {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                      'name': 'root-part'}),
+            ('sda2', {'id': 'sda2', 'type': 'partition', 'device': 'sda'}),
+        ])
+        del block_meta.DNAME_VOLUMES[:]
+        del block_meta.FSTAB_ENTRIES[:]
+
+    def test_write_dnames_and_fstab_reads_devices_once(self):
+        """write_dnames_and_fstab reads udev and blkid once for all."""
+        block_meta.DNAME_VOLUMES.extend(['sda', 'sda1'])
+        block_meta.FSTAB_ENTRIES.extend([
+            block_meta.FstabData(device='/dev/sda1', path='/',
+                                 fstype='ext4', passno='1'),
+            block_meta.FstabData(device='/dev/sda2', path='/srv',
+                                 fstype='ext4', passno='2')])
+
+        block_meta.write_dnames_and_fstab(self.storage_config, self.fstab)
+
+        self.assertEqual(1, self.m_info_db.call_count)
+        self.assertEqual(1, self.m_lsblock.call_count)
+        self.m_blkid.assert_called_once_with(['/dev/sda', '/dev/sda1'])
+        self.assertEqual(0, self.m_info.call_count)
+
+        rules = util.load_file(
+            os.path.join(self.scratch, 'rules.d', 'main.rules'))
+        self.assertIn('ENV{ID_PART_TABLE_UUID}=="pt-uuid"', rules)
+        self.assertIn('ENV{ID_SERIAL}=="disk-a"', rules)
+        rules = util.load_file(
+            os.path.join(self.scratch, 'rules.d', 'root-part.rules'))
+        self.assertIn('ENV{ID_PART_ENTRY_UUID}=="pt-uuid-01"', rules)
+
+        lines = [line for line in util.load_file(self.fstab).splitlines()
+                 if not line.startswith('#')]
+        self.assertEqual([
+            '/dev/disk/by-uuid/root-uuid / ext4 defaults 0 1',
+            '/dev/disk/by-uuid/srv-uuid /srv ext4 defaults 0 2'], lines)
+
+    def test_write_dnames_and_fstab_nothing_to_write(self):
+        """write_dnames_and_fstab reads nothing without dnames or mounts."""
+        block_meta.write_dnames_and_fstab(self.storage_config, self.fstab)
+        self.assertEqual(0, self.m_info_db.call_count)
+        self.assertFalse(os.path.exists(self.fstab))
+
+
+class TestInstallMountOptions(CiTestCase):
+
+    def setUp(self):
+        super(TestInstallMountOptions, self).setUp()
+        self.policy = block_meta.get_install_mount_policy(True)
+        self.state_dir = self.tmp_dir()
+        self.state = {'target': '/tmp/target',
+                      'fstab': os.path.join(self.state_dir, 'fstab')}
+        self.state_file = os.path.join(self.state_dir,
+                                       block_meta.INSTALL_MOUNTS_STATE_FILE)
+        self.add_patch('curtin.commands.block_meta.INSTALL_MOUNT_POLICY',
+                       'm_policy', new=self.policy)
+
+    def _fdata(self, fstype='ext4', options='defaults', path='/'):
+        return block_meta.FstabData(device='/dev/vda1', path=path,
+                                    fstype=fstype, options=options)
+
+    def test_get_install_mount_policy(self):
+        """install-mount-options is off by default, dicts override."""
+        self.assertEqual({}, block_meta.get_install_mount_policy(None))
+        self.assertEqual({}, block_meta.get_install_mount_policy(False))
+        self.assertEqual(block_meta.INSTALL_MOUNT_OPTIONS, self.policy)
+        policy = block_meta.get_install_mount_policy({'ext4': 'nobarrier'})
+        self.assertEqual('nobarrier', policy['ext4'])
+        self.assertEqual(block_meta.INSTALL_MOUNT_OPTIONS['*'], policy['*'])
+
+    def test_install_mount_options_ext4(self):
+        """ext4 mounts skip atime updates and barriers."""
+        self.assertEqual(
+            ('defaults,noatime,lazytime,nobarrier',
+             'remount,defaults,relatime,nolazytime,barrier'),
+            block_meta.install_mount_options(self._fdata(), self.policy))
+
+    def test_install_mount_options_xfs(self):
+        """xfs mounts use larger log buffers."""
+        self.assertEqual(
+            ('defaults,noatime,lazytime,logbsize=256k',
+             'remount,defaults,relatime,nolazytime'),
+            block_meta.install_mount_options(self._fdata('xfs'),
+                                             self.policy))
+
+    def test_install_mount_options_respect_final_options(self):
+        """options set in the storage config are never overridden."""
+        fdata = self._fdata(options='strictatime,data=journal,barrier=1')
+        self.assertEqual(
+            ('strictatime,data=journal,barrier=1,lazytime',
+             'remount,strictatime,data=journal,barrier=1,nolazytime'),
+            block_meta.install_mount_options(fdata, self.policy))
+        fdata = self._fdata('xfs', options='logbsize=64k,noatime,lazytime')
+        self.assertEqual((None, None),
+                         block_meta.install_mount_options(fdata, self.policy))
+
+    def test_install_mount_options_not_used(self):
+        """swap, bind, read-only and non-device mounts keep their options."""
+        for fdata in (self._fdata('swap'), self._fdata(options='ro'),
+                      self._fdata('none', options='bind'),
+                      block_meta.FstabData(spec='server:/export', path='/srv',
+                                           fstype='nfs')):
+            self.assertEqual(
+                (None, None),
+                block_meta.install_mount_options(fdata, self.policy))
+        self.assertEqual((None, None),
+                         block_meta.install_mount_options(self._fdata(), {}))
+
+    @patch('curtin.commands.block_meta.util.ensure_dir')
+    @patch('curtin.commands.block_meta.util.subp')
+    @patch('curtin.commands.block_meta.mount_fstab_data')
+    def test_mount_install_fstab_data_records_mount(self, m_mount, m_subp,
+                                                    m_ensure_dir):
+        """mounts with install options are recorded for remounting."""
+        fdata = self._fdata(path='/home')
+        block_meta.mount_install_fstab_data(fdata, self.state)
+        self.assertEqual(
+            [call(['mount', '-t', 'ext4', '-o',
+                   'defaults,noatime,lazytime,nobarrier', '/dev/vda1',
+                   '/tmp/target/home'], capture=True)],
+            m_subp.call_args_list)
+        self.assertIn(call('/tmp/target/home'), m_ensure_dir.call_args_list)
+        self.assertEqual(0, m_mount.call_count)
+        self.assertEqual(
+            [['/tmp/target/home',
+              'remount,defaults,relatime,nolazytime,barrier']],
+            json.loads(util.load_file(self.state_file)))
+
+    @patch('curtin.commands.block_meta.LOG')
+    @patch('curtin.commands.block_meta.util.ensure_dir')
+    @patch('curtin.commands.block_meta.util.subp')
+    @patch('curtin.commands.block_meta.mount_fstab_data')
+    def test_mount_install_fstab_data_falls_back(self, m_mount, m_subp,
+                                                 m_ensure_dir, m_log):
+        """mounts failing with install options use the final options."""
+        fdata = self._fdata()
+        m_subp.side_effect = util.ProcessExecutionError(
+            stderr='bad option', exit_code=32)
+        block_meta.mount_install_fstab_data(fdata, self.state)
+        self.assertEqual([call(fdata, target='/tmp/target')],
+                         m_mount.call_args_list)
+        self.assertEqual(1, m_log.warning.call_count)
+        self.assertEqual(0, m_log.error.call_count)
+        self.assertEqual(0, m_log.exception.call_count)
+        self.assertFalse(os.path.exists(self.state_file))
+
+    @patch('curtin.commands.block_meta.os.path.ismount')
+    @patch('curtin.commands.block_meta.util.subp')
+    def test_restore_install_mount_options(self, m_subp, m_ismount):
+        """restore syncs and remounts the recorded mounts."""
+        block_meta.record_install_mount(self.state_file, '/tmp/target',
+                                        'remount,defaults,relatime')
+        block_meta.record_install_mount(self.state_file, '/tmp/target/gone',
+                                        'remount,defaults,relatime')
+        m_ismount.side_effect = lambda path: path == '/tmp/target'
+
+        block_meta.restore_install_mount_options(self.state_file)
+        self.assertEqual(
+            [call(['sync']),
+             call(['mount', '-o', 'remount,defaults,relatime',
+                   '/tmp/target'], capture=True)],
+            m_subp.call_args_list)
+        self.assertFalse(os.path.exists(self.state_file))
+
+    @patch('curtin.commands.block_meta.util.subp')
+    def test_restore_install_mount_options_nothing_recorded(self, m_subp):
+        """restore does nothing without recorded mounts."""
+        block_meta.restore_install_mount_options(self.state_file)
+        self.assertEqual(0, m_subp.call_count)
+
+
 class TestZpoolHandler(CiTestCase):
     @patch('curtin.commands.block_meta.zfs')
     @patch('curtin.commands.block_meta.block')
@@ -548,7 +799,93 @@ class TestZpoolHandler(CiTestCase):
             mountpoint="/",
             altroot="mytarget",
             pool_properties={'ashift': 42},
-            zfs_properties={'compression': 'lz4'})
+            zfs_properties=m_zfs.zfs_profile_properties.return_value)
+        m_zfs.zfs_profile_properties.assert_called_with(
+            None, {'compression': 'lz4'}, {'ashift': 42})
+        self.assertEqual(0, m_zfs.zpool_ashift.call_count)
+
+    @patch('curtin.commands.block_meta.zfs')
+    @patch('curtin.commands.block_meta.block')
+    @patch('curtin.commands.block_meta.util')
+    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
+    def test_zpool_handler_picks_ashift_and_profile(self, m_getpath, m_util,
+                                                    m_block, m_zfs):
+        info = {'type': 'zpool', 'id': 'pool1', 'pool': 'tank',
+                'vdevs': ['disk1', 'disk2'], 'profile': 'database'}
+        m_getpath.side_effect = ['/dev/sda', '/dev/sdb']
+        m_block.disk_to_byid_path.side_effect = lambda dev: dev
+        m_util.load_command_environment.return_value = {'target': 'target'}
+        m_zfs.zpool_ashift.return_value = 13
+        m_zfs.zfs_profile_properties.return_value = {'recordsize': '16K'}
+        block_meta.zpool_handler(info, OrderedDict(), {})
+        m_zfs.zpool_ashift.assert_called_with(['/dev/sda', '/dev/sdb'])
+        m_zfs.zfs_profile_properties.assert_called_with('database', {}, {})
+        m_zfs.zpool_create.assert_called_with(
+            'tank', ['/dev/sda', '/dev/sdb'], mountpoint=None,
+            altroot='target', pool_properties={'ashift': 13},
+            zfs_properties={'recordsize': '16K'})
+
+
+class TestZfsHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestZfsHandler, self).setUp()
+        self.add_patch('curtin.commands.block_meta.zfs', 'm_zfs')
+        self.add_patch('curtin.commands.block_meta.util.'
+                       'load_command_environment', 'm_load_env')
+        self.m_load_env.return_value = {'fstab': None}
+        self.m_zfs.zfs_profile_properties.side_effect = (
+            lambda profile, properties, pool_properties: properties)
+        block_meta.ZFS_DATASETS.clear()
+        self.storage_config = OrderedDict([
+            ('pool1', {'type': 'zpool', 'id': 'pool1', 'pool': 'rpool'}),
+            ('root', {'type': 'zfs', 'id': 'root', 'pool': 'pool1',
+                      'volume': '/ROOT'}),
+            ('rootfs', {'type': 'zfs', 'id': 'rootfs', 'pool': 'pool1',
+                        'volume': '/ROOT/zfsroot',
+                        'properties': {'canmount': 'noauto'}}),
+            ('home', {'type': 'zfs', 'id': 'home', 'pool': 'pool1',
+                      'volume': '/USERDATA/home'}),
+        ])
+
+    def _handle(self, item_id):
+        block_meta.zfs_handler(self.storage_config[item_id],
+                               self.storage_config, {})
+        return self.m_zfs.zfs_create.call_args
+
+    def test_zfs_handler_configured_parent(self):
+        """ datasets with a configured parent do not create parents """
+        self.assertEqual(call('rpool', '/ROOT', zfs_properties={},
+                              parents=False), self._handle('root'))
+        self.assertEqual(call('rpool', '/ROOT/zfsroot',
+                              zfs_properties={'canmount': 'noauto'},
+                              parents=False), self._handle('rootfs'))
+
+    def test_zfs_handler_unconfigured_parent(self):
+        """ datasets with an unconfigured parent create the parent """
+        self.assertEqual(call('rpool', '/USERDATA/home', zfs_properties={},
+                              parents=True), self._handle('home'))
+
+    def test_zfs_handler_scans_config_once(self):
+        """ the configured datasets are collected once per run """
+        with patch('curtin.commands.block_meta.get_poolname',
+                   wraps=block_meta.get_poolname) as m_poolname:
+            for item_id in ('root', 'rootfs', 'home'):
+                self._handle(item_id)
+        # one scan of the three datasets plus one lookup per handler call,
+        # each resolving the dataset and then its pool
+        self.assertEqual(2 * (3 + 3), m_poolname.call_count)
+        self.assertEqual(
+            {'rpool': set(['/ROOT', '/ROOT/zfsroot', '/USERDATA/home'])},
+            block_meta.ZFS_DATASETS)
+
+    def test_zfs_handler_profile_uses_pool_properties(self):
+        """ the profile of a dataset depends on its pool's properties """
+        self.storage_config['pool1']['pool_properties'] = {'version': 5000}
+        self.storage_config['home']['profile'] = 'database'
+        self._handle('home')
+        self.m_zfs.zfs_profile_properties.assert_called_with(
+            'database', {}, {'version': 5000})
 
 
 class TestZFSRootUpdates(CiTestCase):
@@ -1237,93 +1574,138 @@ class TestFstabVolumeSpec(CiTestCase):
 
 class TestDasdHandler(CiTestCase):
 
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.devname')
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.format')
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.needs_formatting')
-    @patch('curtin.commands.block_meta.block')
-    @patch('curtin.commands.block_meta.util')
-    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
-    def test_dasd_handler_calls_format(self, m_getpath, m_util, m_block,
-                                       m_dasd_needf, m_dasd_format,
-                                       m_dasd_devname):
+    def setUp(self):
+        super(TestDasdHandler, self).setUp()
+        dpath = 'curtin.commands.block_meta.dasd.DasdDevice'
+        self.add_patch(dpath + '.devname', 'm_dasd_devname',
+                       new=PropertyMock(return_value='/wark/dasda'))
+        self.add_patch(dpath + '.format', 'm_dasd_format', autospec=False)
+        self.add_patch(dpath + '.format_mode', 'm_dasd_fmode',
+                       autospec=False)
+        self.add_patch(dpath + '.needs_formatting', 'm_dasd_needf',
+                       autospec=False)
+        self.add_patch('curtin.commands.block_meta.events', 'm_events')
+        self.m_dasd_needf.return_value = False
+        self.info = {'type': 'dasd', 'id': 'dasd_rootfs',
+                     'device_id': '0.1.24fe', 'blocksize': 4096,
+                     'disk_layout': 'cdl', 'mode': 'quick',
+                     'label': 'cloudimg-rootfs'}
+        block_meta.FORMATTED_DASDS.clear()
+
+    def test_dasd_handler_calls_format(self):
         """verify dasd.format is called on disk that differs from config."""
-        storage_config = OrderedDict()
-        info = {'type': 'dasd', 'id': 'dasd_rootfs', 'device_id': '0.1.24fe',
-                'blocksize': 4096, 'disk_layout': 'cdl', 'mode': 'quick',
-                'label': 'cloudimg-rootfs'}
-
-        disk_path = "/wark/dasda"
-        m_dasd_devname.return_value = disk_path
-        m_getpath.return_value = disk_path
-        m_dasd_needf.side_effect = [True, False]
-        block_meta.dasd_handler(info, storage_config, {})
-        m_dasd_format.assert_called_with(blksize=4096, layout='cdl',
-                                         set_label='cloudimg-rootfs',
-                                         mode='quick')
-
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.format')
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.needs_formatting')
-    @patch('curtin.commands.block_meta.block')
-    @patch('curtin.commands.block_meta.util')
-    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
-    def test_dasd_handler_skips_format_if_not_needed(self, m_getpath, m_util,
-                                                     m_block, m_dasd_needf,
-                                                     m_dasd_format):
+        self.m_dasd_fmode.return_value = 'full'
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.m_dasd_format.assert_called_with(blksize=4096, layout='cdl',
+                                              set_label='cloudimg-rootfs',
+                                              mode='quick', progress=None)
+        self.assertEqual(1, self.m_dasd_needf.call_count)
+
+    def test_dasd_handler_picks_mode_when_not_configured(self):
+        """verify dasd.format uses the mode format_mode returns."""
+        del self.info['mode']
+        self.m_dasd_fmode.return_value = 'full'
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.m_dasd_format.assert_called_with(blksize=4096, layout='cdl',
+                                              set_label='cloudimg-rootfs',
+                                              mode='full', progress=None)
+
+    def test_dasd_handler_skips_format_if_not_needed(self):
         """verify dasd.format is NOT called if disk matches config."""
-        storage_config = OrderedDict()
-        info = {'type': 'dasd', 'id': 'dasd_rootfs', 'device_id': '0.1.24fe',
-                'blocksize': 4096, 'disk_layout': 'cdl', 'mode': 'quick',
-                'label': 'cloudimg-rootfs'}
+        self.m_dasd_fmode.return_value = None
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.assertEqual(0, self.m_dasd_format.call_count)
+
+    def test_dasd_handler_wipe_forces_quick_format(self):
+        """verify wipe formats a matching dasd in quick mode."""
+        del self.info['mode']
+        self.info['wipe'] = 'superblock'
+        self.m_dasd_fmode.return_value = None
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.m_dasd_format.assert_called_with(blksize=4096, layout='cdl',
+                                              set_label='cloudimg-rootfs',
+                                              mode='quick', progress=None)
+
+    def test_dasd_handler_preserves_existing_dasd(self):
+        """verify dasd.format is skipped if preserve is True."""
+        self.info['preserve'] = True
+        self.m_dasd_fmode.return_value = None
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.assertEqual(1, self.m_dasd_fmode.call_count)
+        self.assertEqual(0, self.m_dasd_format.call_count)
 
-        disk_path = "/wark/dasda"
-        m_getpath.return_value = disk_path
-        m_dasd_needf.side_effect = [False, False]
-        block_meta.dasd_handler(info, storage_config, {})
-        self.assertEqual(0, m_dasd_format.call_count)
+    def test_dasd_handler_raise_on_preserve_needs_formatting(self):
+        """ValueError raised if preserve is True but dasd needs formatting."""
+        self.info['preserve'] = True
+        self.m_dasd_fmode.return_value = 'quick'
+        with self.assertRaises(ValueError):
+            block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.assertEqual(0, self.m_dasd_format.call_count)
 
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.format')
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.needs_formatting')
-    @patch('curtin.commands.block_meta.block')
-    @patch('curtin.commands.block_meta.util')
-    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
-    def test_dasd_handler_preserves_existing_dasd(self, m_getpath, m_util,
-                                                  m_block, m_dasd_needf,
-                                                  m_dasd_format):
-        """verify dasd.format is skipped if preserve is True."""
-        storage_config = OrderedDict()
-        info = {'type': 'dasd', 'id': 'dasd_rootfs', 'device_id': '0.1.24fe',
-                'blocksize': 4096, 'disk_layout': 'cdl', 'mode': 'quick',
-                'label': 'cloudimg-rootfs', 'preserve': True}
+    def test_dasd_handler_raises_if_format_did_not_apply(self):
+        """RuntimeError raised if dasd still differs after dasdfmt."""
+        self.m_dasd_fmode.return_value = 'full'
+        self.m_dasd_needf.return_value = True
+        with self.assertRaises(RuntimeError):
+            block_meta.dasd_handler(self.info, OrderedDict(), {})
 
-        disk_path = "/wark/dasda"
-        m_getpath.return_value = disk_path
-        m_dasd_needf.side_effect = [False, False]
-        block_meta.dasd_handler(info, storage_config, {})
-        self.assertEqual(1, m_dasd_needf.call_count)
-        self.assertEqual(0, m_dasd_format.call_count)
+    def test_dasd_handler_skips_dasds_already_formatted(self):
+        """verify dasd_handler skips dasds format_dasds formatted."""
+        block_meta.FORMATTED_DASDS.add(self.info['id'])
+        block_meta.dasd_handler(self.info, OrderedDict(), {})
+        self.assertEqual(0, self.m_dasd_fmode.call_count)
+        self.assertEqual(0, self.m_dasd_format.call_count)
 
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.format')
-    @patch('curtin.commands.block_meta.dasd.DasdDevice.needs_formatting')
-    @patch('curtin.commands.block_meta.block')
-    @patch('curtin.commands.block_meta.util')
-    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
-    def test_dasd_handler_raise_on_preserve_needs_formatting(self, m_getpath,
-                                                             m_util, m_block,
-                                                             m_dasd_needf,
-                                                             m_dasd_format):
-        """ValueError raised if preserve is True but dasd needs formatting."""
+    def _storage_config(self, count):
         storage_config = OrderedDict()
-        info = {'type': 'dasd', 'id': 'dasd_rootfs', 'device_id': '0.1.24fe',
-                'blocksize': 4096, 'disk_layout': 'cdl', 'mode': 'quick',
-                'label': 'cloudimg-rootfs', 'preserve': True}
-
-        disk_path = "/wark/dasda"
-        m_getpath.return_value = disk_path
-        m_dasd_needf.side_effect = [True, False]
+        for num in range(count):
+            info = dict(self.info, id='dasd%d' % num,
+                        device_id='0.0.%04x' % num)
+            del info['mode']
+            storage_config[info['id']] = info
+        storage_config['disk0'] = {'type': 'disk', 'id': 'disk0'}
+        return storage_config
+
+    def test_format_dasds_formats_concurrently(self):
+        """verify format_dasds runs dasdfmt of several dasds at once."""
+        storage_config = self._storage_config(3)
+        self.m_dasd_fmode.side_effect = iter(['full', None, 'quick'])
+        started = {'full': threading.Event(), 'quick': threading.Event()}
+
+        def format(**kwargs):
+            started[kwargs['mode']].set()
+            other = 'quick' if kwargs['mode'] == 'full' else 'full'
+            self.assertTrue(started[other].wait(5))
+            kwargs['progress'](10, 100, 10)
+        self.m_dasd_format.side_effect = format
+
+        block_meta.format_dasds(storage_config, workers=4,
+                                stack_prefix='cmd-install/stage-partitioning')
+        self.assertEqual(set(['dasd0', 'dasd2']), block_meta.FORMATTED_DASDS)
+        self.assertEqual(
+            ['full', 'quick'],
+            sorted(c[1]['mode'] for c in self.m_dasd_format.call_args_list))
+        self.assertIn(
+            call('cmd-install/stage-partitioning/dasd0/dasdfmt',
+                 'dasdfmt of /wark/dasda 10% complete (cylinder 10 of 100)'),
+            self.m_events.report_progress_event.call_args_list)
+
+    def test_format_dasds_nothing_to_format(self):
+        """verify format_dasds does not format matching dasds."""
+        storage_config = self._storage_config(2)
+        self.m_dasd_fmode.return_value = None
+        block_meta.format_dasds(storage_config)
+        self.assertEqual(0, self.m_dasd_format.call_count)
+        self.assertEqual(set(), block_meta.FORMATTED_DASDS)
+
+    def test_format_dasds_raises_on_preserved_dasd(self):
+        """verify format_dasds checks preserve before formatting any dasd."""
+        storage_config = self._storage_config(2)
+        storage_config['dasd1']['preserve'] = True
+        self.m_dasd_fmode.return_value = 'quick'
         with self.assertRaises(ValueError):
-            block_meta.dasd_handler(info, storage_config, {})
-        self.assertEqual(1, m_dasd_needf.call_count)
-        self.assertEqual(0, m_dasd_format.call_count)
+            block_meta.format_dasds(storage_config)
+        self.assertEqual(0, self.m_dasd_format.call_count)
 
 
 class TestDiskHandler(CiTestCase):
@@ -1410,6 +1792,71 @@ class TestDiskHandler(CiTestCase):
         m_subp.assert_called_once_with(['fdasd', '-c', '/dev/null', path])
 
 
+class TestGetVolumeStack(CiTestCase):
+
+    def setUp(self):
+        super(TestGetVolumeStack, self).setUp()
+        self.add_patch('curtin.commands.block_meta.get_path_to_storage_volume',
+                       'm_getpath')
+        self.m_getpath.side_effect = lambda vol, sconfig: '/dev/' + vol
+        self.storage_config = OrderedDict((item['id'], item) for item in [
+            {'id': 'sda', 'type': 'disk'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+            {'id': 'md0', 'type': 'raid', 'devices': ['sda1']},
+            {'id': 'nvme0', 'type': 'disk'},
+            {'id': 'bcache0', 'type': 'bcache', 'backing_device': 'md0',
+             'cache_device': 'nvme0'},
+            {'id': 'crypt0', 'type': 'dm_crypt', 'volume': 'bcache0'},
+            {'id': 'vg0', 'type': 'lvm_volgroup', 'devices': ['crypt0']},
+            {'id': 'lv0', 'type': 'lvm_partition', 'volgroup': 'vg0'},
+            {'id': 'vg1', 'type': 'lvm_volgroup', 'devices': ['sda', 'md0']},
+            {'id': 'lv1', 'type': 'lvm_partition', 'volgroup': 'vg1'},
+        ])
+
+    def test_stack_follows_single_device_layers(self):
+        self.assertEqual(['/dev/crypt0', '/dev/bcache0', '/dev/md0'],
+                         block_meta.get_volume_stack('lv0',
+                                                     self.storage_config))
+        self.assertEqual(['/dev/sda'],
+                         block_meta.get_volume_stack('sda1',
+                                                     self.storage_config))
+
+    def test_stack_stops_at_multi_device_volgroup(self):
+        self.assertEqual([], block_meta.get_volume_stack('lv1',
+                                                         self.storage_config))
+
+
+class TestFormatHandlerMkfsTuning(CiTestCase):
+
+    def setUp(self):
+        super(TestFormatHandlerMkfsTuning, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + 'get_volume_stack', 'm_stack')
+        self.add_patch(basepath + 'mkfs.mkfs_from_config', 'm_mkfs')
+        self.m_getpath.return_value = '/dev/sda1'
+        self.m_stack.return_value = ['/dev/sda']
+        self.info = {'id': 'sda1-fs', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sda1'}
+        self.storage_config = OrderedDict([
+            ('sda1', {'id': 'sda1', 'type': 'partition'}),
+            ('sda1-fs', self.info)])
+        self.addCleanup(block_meta.MKFS_TUNING.update, {'enabled': False})
+
+    def test_format_handler_does_not_tune_by_default(self):
+        block_meta.format_handler(self.info, self.storage_config, {})
+        self.assertEqual([call('/dev/sda1', self.info)],
+                         self.m_mkfs.call_args_list)
+        self.assertEqual(0, self.m_stack.call_count)
+
+    def test_format_handler_tunes_when_enabled(self):
+        block_meta.MKFS_TUNING['enabled'] = True
+        block_meta.format_handler(self.info, self.storage_config, {})
+        self.assertEqual([call('/dev/sda1', self.info, tune=True,
+                               stack=['/dev/sda'])],
+                         self.m_mkfs.call_args_list)
+
+
 class TestLvmVolgroupHandler(CiTestCase):
 
     def setUp(self):
@@ -1445,21 +1892,96 @@ class TestLvmVolgroupHandler(CiTestCase):
         }
         self.storage_config = (
             block_meta.extract_storage_ordered_dict(self.config))
+        self.add_patch(basepath + 'distro.lsb_release', 'm_lsb_release')
+        self.m_lsb_release.return_value = {'codename': 'focal'}
+        self.m_lvm.get_pvols_in_volgroup.return_value = ['/dev/wda2']
+        self.m_lvm.get_lvols_in_volgroup.return_value = ['lv1']
+        block_meta.CREATED_LVOLS.clear()
+        self.addCleanup(block_meta.CREATED_LVOLS.clear)
+
+    lvcreate = ['lvcreate', 'vg1', '--name', 'lv1', '--zero=y',
+                '--wipesignatures=y', '--yes', '--size', '1073741824B']
 
     def test_lvmvolgroup_creates_volume_group(self):
-        """ lvm_volgroup handler creates volume group. """
+        """ lvm_volgroup handler creates volume group and its lvs. """
+
+        devices = [self.random_string(), self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.m_lvm.get_pvols_in_volgroup.return_value = devices
+
+        block_meta.lvm_volgroup_handler(self.storage_config['lvm-volgroup1'],
+                                        self.storage_config, {})
+
+        self.assertEqual([call([['vgcreate', '--force', '--zero=y', '--yes',
+                                 'vg1'] + devices, self.lvcreate])],
+                         self.m_lvm.lvm_shell.call_args_list)
+        self.assertEqual(0, self.m_subp.call_count)
+        self.assertEqual(1, self.m_lvm.lvm_scan.call_count)
+        self.assertEqual(set(['lvm-part1']), block_meta.CREATED_LVOLS)
+
+    def test_lvmvolgroup_reruns_commands_the_shell_missed(self):
+        """ lvm_volgroup handler reruns commands which did not apply. """
 
         devices = [self.random_string(), self.random_string()]
         self.m_getpath.side_effect = iter(devices)
+        self.m_lvm.get_pvols_in_volgroup.side_effect = [[], devices]
+        self.m_lvm.get_lvols_in_volgroup.side_effect = [[], ['lv1']]
 
         block_meta.lvm_volgroup_handler(self.storage_config['lvm-volgroup1'],
                                         self.storage_config, {})
 
         self.assertEqual([call(['vgcreate', '--force', '--zero=y', '--yes',
-                                'vg1'] + devices,  capture=True)],
+                                'vg1'] + devices, capture=True),
+                          call(self.lvcreate)],
                          self.m_subp.call_args_list)
         self.assertEqual(1, self.m_lvm.lvm_scan.call_count)
 
+    def test_lvmvolgroup_raises_on_partial_volume_group(self):
+        """ lvm_volgroup handler raises if the vg lacks some members. """
+
+        devices = [self.random_string(), self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.m_lvm.get_pvols_in_volgroup.return_value = devices[:1]
+
+        with self.assertRaises(RuntimeError):
+            block_meta.lvm_volgroup_handler(
+                self.storage_config['lvm-volgroup1'], self.storage_config, {})
+
+        self.assertEqual(0, self.m_subp.call_count)
+        self.assertEqual(0, self.m_lvm.lvm_scan.call_count)
+        self.assertEqual(set(), block_meta.CREATED_LVOLS)
+
+    def test_lvmvolgroup_raises_if_rerun_lv_is_missing(self):
+        """ lvm_volgroup handler raises if a rerun lvcreate left no lv. """
+
+        devices = [self.random_string(), self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.m_lvm.get_pvols_in_volgroup.return_value = devices
+        self.m_lvm.get_lvols_in_volgroup.return_value = []
+
+        with self.assertRaises(RuntimeError):
+            block_meta.lvm_volgroup_handler(
+                self.storage_config['lvm-volgroup1'], self.storage_config, {})
+
+        self.assertEqual([call(self.lvcreate)], self.m_subp.call_args_list)
+        self.assertEqual(set(), block_meta.CREATED_LVOLS)
+
+    def test_lvmvolgroup_skips_preserved_lvs(self):
+        """ lvm_volgroup handler does not create preserved lvs. """
+
+        devices = [self.random_string(), self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.m_lvm.get_pvols_in_volgroup.return_value = devices
+        self.storage_config['lvm-part1']['preserve'] = True
+
+        block_meta.lvm_volgroup_handler(self.storage_config['lvm-volgroup1'],
+                                        self.storage_config, {})
+
+        self.assertEqual([call([['vgcreate', '--force', '--zero=y', '--yes',
+                                 'vg1'] + devices])],
+                         self.m_lvm.lvm_shell.call_args_list)
+        self.assertEqual(set(), block_meta.CREATED_LVOLS)
+
     @patch('curtin.commands.block_meta.lvm_volgroup_verify')
     def test_lvmvolgroup_preserve_existing_volume_group(self, m_verify):
         """ lvm_volgroup handler preserves existing volume group. """
@@ -1582,6 +2104,20 @@ class TestLvmPartitionHandler(CiTestCase):
         self.m_wipe.assert_called_with(devpath, mode=wipe_mode,
                                        exclusive=False)
 
+    def test_lvmpart_created_with_volgroup(self):
+        """ lvm_partition_handler only wipes lvs created with their vg. """
+
+        devpath = self.random_string()
+        self.m_getpath.return_value = devpath
+        block_meta.CREATED_LVOLS.add('lvm-part1')
+        self.addCleanup(block_meta.CREATED_LVOLS.clear)
+        block_meta.lvm_partition_handler(self.storage_config['lvm-part1'],
+                                         self.storage_config, {})
+        self.assertEqual(0, self.m_subp.call_count)
+        self.assertEqual(0, self.m_lvm.lvm_scan.call_count)
+        self.m_wipe.assert_called_with(devpath, mode='superblock',
+                                       exclusive=False)
+
     @patch('curtin.commands.block_meta.lvm_partition_verify')
     def test_lvmpart_preserve_existing_lvmpart(self, m_verify):
         m_verify.return_value = True
@@ -1685,6 +2221,8 @@ class TestDmCryptHandler(CiTestCase):
         self.m_which.return_value = False
         self.fstab = self.tmp_path('fstab')
         self.crypttab = os.path.join(os.path.dirname(self.fstab), 'crypttab')
+        block_meta.CRYPTSETUP_CAPABILITIES.clear()
+        block_meta.PBKDF_BENCHMARKS.clear()
         self.m_load_env.return_value = {'fstab': self.fstab,
                                         'target': self.target}
 
@@ -1888,6 +2426,150 @@ class TestDmCryptHandler(CiTestCase):
         with self.assertRaises(RuntimeError):
             block_meta.dm_crypt_handler(info, self.storage_config, {})
 
+    def _add_dmcrypt(self, dmcrypt_id, **kwargs):
+        info = {'id': dmcrypt_id, 'type': 'dm_crypt', 'dm_name': dmcrypt_id,
+                'volume': 'sda-part1', 'keyfile': self.keyfile}
+        info.update(kwargs)
+        self.storage_config[dmcrypt_id] = info
+        return info
+
+    def test_dm_crypt_key_derivation_options(self):
+        """ verify dm_crypt passes pbkdf, iter-time and sector-size. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        info = self.storage_config['dmcrypt0']
+        info.update({'pbkdf': 'argon2id', 'pbkdf-memory': 65536,
+                     'iter-time': 500, 'sector-size': 4096})
+
+        block_meta.dm_crypt_handler(info, self.storage_config, {})
+        self.m_subp.assert_has_calls([
+            call(['cryptsetup', '--cipher', self.cipher,
+                  '--key-size', self.keysize,
+                  '--type', 'luks2', '--sector-size', '4096',
+                  '--pbkdf', 'argon2id', '--pbkdf-memory', '65536',
+                  '--iter-time', '500',
+                  'luksFormat', volume_path, self.keyfile])])
+
+    def test_dm_crypt_default_format_unchanged(self):
+        """ verify dm_crypt only adds luks2 options when configured. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        self.m_block.get_blockdev_sector_size.return_value = (512, 4096)
+        info = self.storage_config['dmcrypt0']
+
+        block_meta.dm_crypt_handler(info, self.storage_config, {})
+        self.m_subp.assert_has_calls([
+            call(['cryptsetup', '--cipher', self.cipher,
+                  '--key-size', self.keysize,
+                  'luksFormat', volume_path, self.keyfile])])
+
+    def test_dm_crypt_reuses_pbkdf_benchmark(self):
+        """ verify formatting several volumes benchmarks the pbkdf once. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        help_out = '\n'.join([
+            '      --pbkdf-force-iterations=LONG  PBKDF iterations cost',
+            '      --perf-no_read_workqueue       Bypass dm-crypt workqueue',
+            'Default compiled-in metadata format is LUKS2 (for luksFormat '
+            'action).',
+            'Default PBKDF for LUKS1: pbkdf2, iteration time: 2000 (ms)',
+            'Default PBKDF for LUKS2: argon2id',
+        ])
+        bench_out = (
+            '# Tests are approximate using memory only (no storage IO).\n'
+            'argon2id      4 iterations, 1048576 memory, 4 parallel threads '
+            '(CPUs) for 256-bit key (requested 2000 ms time)\n')
+
+        def subp(cmd, **kwargs):
+            if cmd[:2] == ['cryptsetup', '--help']:
+                return (help_out, '')
+            if cmd[:2] == ['cryptsetup', 'benchmark']:
+                return (bench_out, '')
+            return ('', '')
+        self.m_subp.side_effect = subp
+
+        infos = [self.storage_config['dmcrypt0'],
+                 self._add_dmcrypt('dmcrypt1')]
+        for info in infos:
+            block_meta.dm_crypt_handler(info, self.storage_config, {})
+
+        benchmark = [c for c in self.m_subp.call_args_list
+                     if c[0][0][:2] == ['cryptsetup', 'benchmark']]
+        self.assertEqual(
+            [call(['cryptsetup', 'benchmark', '--pbkdf', 'argon2id'],
+                  capture=True)], benchmark)
+        formats = [c[0][0] for c in self.m_subp.call_args_list
+                   if 'luksFormat' in c[0][0]]
+        self.assertEqual(2, len(formats))
+        for cmd in formats:
+            self.assertIn('--pbkdf-force-iterations', cmd)
+            self.assertEqual(
+                ['--pbkdf', 'argon2id', '--pbkdf-force-iterations', '4',
+                 '--pbkdf-memory', '1048576', '--pbkdf-parallel', '4'],
+                cmd[cmd.index('--pbkdf'):cmd.index('luksFormat')])
+
+    def test_dm_crypt_single_volume_is_not_benchmarked(self):
+        """ verify a single volume leaves the benchmark to luksFormat. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        info = self.storage_config['dmcrypt0']
+        info['pbkdf'] = 'pbkdf2'
+
+        block_meta.dm_crypt_handler(info, self.storage_config, {})
+        for (args, _kwargs) in self.m_subp.call_args_list:
+            self.assertNotIn('benchmark', args[0])
+        self.m_subp.assert_has_calls([
+            call(['cryptsetup', '--cipher', self.cipher,
+                  '--key-size', self.keysize, '--pbkdf', 'pbkdf2',
+                  'luksFormat', volume_path, self.keyfile])])
+
+    def test_cryptsetup_pbkdf_benchmark_pbkdf2(self):
+        """ verify pbkdf2 benchmark scales iterations to the iter-time. """
+        self.m_subp.return_value = (
+            'PBKDF2-sha256    1000000 iterations per second for 256-bit key\n',
+            '')
+        self.assertEqual(
+            ['--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '500000'],
+            block_meta.cryptsetup_pbkdf_benchmark('pbkdf2', iter_time=500))
+        self.assertEqual(
+            ['--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '500000'],
+            block_meta.cryptsetup_pbkdf_benchmark('pbkdf2', iter_time=500))
+        self.assertEqual(1, self.m_subp.call_count)
+
+    def test_cryptsetup_pbkdf_benchmark_failure(self):
+        """ verify a failed benchmark returns None and is not retried. """
+        self.m_subp.side_effect = util.ProcessExecutionError('benchmark')
+        self.assertIsNone(block_meta.cryptsetup_pbkdf_benchmark('argon2id'))
+        self.assertIsNone(block_meta.cryptsetup_pbkdf_benchmark('argon2id'))
+        self.assertEqual(1, self.m_subp.call_count)
+
+    def test_dm_crypt_perf_flags_in_open_and_crypttab(self):
+        """ verify supported perf flags are used on open and in crypttab. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        self.m_block.get_volume_uuid.return_value = 'abcd'
+
+        def subp(cmd, **kwargs):
+            if cmd[:2] == ['cryptsetup', '--help']:
+                return ('      --perf-no_read_workqueue  Bypass workqueue\n'
+                        '      --perf-no_write_workqueue Bypass workqueue\n',
+                        '')
+            return ('', '')
+        self.m_subp.side_effect = subp
+
+        info = self.storage_config['dmcrypt0']
+        info['perf'] = ['no_read_workqueue', 'no_write_workqueue',
+                        'same_cpu_crypt']
+        block_meta.dm_crypt_handler(info, self.storage_config, {})
+        self.m_subp.assert_has_calls([
+            call(['cryptsetup', 'open', '--type', 'luks', volume_path,
+                  info['dm_name'], '--key-file', self.keyfile,
+                  '--perf-no_read_workqueue', '--perf-no_write_workqueue'])])
+        self.assertEqual(
+            'cryptroot UUID=abcd none '
+            'luks,no-read-workqueue,no-write-workqueue\n',
+            util.load_file(self.crypttab))
+
 
 class TestRaidHandler(CiTestCase):
 
@@ -2007,9 +2689,70 @@ class TestRaidHandler(CiTestCase):
         self.m_getpath.side_effect = iter(devices)
         block_meta.raid_handler(self.storage_config['mddevice'],
                                 self.storage_config, {})
-        self.assertEqual([call(md_devname, 5, devices, [], None, '', None)],
+        self.assertEqual([call(md_devname, 5, devices, [], None, '', None,
+                               assume_clean=False)],
                          self.m_mdadm.mdadm_create.call_args_list)
 
+    def test_raid_handler_assume_clean_when_members_zeroed(self):
+        """ raid_handler skips resync of raid5 with zeroed members. """
+        devices = [self.random_string(), self.random_string(),
+                   self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        for member in ('sda1', 'sdb1', 'sdc1'):
+            self.storage_config[member]['wipe'] = 'zero'
+        self.storage_config['mddevice']['resync'] = 'assume-clean'
+        self.m_mdadm.md_assume_clean_safe.return_value = True
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config, {})
+        self.m_mdadm.md_assume_clean_safe.assert_called_with(5, True)
+        self.assertEqual(
+            True,
+            self.m_mdadm.mdadm_create.call_args[1]['assume_clean'])
+        self.assertEqual(0, self.m_mdadm.md_set_sync_speed_max.call_count)
+
+    def test_raid_handler_assume_clean_unsafe_throttles(self):
+        """ raid_handler throttles resync where assume-clean is unsafe. """
+        devices = [self.random_string(), self.random_string(),
+                   self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.storage_config['mddevice']['resync'] = 'assume-clean'
+        self.m_mdadm.md_assume_clean_safe.return_value = False
+        self.m_mdadm.DEFAULT_SYNC_SPEED_MAX = 1000
+        self.m_mdadm.SYNC_SPEED_STATE_FILE = 'md_sync_speed.json'
+        self.m_mdadm.md_set_sync_speed_max.return_value = 'system'
+        self.m_util.load_command_environment.return_value = {
+            'fstab': '/tmp/state/fstab'}
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config, {})
+        self.m_mdadm.md_assume_clean_safe.assert_called_with(5, False)
+        self.assertEqual(
+            False,
+            self.m_mdadm.mdadm_create.call_args[1]['assume_clean'])
+        self.m_mdadm.md_set_sync_speed_max.assert_called_with(
+            '/dev/md0', 1000)
+        self.m_mdadm.md_record_sync_speed.assert_called_with(
+            '/tmp/state/md_sync_speed.json', '/dev/md0', 'system')
+
+    @patch('curtin.commands.block_meta.events')
+    def test_raid_handler_wait_reports_progress(self, m_events):
+        """ raid_handler waits for resync and reports its progress. """
+        devices = [self.random_string(), self.random_string(),
+                   self.random_string()]
+        self.m_getpath.side_effect = iter(devices)
+        self.storage_config['mddevice']['resync'] = 'wait'
+
+        def block_until_in_sync(md_devname, progress):
+            for completed in (0, 10, 11, 100):
+                progress(completed, 200)
+
+        self.m_mdadm.md_block_until_in_sync.side_effect = block_until_in_sync
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config, {})
+        self.assertEqual(
+            [call('mddevice/resync', 'resync of /dev/md0 %d%% complete' % pct)
+             for pct in (0, 5, 50)],
+            m_events.report_progress_event.call_args_list)
+
     @patch('curtin.commands.block_meta.raid_verify')
     def test_raid_handler_preserves_existing_device(self, m_verify):
         """ raid_handler preserves existing device. """
@@ -2106,6 +2849,9 @@ class TestBcacheHandler(CiTestCase):
         self.add_patch(basepath + 'bcache', 'm_bcache')
         self.add_patch(basepath + 'block', 'm_block')
         self.add_patch(basepath + 'disk_handler', 'm_disk_handler')
+        block_meta.BCACHE_CACHE_SETS.clear()
+        block_meta.CREATED_BCACHES.clear()
+        block_meta.CONFIGURED_ITEMS.clear()
 
         self.target = "my_target"
         self.config = {
@@ -2178,13 +2924,60 @@ class TestBcacheHandler(CiTestCase):
         self.m_getpath.side_effect = iter([backing_device, caching_device])
         self.m_bcache.create_cache_device.return_value = cset_uuid
 
+        self.m_bcache.create_backing_devices.return_value = ['/dev/bcache0']
+
         block_meta.bcache_handler(self.storage_config['id_bcache0'],
                                   self.storage_config, {})
         self.assertEqual([call(caching_device)],
                          self.m_bcache.create_cache_device.call_args_list)
         self.assertEqual([
-            call(backing_device, caching_device, cache_mode, cset_uuid)],
-                         self.m_bcache.create_backing_device.call_args_list)
+            call([(backing_device, cache_mode)], caching_device, cset_uuid)],
+            self.m_bcache.create_backing_devices.call_args_list)
+
+    def _add_sibling_bcaches(self, count):
+        for num in range(count):
+            disk_id = 'id_rotary%d' % (num + 1)
+            self.storage_config[disk_id] = {
+                'id': disk_id, 'type': 'disk', 'serial': 'disk-%d' % num}
+            self.storage_config['id_bcache%d' % (num + 1)] = {
+                'id': 'id_bcache%d' % (num + 1), 'type': 'bcache',
+                'backing_device': disk_id, 'cache_device': 'id_ssd0',
+                'cache_mode': 'writethrough', 'wipe': 'superblock'}
+
+    def test_bcache_handler_creates_configured_siblings_together(self):
+        """ bcache_handler creates bcaches sharing the cache device in one
+            batch once their backing devices are configured. """
+        self._add_sibling_bcaches(3)
+        block_meta.CONFIGURED_ITEMS.update(['id_rotary1', 'id_rotary2'])
+        self.m_getpath.side_effect = lambda vol_id, _: '/dev/' + vol_id
+        self.m_bcache.create_cache_device.return_value = 'cset'
+        self.m_bcache.create_backing_devices.return_value = [
+            '/dev/bcache0', '/dev/bcache1', '/dev/bcache2']
+
+        block_meta.bcache_handler(self.storage_config['id_bcache0'],
+                                  self.storage_config, {})
+        self.assertEqual([
+            call([('/dev/id_rotary0_part2', 'writeback'),
+                  ('/dev/id_rotary1', 'writethrough'),
+                  ('/dev/id_rotary2', 'writethrough')],
+                 '/dev/id_ssd0', 'cset')],
+            self.m_bcache.create_backing_devices.call_args_list)
+
+        # siblings created in the batch are not created again
+        block_meta.bcache_handler(self.storage_config['id_bcache1'],
+                                  self.storage_config, {})
+        self.assertEqual(
+            1, self.m_bcache.create_backing_devices.call_count)
+        self.m_block.wipe_volume.assert_called_with(
+            '/dev/bcache1', mode='superblock', exclusive=False)
+
+        # the cache set is reused for bcaches created later
+        self.m_bcache.create_backing_devices.return_value = ['/dev/bcache3']
+        block_meta.bcache_handler(self.storage_config['id_bcache3'],
+                                  self.storage_config, {})
+        self.assertEqual(1, self.m_bcache.create_cache_device.call_count)
+        self.m_bcache.create_backing_devices.assert_called_with(
+            [('/dev/id_rotary3', 'writethrough')], '/dev/id_ssd0', 'cset')
 
 
 class TestPartitionHandler(CiTestCase):
@@ -2354,6 +3147,61 @@ class TestPartitionHandler(CiTestCase):
         m_verify_fdasd.assert_has_calls([call(devpath, 1, sconfig[1])])
 
 
+class TestPartitionNumbering(CiTestCase):
+
+    config = [
+        {'id': 'sda', 'type': 'disk', 'ptable': 'msdos'},
+        {'id': 'sda-p1', 'type': 'partition', 'device': 'sda'},
+        {'id': 'sda-p2', 'type': 'partition', 'device': 'sda',
+         'flag': 'extended'},
+        {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+        {'id': 'sdb-p1', 'type': 'partition', 'device': 'sdb'},
+        {'id': 'sda-p5', 'type': 'partition', 'device': 'sda',
+         'flag': 'logical'},
+        {'id': 'sda-p6', 'type': 'partition', 'device': 'sda',
+         'flag': 'logical'},
+        {'id': 'sdb-p2', 'type': 'partition', 'device': 'sdb', 'number': 7},
+    ]
+
+    def _configs(self):
+        """ yield the config as a plain OrderedDict and indexed """
+        odict = OrderedDict((item['id'], item) for item in self.config)
+        yield odict
+        yield block_meta.IndexedStorageConfig(odict)
+
+    def test_determine_partition_number(self):
+        expected = {'sda-p1': 1, 'sda-p2': 2, 'sda-p5': 5, 'sda-p6': 6,
+                    'sdb-p1': 1, 'sdb-p2': 7}
+        for sconfig in self._configs():
+            self.assertEqual(
+                expected,
+                dict((part_id, block_meta.determine_partition_number(
+                      part_id, sconfig)) for part_id in expected))
+
+    def test_find_previous_partition(self):
+        for sconfig in self._configs():
+            self.assertIsNone(
+                block_meta.find_previous_partition('sda', 'sda-p1', sconfig))
+            self.assertEqual(
+                1, block_meta.find_previous_partition('sda', 'sda-p5',
+                                                      sconfig))
+            self.assertEqual(
+                5, block_meta.find_previous_partition('sda', 'sda-p6',
+                                                      sconfig))
+            self.assertEqual(
+                1, block_meta.find_previous_partition('sdb', 'sdb-p2',
+                                                      sconfig))
+
+    def test_logical_partitions(self):
+        for sconfig in self._configs():
+            self.assertEqual(
+                2, block_meta.getnumberoflogicaldisks('sda', sconfig))
+            self.assertEqual(
+                0, block_meta.getnumberoflogicaldisks('sdb', sconfig))
+            self.assertEqual(
+                'sda-p2', block_meta.find_extended_partition('sda', sconfig))
+
+
 class TestMultipathPartitionHandler(CiTestCase):
 
     def setUp(self):
@@ -2908,4 +3756,71 @@ class TestGetDevicePathsFromStorageConfig(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestGetStorageConfigGraph(CiTestCase):
+
+    def setUp(self):
+        super(TestGetStorageConfigGraph, self).setUp()
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'size': '1G'},
+                    {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                     'size': '1G'},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'size': '1G'},
+                    {'id': 'sda1-fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sda1'},
+                    {'id': 'sdb1-fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sdb1'},
+                    {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+                     'name': 'md0', 'devices': ['sda2', 'sdb1']},
+                    {'id': 'sda1-mnt', 'type': 'mount', 'path': '/',
+                     'device': 'sda1-fmt'},
+                    {'id': 'sdb1-mnt', 'type': 'mount', 'path': '/srv',
+                     'device': 'sdb1-fmt'},
+                ],
+            }
+        }
+        self.sconfig = block_meta.extract_storage_ordered_dict(self.config)
+
+    def test_graph_preserves_config_order(self):
+        graph = block_meta.get_storage_config_graph(self.sconfig)
+        self.assertEqual(list(self.sconfig), list(graph))
+
+    def test_graph_disks_are_independent(self):
+        graph = block_meta.get_storage_config_graph(self.sconfig)
+        self.assertEqual(set(), graph['sda'])
+        self.assertEqual(set(), graph['sdb'])
+        self.assertEqual(set(['sda']), graph['sda1'])
+        self.assertEqual(set(['sdb']), graph['sdb1'])
+
+    def test_graph_chains_items_on_the_same_disk(self):
+        graph = block_meta.get_storage_config_graph(self.sconfig)
+        self.assertEqual(set(['sda', 'sda1']), graph['sda2'])
+        self.assertEqual(set(['sda1', 'sda2']), graph['sda1-fmt'])
+
+    def test_graph_composed_devices_follow_all_disks(self):
+        graph = block_meta.get_storage_config_graph(self.sconfig)
+        self.assertEqual(set(['sda2', 'sdb1', 'sda1-fmt', 'sdb1-fmt']),
+                         graph['md0'])
+
+    def test_graph_mounts_are_chained(self):
+        graph = block_meta.get_storage_config_graph(self.sconfig)
+        self.assertIn('sda1-mnt', graph['sdb1-mnt'])
+
+    def test_graph_disk_depends_on_dasd(self):
+        sconfig = OrderedDict([
+            ('dasd0', {'id': 'dasd0', 'type': 'dasd',
+                       'device_id': '0.0.1544'}),
+            ('disk0', {'id': 'disk0', 'type': 'disk',
+                       'device_id': '0.0.1544'}),
+        ])
+        graph = block_meta.get_storage_config_graph(sconfig)
+        self.assertEqual(set(['dasd0']), graph['disk0'])
+
+
 # vi: ts=4 expandtab syntax=python
@@ -0,0 +1,39 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import argparse
+import mock
+
+from curtin.commands import block_wipe
+from .helpers import CiTestCase
+
+
+class TestBlockWipe(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockWipe, self).setUp()
+        self.add_patch('curtin.commands.block_wipe.block.wipe_volume',
+                       'm_wipe_volume')
+        self.parser = argparse.ArgumentParser()
+        block_wipe.POPULATE_SUBCMD(self.parser)
+
+    def test_wipes_all_devices(self):
+        args = self.parser.parse_args(
+            ['--mode', 'zero', '--workers', '2', '/dev/vdb', '/dev/vdc'])
+        with self.assertRaises(SystemExit) as exit:
+            block_wipe.wipe_main(args)
+        self.assertEqual(0, exit.exception.code)
+        self.assertEqual(
+            sorted([mock.call('/dev/vdb', mode='zero'),
+                    mock.call('/dev/vdc', mode='zero')]),
+            sorted(self.m_wipe_volume.call_args_list))
+
+    @mock.patch('curtin.commands.block_wipe.sys.stderr')
+    def test_wipe_failure_exits_nonzero(self, m_stderr):
+        self.m_wipe_volume.side_effect = OSError('device busy')
+        args = self.parser.parse_args(['--workers', '2', '/dev/vdb'])
+        with self.assertRaises(SystemExit) as exit:
+            block_wipe.wipe_main(args)
+        self.assertEqual(1, exit.exception.code)
+        self.assertIn('/dev/vdb', m_stderr.write.call_args[0][0])
+
+# vi: ts=4 expandtab syntax=python
@@ -20,5 +20,12 @@ class TestClearHolders(CiTestCase):
         args = parser.parse_args(argv)
         self.assertEqual(list, type(args.devices))
 
+    def test_argument_parsing_workers(self):
+        parser = argparse.ArgumentParser()
+        clear_holders.POPULATE_SUBCMD(parser)
+        self.assertEqual(1, parser.parse_args(['/dev/vda']).workers)
+        self.assertEqual(
+            4, parser.parse_args(['-w', '4', '/dev/vda']).workers)
+
 
 # vi: ts=4 expandtab syntax=python
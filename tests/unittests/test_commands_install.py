@@ -1,6 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import copy
+import os
 import mock
 
 from curtin import config
@@ -190,6 +191,36 @@ class TestCmdInstall(CiTestCase):
             [mock.call(self.logfile, target_dir, '/root/curtin-install.log')],
             self.m_copy_log.call_args_list)
 
+    def test_restore_mount_options_failure_keeps_exception(self):
+        """A failure restoring mount options does not replace the error."""
+        working_dir = self.tmp_path('working', _dir=self.new_root)
+        ensure_dir(working_dir)
+        myargs = FakeArgs(
+            config={'install': {'log_file': self.logfile,
+                                'error_tarfile': None}},
+            source=['dd-raw:https://localhost/raw_images/centos-6-3.img',
+                    'dd-raw:https://localhost/cant/provide/two/images.img'],
+            reportstack=FakeReportStack())
+        self.add_patch(
+            'curtin.commands.install.copy_install_log', 'm_copy_log')
+        self.add_patch(
+            'curtin.commands.install.tempfile.mkdtemp', 'm_mkdtemp')
+        self.add_patch(
+            'curtin.commands.install.restore_install_mount_options',
+            'm_restore')
+        self.m_mkdtemp.return_value = working_dir
+        self.m_restore.side_effect = RuntimeError('sync failed')
+        with self.assertRaises(ValueError) as context_manager:
+            install.cmd_install(myargs)
+        self.assertEqual(
+            'You may not use more than one disk image',
+            str(context_manager.exception))
+        self.assertEqual(
+            [mock.call(os.path.join(working_dir, 'state',
+                                    'install_mounts.json'))],
+            self.m_restore.call_args_list)
+        self.assertEqual(1, self.m_copy_log.call_count)
+
 
 class TestWorkingDir(CiTestCase):
     def test_target_dir_may_exist(self):
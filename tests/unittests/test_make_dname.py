@@ -163,9 +163,24 @@ class TestMakeDname(CiTestCase):
 
         mock_util.subp.side_effect = self._make_mock_subp_blkid(
             '', self.trusty_blkid)
-        # partition with no PART_UUID
-        block_meta.make_dname('disk1p1', self.storage_config)
-        mock_log.warning.assert_called_with(warning_msg, 'disk1p1')
+        # named partition with no PART_UUID
+        block_meta.make_dname('disk1p2', self.storage_config)
+        mock_log.warning.assert_called_with(warning_msg, 'disk1p2')
+        self.assertFalse(mock_util.write_file.called)
+
+    @mock.patch('curtin.commands.block_meta.LOG')
+    @mock.patch('curtin.commands.block_meta.get_path_to_storage_volume')
+    @mock.patch('curtin.commands.block_meta.util')
+    def test_make_dname_unnamed_partition(self, mock_util, mock_get_path,
+                                          mock_log):
+        mock_util.load_command_environment.return_value = self.state
+        devices = mock.Mock()
+        devices.blkid.return_value = {}
+
+        block_meta.make_dname('disk1p1', self.storage_config, devices=devices)
+        self.assertFalse(mock_log.warning.called)
+        self.assertFalse(devices.blkid.called)
+        self.assertFalse(mock_util.subp.called)
         self.assertFalse(mock_util.write_file.called)
 
     @mock.patch('curtin.commands.block_meta.LOG')
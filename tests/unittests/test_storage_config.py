@@ -1,6 +1,8 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+from collections import OrderedDict
 import copy
 import json
+import mock
 from .helpers import CiTestCase, skipUnlessJsonSchema
 from curtin import storage_config
 from curtin.storage_config import ProbertParser as baseparser
@@ -103,6 +105,55 @@ class TestStorageConfigSchema(CiTestCase):
         with self.assertRaises(ValueError):
             storage_config.validate_config(config)
 
+    @skipUnlessJsonSchema()
+    def test_validate_config_builds_validators_once(self):
+        disk = {'id': 'disk-vdc', 'path': '/dev/vdc', 'type': 'disk'}
+        storage_config.validate_config({'config': [disk], 'version': 1})
+        validators = dict(storage_config._SCHEMA_VALIDATORS)
+        self.assertIn(None, validators)
+        self.assertIn('disk', validators)
+        storage_config.validate_config({'config': [disk], 'version': 1})
+        storage_config.validate_config(disk)
+        for stype, validator in validators.items():
+            self.assertIs(validator, storage_config._SCHEMA_VALIDATORS[stype])
+
+    @skipUnlessJsonSchema()
+    def test_validate_config_validates_single_item(self):
+        storage_config.validate_config(
+            {'id': 'disk-vdc', 'path': '/dev/vdc', 'type': 'disk'})
+        with self.assertRaisesRegex(ValueError, 'ptable'):
+            storage_config.validate_config(
+                {'id': 'disk-vdc', 'type': 'disk', 'ptable': 'bogus'},
+                sourcefile='storage.yaml')
+
+    @skipUnlessJsonSchema()
+    def test_validate_config_reports_invalid_item(self):
+        config = {'version': 1, 'config': [
+            {'id': 'disk-vdc', 'type': 'disk', 'path': '/dev/vdc'},
+            {'id': 'vdc1', 'type': 'partition', 'device': 'disk-vdc',
+             'size': 0}]}
+        with self.assertRaisesRegex(ValueError,
+                                    'minimum of 1 in storage.yaml'):
+            storage_config.validate_config(config, sourcefile='storage.yaml')
+
+    @skipUnlessJsonSchema()
+    def test_validate_config_unknown_and_missing_type(self):
+        for item, error in (({'id': 'x', 'type': 'floppy'},
+                             'Unknown storage type: floppy'),
+                            ({'id': 'x'}, "'type' is a required property")):
+            with self.assertRaisesRegex(ValueError, error):
+                storage_config.validate_config(
+                    {'version': 1, 'config': [item]})
+
+    @skipUnlessJsonSchema()
+    def test_validate_config_checks_storage_config_keys(self):
+        with self.assertRaisesRegex(ValueError, 'Unexpected value'):
+            storage_config.validate_config(
+                {'version': 3, 'config': [{'id': 'x', 'type': 'disk'}]})
+        with self.assertRaisesRegex(ValueError,
+                                    "'config' is a required property"):
+            storage_config.validate_config({'version': 1})
+
 
 class TestProbertParser(CiTestCase):
 
@@ -149,6 +200,60 @@ def _get_data(datafile):
     return jdata.get('storage') if 'storage' in jdata else jdata
 
 
+class TestProbertIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestProbertIndex, self).setUp()
+        self.probe_data = _get_data('probert_storage_lvm.json')
+        self.index = storage_config.ProbertIndex(self.probe_data['blockdev'])
+
+    def test_lookup_devname(self):
+        self.assertEqual('/dev/vdc1', self.index.lookup_devname('/dev/vdc1'))
+        self.assertEqual(
+            '/dev/vdc1',
+            self.index.lookup_devname('/dev/disk/by-id/virtio-disk-b-part1'))
+        self.assertEqual('/dev/dm-1',
+                         self.index.lookup_devname('/dev/mapper/vg1-lv2'))
+        self.assertIsNone(self.index.lookup_devname('/dev/disk/by-id/nope'))
+        self.assertIsNone(self.index.lookup_devname(None))
+
+    def test_skips_empty_blockdev_data(self):
+        index = storage_config.ProbertIndex(
+            {'/dev/vda': None,
+             '/dev/vdb': {'DEVLINKS': '/dev/disk/by-id/virtio-b'}})
+        self.assertEqual('/dev/vdb',
+                         index.lookup_devname('/dev/disk/by-id/virtio-b'))
+        self.assertEqual('/dev/vda', index.lookup_devname('/dev/vda'))
+
+    def test_ptable_entry(self):
+        self.assertEqual(
+            {'node': '/dev/vda5', 'size': 4194304, 'start': 6295552,
+             'type': '83'},
+            self.index.ptable_entry('/dev/vda', '/dev/vda5'))
+        self.assertIsNone(self.index.ptable_entry('/dev/vda', '/dev/vdc1'))
+        self.assertIsNone(self.index.ptable_entry('/dev/nope', '/dev/vda5'))
+
+    def test_parsers_share_index(self):
+        parsers = [parser(self.probe_data, index=self.index)
+                   for parser in (BlockdevParser, LvmParser, MountParser)]
+        for parser in parsers:
+            self.assertIs(self.index, parser.index)
+
+    def test_parser_builds_index_when_not_given(self):
+        parser = LvmParser(self.probe_data)
+        self.assertEqual('/dev/dm-1',
+                         parser.lookup_devname('/dev/mapper/vg1-lv2'))
+        self.assertIs(parser.index, parser.index)
+
+    @skipUnlessJsonSchema()
+    def test_extract_storage_config_builds_one_index(self):
+        real_index = storage_config.ProbertIndex
+        with mock.patch('curtin.storage_config.ProbertIndex') as m_index:
+            m_index.side_effect = real_index
+            storage_config.extract_storage_config(self.probe_data)
+        self.assertEqual(1, m_index.call_count)
+
+
 class TestBcacheParser(CiTestCase):
 
     def setUp(self):
@@ -1117,4 +1222,178 @@ class TestExtractStorageConfig(CiTestCase):
         self.assertEqual(expected_dict, bitlocker[0])
 
 
+class TestStorageConfigDependencies(CiTestCase):
+
+    config = [
+        {'id': 'disk-sda', 'type': 'disk', 'path': '/dev/sda'},
+        {'id': 'disk-sdb', 'type': 'disk', 'path': '/dev/sdb'},
+        {'id': 'sda2', 'type': 'partition', 'number': 2, 'device': 'disk-sda',
+         'size': '1G'},
+        {'id': 'sda1', 'type': 'partition', 'number': 1, 'device': 'disk-sda',
+         'size': '1G'},
+        {'id': 'sdb1', 'type': 'partition', 'number': 1, 'device': 'disk-sdb',
+         'size': '1G'},
+        {'id': 'vg1', 'type': 'lvm_volgroup', 'name': 'vg1',
+         'devices': ['sda2', 'sdb1']},
+        {'id': 'lv1', 'type': 'lvm_partition', 'name': 'lv1', 'size': '1G',
+         'volgroup': 'vg1'},
+        {'id': 'format-lv1', 'type': 'format', 'fstype': 'ext4',
+         'volume': 'lv1'},
+        {'id': 'mount-lv1', 'type': 'mount', 'path': '/srv',
+         'device': 'format-lv1'},
+        {'id': 'format-sda1', 'type': 'format', 'fstype': 'ext4',
+         'volume': 'sda1'},
+        {'id': 'mount-sda1', 'type': 'mount', 'path': '/',
+         'device': 'format-sda1'},
+    ]
+
+    def _sconfig(self, config=None):
+        return storage_config.extract_storage_ordered_dict(
+            {'storage': {'version': 2, 'config': config or self.config}})
+
+    def test_find_item_dependencies_includes_siblings(self):
+        """ partitions depend on their disk and on sibling partitions. """
+        self.assertEqual(
+            ['disk-sda', 'sda1', 'sda2'],
+            storage_config.find_item_dependencies('sda2', self._sconfig()))
+
+    def test_find_item_dependencies_recurses(self):
+        deps = storage_config.find_item_dependencies('mount-lv1',
+                                                     self._sconfig())
+        self.assertEqual(
+            {'mount-lv1', 'format-lv1', 'lv1', 'vg1', 'sda1', 'sda2', 'sdb1',
+             'disk-sda', 'disk-sdb'}, set(deps))
+
+    def test_find_item_dependencies_missing_item(self):
+        self.assertIsNone(
+            storage_config.find_item_dependencies('sdz', self._sconfig()))
+
+    def test_find_item_dependencies_validates_types(self):
+        config = copy.deepcopy(self.config)
+        config[2]['device'] = 'sda1'
+        config[3]['device'] = 'format-sda1'
+        with self.assertRaises(ValueError):
+            storage_config.find_item_dependencies('sda2',
+                                                  self._sconfig(config))
+
+    def test_find_item_dependencies_raises_on_cycle(self):
+        config = copy.deepcopy(self.config)
+        config[0] = {'id': 'disk-sda', 'type': 'partition', 'number': 3,
+                     'device': 'sda1', 'size': '1G'}
+        with self.assertRaises(ValueError):
+            storage_config.find_item_dependencies('sda1',
+                                                  self._sconfig(config))
+
+    def test_get_config_tree(self):
+        tree = storage_config.get_config_tree(
+            'format-sda1', {'storage': {'version': 2,
+                                        'config': self.config}})
+        self.assertEqual(['format-sda1', 'sda1', 'disk-sda', 'sda2'],
+                         list(tree.keys()))
+
+    def test_sort_storage_config_orders_dependencies_first(self):
+        """ every item is listed after all of the items it depends upon. """
+        ordered = storage_config.sort_storage_config(
+            list(reversed(self.config)))
+        self.assertEqual(sorted(cfg['id'] for cfg in self.config),
+                         sorted(cfg['id'] for cfg in ordered))
+        seen = set()
+        for cfg in ordered:
+            deps = storage_config.get_item_direct_dependencies(cfg)
+            self.assertEqual(set(), set(deps) - seen, cfg['id'])
+            seen.add(cfg['id'])
+
+    def test_sort_storage_config_empty(self):
+        self.assertEqual([], storage_config.sort_storage_config([]))
+
+    @skipUnlessJsonSchema()
+    def test_extract_orders_dependencies_first(self):
+        probe_data = _get_data('probert_storage_lvm.json')
+        extracted = storage_config.extract_storage_config(probe_data)
+        seen = set()
+        for cfg in extracted['storage']['config']:
+            deps = storage_config.get_item_direct_dependencies(cfg)
+            self.assertEqual(set(), set(deps) - seen, cfg['id'])
+            seen.add(cfg['id'])
+
+
+class TestIndexedStorageConfig(CiTestCase):
+
+    config = [
+        {'id': 'sda', 'type': 'disk', 'ptable': 'msdos'},
+        {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+        {'id': 'sda1', 'type': 'partition', 'device': 'sda', 'size': '1G'},
+        {'id': 'sda2', 'type': 'partition', 'device': 'sda', 'size': '4G',
+         'flag': 'extended'},
+        {'id': 'sda5', 'type': 'partition', 'device': 'sda', 'size': '1G',
+         'flag': 'logical'},
+        {'id': 'sdb1', 'type': 'partition', 'device': 'sdb', 'size': '1G'},
+        {'id': 'sda6', 'type': 'partition', 'device': 'sda', 'size': '1G',
+         'flag': 'logical'},
+        {'id': 'vg1', 'type': 'lvm_volgroup', 'name': 'vg1',
+         'devices': ['sda5', 'sdb1']},
+        {'id': 'lv1', 'type': 'lvm_partition', 'name': 'lv1',
+         'volgroup': 'vg1'},
+    ]
+
+    def setUp(self):
+        super(TestIndexedStorageConfig, self).setUp()
+        self.sconfig = storage_config.IndexedStorageConfig(
+            storage_config.extract_storage_ordered_dict(
+                {'storage': {'version': 1,
+                             'config': copy.deepcopy(self.config)}}))
+
+    def _partitions(self, device_id):
+        return self.sconfig.get_partitions_before(device_id, None)
+
+    def test_is_ordered_dict_of_items(self):
+        self.assertIsInstance(self.sconfig, OrderedDict)
+        self.assertEqual([cfg['id'] for cfg in self.config],
+                         list(self.sconfig.keys()))
+        self.assertEqual(storage_config.extract_storage_ordered_dict(
+            {'storage': {'config': self.config}}), self.sconfig)
+
+    def test_storage_config_type_alias(self):
+        self.assertIs(storage_config.StorageConfigType,
+                      storage_config.StorageConfig)
+
+    def test_partitions(self):
+        self.assertEqual(3, self.sconfig.get_partition_index('sda6'))
+        self.assertIsNone(self.sconfig.get_partition_index('vg1'))
+        self.assertEqual(0, self.sconfig.get_logical_partition_index('sda5'))
+        self.assertEqual(1, self.sconfig.get_logical_partition_index('sda6'))
+        self.assertIsNone(self.sconfig.get_logical_partition_index('sda1'))
+        self.assertEqual(2, self.sconfig.count_logical('sda'))
+        self.assertEqual('sda2', self.sconfig.get_extended_partition('sda'))
+        self.assertIsNone(self.sconfig.get_extended_partition('sdb'))
+
+    def test_partitions_before(self):
+        self.assertEqual(['sda1', 'sda2', 'sda5'],
+                         self.sconfig.get_partitions_before('sda', 'sda6'))
+        self.assertEqual(['sda1', 'sda2', 'sda5'],
+                         self.sconfig.get_partitions_before('sda', 'sdb1'))
+        self.assertEqual(['sda1', 'sda2', 'sda5', 'sda6'],
+                         self.sconfig.get_partitions_before('sda', 'nope'))
+        self.assertEqual([], self.sconfig.get_partitions_before('sdz', 'sda1'))
+
+    def test_index_dropped_on_change(self):
+        self.assertEqual(['sdb1'], self._partitions('sdb'))
+        self.sconfig['sdb2'] = {'id': 'sdb2', 'type': 'partition',
+                                'device': 'sdb', 'size': '1G'}
+        self.assertEqual(['sdb1', 'sdb2'], self._partitions('sdb'))
+        del self.sconfig['sdb1']
+        self.assertEqual(['sdb2'], self._partitions('sdb'))
+        self.sconfig.pop('sdb2')
+        self.assertEqual([], self._partitions('sdb'))
+
+    def test_copies_are_indexed_independently(self):
+        self.assertEqual(['sdb1'], self._partitions('sdb'))
+        for dup in (copy.copy(self.sconfig), copy.deepcopy(self.sconfig),
+                    self.sconfig.copy()):
+            self.assertIsInstance(dup, storage_config.IndexedStorageConfig)
+            self.assertEqual(self.sconfig, dup)
+            del dup['sdb1']
+            self.assertEqual([], dup.get_partitions_before('sdb', None))
+            self.assertEqual(['sdb1'], self._partitions('sdb'))
+
 # vi: ts=4 expandtab syntax=python
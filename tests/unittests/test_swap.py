@@ -1,4 +1,5 @@
 import mock
+import os
 
 from curtin import swap
 from curtin import util
@@ -51,3 +52,121 @@ class TestSwap(CiTestCase):
         blob = b'\x00\x00c\x05\x00\x00\x11\x19'
         util.write_file(path, int(pagesize * 2 / len(blob)) * blob, omode="wb")
         self.assertFalse(swap.is_swap_device(path))
+
+
+class TestAllocateSwapfile(CiTestCase):
+
+    size = 8 * 2 ** 20
+
+    def _assert_no_holes(self, path):
+        self.assertEqual(self.size, os.path.getsize(path))
+        # a file with holes has fewer blocks allocated than its size
+        self.assertGreaterEqual(os.stat(path).st_blocks * 512, self.size)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            swap.get_file_extents(fd)
+        except (IOError, OSError):
+            # the test directory's filesystem does not support FIEMAP
+            return
+        else:
+            self.assertTrue(swap.swapfile_extents_ok(fd, self.size))
+        finally:
+            os.close(fd)
+
+    def test_allocate_swapfile_has_no_holes(self):
+        """allocate_swapfile creates a file of size without holes."""
+        path = self.tmp_path('swap.img')
+        swap.allocate_swapfile(path, self.size, fstype='ext4')
+        self._assert_no_holes(path)
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+    @mock.patch('curtin.swap._write_zeros', wraps=swap._write_zeros)
+    def test_allocate_swapfile_writes_zeros_without_fallocate(self, m_zero):
+        """allocate_swapfile writes zeros on filesystems lacking fallocate."""
+        path = self.tmp_path('swap.img')
+        swap.allocate_swapfile(path, self.size, fstype='ext3')
+        self.assertEqual(1, m_zero.call_count)
+        self._assert_no_holes(path)
+
+    @mock.patch('curtin.swap._fallocate')
+    @mock.patch('curtin.swap._write_zeros', wraps=swap._write_zeros)
+    def test_allocate_swapfile_writes_zeros_on_old_xfs_kernels(self, m_zero,
+                                                               m_falloc):
+        """allocate_swapfile only fallocates on xfs for kernels >= 4.18."""
+        path = self.tmp_path('swap.img')
+        for kernel_version in (None, (4, 15), (3, 13)):
+            m_zero.reset_mock()
+            swap.allocate_swapfile(path, self.size, fstype='xfs',
+                                   kernel_version=kernel_version)
+            self.assertEqual(0, m_falloc.call_count)
+            self.assertEqual(1, m_zero.call_count)
+            self._assert_no_holes(path)
+
+    @mock.patch('curtin.swap.swapfile_extents_ok', return_value=True)
+    @mock.patch('curtin.swap._fallocate', return_value=True)
+    @mock.patch('curtin.swap._write_zeros')
+    def test_allocate_swapfile_fallocates_on_new_xfs_kernels(
+            self, m_zero, m_falloc, m_extents_ok):
+        """allocate_swapfile fallocates on xfs for kernels >= 4.18."""
+        path = self.tmp_path('swap.img')
+        for kernel_version in ((4, 18), (5, 15)):
+            swap.allocate_swapfile(path, self.size, fstype='xfs',
+                                   kernel_version=kernel_version)
+        self.assertEqual(2, m_falloc.call_count)
+        self.assertEqual(0, m_zero.call_count)
+
+    def test_swapfile_can_fallocate(self):
+        self.assertTrue(swap.swapfile_can_fallocate('ext4'))
+        self.assertTrue(swap.swapfile_can_fallocate('btrfs'))
+        self.assertFalse(swap.swapfile_can_fallocate('ext3', (5, 15)))
+        self.assertFalse(swap.swapfile_can_fallocate('xfs'))
+        self.assertFalse(swap.swapfile_can_fallocate('xfs', (4, 17)))
+        self.assertTrue(swap.swapfile_can_fallocate('xfs', (4, 18)))
+
+    @mock.patch('curtin.swap.util.subp')
+    @mock.patch('curtin.swap.allocate_swapfile')
+    @mock.patch('curtin.swap.get_target_kernel_version')
+    @mock.patch('curtin.swap.can_use_swapfile')
+    @mock.patch('curtin.swap.get_fstype', return_value='xfs')
+    def test_setup_swapfile_passes_target_kernel(self, m_fstype, m_can_use,
+                                                 m_kernel, m_allocate,
+                                                 m_subp):
+        """setup_swapfile passes the target kernel version for xfs."""
+        target = self.tmp_dir()
+        m_kernel.return_value = {'major': 5, 'minor': 4, 'micro': 0}
+        swap.setup_swapfile(target, size=self.size)
+        m_allocate.assert_called_with(
+            os.path.sep.join([target, '/swap.img']), self.size,
+            fstype='xfs', kernel_version=(5, 4))
+
+    @mock.patch('curtin.swap.swapfile_extents_ok', return_value=False)
+    @mock.patch('curtin.swap._write_zeros', wraps=swap._write_zeros)
+    def test_allocate_swapfile_writes_zeros_if_extents_unusable(
+            self, m_zero, m_extents_ok):
+        """allocate_swapfile falls back to zeros if fallocate falls short."""
+        path = self.tmp_path('swap.img')
+        util.write_file(path, 'old swapfile')
+        swap.allocate_swapfile(path, self.size, fstype='ext4')
+        self.assertEqual(1, m_zero.call_count)
+        self.assertEqual(self.size, os.path.getsize(path))
+        self.assertGreaterEqual(os.stat(path).st_blocks * 512, self.size)
+
+    @mock.patch('curtin.swap._set_nocow')
+    def test_allocate_swapfile_btrfs_nocow(self, m_nocow):
+        """allocate_swapfile disables copy-on-write on btrfs."""
+        path = self.tmp_path('swap.img')
+        swap.allocate_swapfile(path, self.size, fstype='btrfs')
+        self.assertEqual(1, m_nocow.call_count)
+        self._assert_no_holes(path)
+
+    def test_swapfile_extents_ok_false_for_sparse_file(self):
+        """swapfile_extents_ok rejects a file with holes."""
+        path = self.tmp_path('sparse')
+        with open(path, 'wb') as fp:
+            fp.seek(self.size - 4096)
+            fp.write(b'\1' * 4096)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.assertFalse(swap.swapfile_extents_ok(fd, self.size))
+        finally:
+            os.close(fd)
@@ -1,13 +1,17 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import mock
+import os
 import shlex
+import threading
 
 from curtin.udev import (
         udevadm_info,
+        udevadm_info_db,
         shlex_quote,
+        wait_for_paths,
         )
-from curtin import util
+from curtin import udev, util
 from .helpers import CiTestCase
 
 
@@ -116,3 +120,116 @@ class TestUdevInfo(CiTestCase):
             ['udevadm', 'info', '--query=property', '--export', mypath],
             capture=True)
         self.assertEqual({'SCSI_IDENT_TARGET_VENDOR': 'clusterid=92901'}, info)
+
+
+class TestWaitForPaths(CiTestCase):
+
+    def test_wait_for_paths_returns_at_once_if_present(self):
+        """wait_for_paths does not listen for uevents if paths exist."""
+        path = self.tmp_path('present')
+        util.write_file(path, '')
+        with mock.patch('curtin.udev._uevent_socket') as m_socket:
+            self.assertEqual([], wait_for_paths([path], timeout=5))
+        self.assertEqual(0, m_socket.call_count)
+
+    def test_wait_for_paths_returns_when_path_appears(self):
+        """wait_for_paths returns once the last path is created."""
+        present = self.tmp_path('present')
+        util.write_file(present, '')
+        later = self.tmp_path('later')
+        timer = threading.Timer(0.2, util.write_file, args=(later, ''))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual([], wait_for_paths([present, later], timeout=30))
+        self.assertTrue(os.path.exists(later))
+
+    def test_wait_for_paths_removal(self):
+        """wait_for_paths with exists=False waits for paths to go away."""
+        path = self.tmp_path('going')
+        util.write_file(path, '')
+        timer = threading.Timer(0.2, os.unlink, args=(path,))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual([], wait_for_paths([path], timeout=30,
+                                            exists=False))
+
+    @mock.patch('curtin.udev._uevent_socket')
+    def test_wait_for_paths_timeout_without_uevent_socket(self, m_socket):
+        """wait_for_paths polls without a uevent socket, returns missing."""
+        m_socket.return_value = None
+        missing = self.tmp_path('missing')
+        with mock.patch.object(udev, 'UEVENT_POLL_INTERVAL', 0.01):
+            self.assertEqual([missing],
+                             wait_for_paths([missing], timeout=0.05))
+
+
+UDEVADM_EXPORT_DB = """\
+P: /devices/virtual/tty/tty0
+N: tty0
+E: DEVNAME=/dev/tty0
+E: SUBSYSTEM=tty
+
+P: /devices/pci0000:00/0000:00:1c.4/0000:05:00.0/nvme/nvme0/nvme0n1
+N: nvme0n1
+S: disk/by-id/nvme-eui.0025388b710116a1
+E: DEVLINKS=/dev/disk/by-id/nvme-eui.0025388b710116a1 /dev/disk/by-id/nvme-n1
+E: DEVNAME=/dev/nvme0n1
+E: DEVTYPE=disk
+E: ID_SERIAL=SAMSUNG MZVLB1T0HALR-000L7_S3TPNY0JB00151
+E: SUBSYSTEM=block
+
+P: /devices/virtual/block/loop0
+N: loop0
+E: DEVNAME=/dev/loop0
+E: DEVTYPE=disk
+E: SUBSYSTEM=block
+"""
+
+
+class TestUdevadmSettle(CiTestCase):
+
+    @mock.patch('curtin.util.subp')
+    def test_udevadm_settle_serialized(self, m_subp):
+        """concurrent udevadm_settle calls run one at a time."""
+        running = []
+        overlapped = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def subp(cmd):
+            if running:
+                overlapped.append(cmd)
+            running.append(cmd)
+            started.set()
+            release.wait(5)
+            running.remove(cmd)
+
+        m_subp.side_effect = subp
+        threads = [threading.Thread(target=udev.udevadm_settle)
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(3, m_subp.call_count)
+        self.assertEqual([], overlapped)
+
+
+class TestUdevInfoDb(CiTestCase):
+
+    @mock.patch('curtin.util.subp')
+    def test_udevadm_info_db(self, m_subp):
+        """udevadm_info_db returns properties of every block device."""
+        m_subp.return_value = (UDEVADM_EXPORT_DB, "")
+        devices = udevadm_info_db()
+        m_subp.assert_called_with(['udevadm', 'info', '--export-db'],
+                                  capture=True)
+        self.assertEqual(['/dev/loop0', '/dev/nvme0n1'], sorted(devices))
+        nvme = devices['/dev/nvme0n1']
+        self.assertEqual(['/dev/disk/by-id/nvme-eui.0025388b710116a1',
+                          '/dev/disk/by-id/nvme-n1'], nvme['DEVLINKS'])
+        self.assertEqual('SAMSUNG MZVLB1T0HALR-000L7_S3TPNY0JB00151',
+                         nvme['ID_SERIAL'])
+        self.assertEqual([], devices['/dev/loop0']['DEVLINKS'])
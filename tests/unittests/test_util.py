@@ -1,10 +1,13 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from collections import OrderedDict
 from unittest import skipIf
 import mock
 import os
 import stat
 from textwrap import dedent
+import threading
+import time
 
 from curtin import util
 from curtin import paths
@@ -25,6 +28,91 @@ class TestLogTimer(CiTestCase):
         self.assertIn("mymessage", data['msg'])
 
 
+class TestRunDependencyGraph(CiTestCase):
+
+    def setUp(self):
+        super(TestRunDependencyGraph, self).setUp()
+        self.graph = OrderedDict([
+            ('sda', set()),
+            ('sdb', set()),
+            ('sda1', set(['sda'])),
+            ('sdb1', set(['sdb'])),
+            ('md0', set(['sda1', 'sdb1'])),
+        ])
+
+    def assert_deps_first(self, order):
+        for node, deps in self.graph.items():
+            for dep in deps:
+                self.assertLess(order.index(dep), order.index(node))
+
+    def test_serial_runs_in_graph_order(self):
+        order = []
+        util.run_dependency_graph(self.graph, order.append)
+        self.assertEqual(list(self.graph), order)
+
+    def test_parallel_runs_deps_first(self):
+        order = []
+        lock = threading.Lock()
+
+        def func(node):
+            with lock:
+                order.append(node)
+
+        util.run_dependency_graph(self.graph, func, workers=4)
+        self.assertEqual(sorted(self.graph), sorted(order))
+        self.assert_deps_first(order)
+
+    def test_parallel_runs_independent_nodes_concurrently(self):
+        """Two independent nodes wait for each other and both finish."""
+        graph = OrderedDict([('a', []), ('b', [])])
+        barrier = {'a': threading.Event(), 'b': threading.Event()}
+
+        def func(node):
+            barrier[node].set()
+            other = 'b' if node == 'a' else 'a'
+            self.assertTrue(barrier[other].wait(5))
+
+        util.run_dependency_graph(graph, func, workers=2)
+
+    def test_parallel_lock_key_serializes_nodes(self):
+        graph = OrderedDict((str(i), []) for i in range(8))
+        active = []
+        overlap = []
+        lock = threading.Lock()
+
+        def func(node):
+            with lock:
+                active.append(node)
+                if len(active) > 1:
+                    overlap.append(list(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(node)
+
+        util.run_dependency_graph(graph, func, workers=4,
+                                  lock_key=lambda node: 'lvm')
+        self.assertEqual([], overlap)
+
+    def test_parallel_error_stops_new_nodes(self):
+        ran = []
+
+        def func(node):
+            ran.append(node)
+            if node == 'sda1':
+                raise RuntimeError('failed on %s' % node)
+
+        graph = OrderedDict([('sda', []), ('sda1', ['sda']),
+                             ('sda2', ['sda1'])])
+        with self.assertRaises(RuntimeError):
+            util.run_dependency_graph(graph, func, workers=2)
+        self.assertEqual(['sda', 'sda1'], ran)
+
+    def test_parallel_unsatisfiable_raises_value_error(self):
+        graph = OrderedDict([('a', ['b']), ('b', ['a'])])
+        with self.assertRaises(ValueError):
+            util.run_dependency_graph(graph, lambda node: None, workers=2)
+
+
 class TestDisableDaemons(CiTestCase):
     prcpath = "usr/sbin/policy-rc.d"
 